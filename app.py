@@ -1,4 +1,4 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context
 from flask_socketio import SocketIO, emit
 import logging
 from config import Config
@@ -7,18 +7,76 @@ from modules.network_tools import NetworkTools
 from modules.system_commands import SystemCommands
 from modules.os_detector import OSDetector
 from modules.automated_diagnostics import AutomatedDiagnostics, DiagnosticCommand
+from modules.llm_client import CircuitOpenError
+from modules.async_runner import get_async_runner
+from modules.job_manager import JobManager, JobQueueFull
+import atexit
 import json
+import threading
+import uuid
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your-secret-key-here'
 socketio = SocketIO(app, cors_allowed_origins="*")
 
 # Initialize modules
-chat_handler = ChatHandler()
-network_tools = NetworkTools()
 system_commands = SystemCommands()
+chat_handler = ChatHandler(system_commands=system_commands)
+network_tools = NetworkTools()
 os_detector = OSDetector()
 automated_diagnostics = AutomatedDiagnostics()
+async_runner = get_async_runner()
+
+# Cancel events of commands currently streaming to a client, by execution id
+running_commands = {}
+
+def run_user_command(command, description, session_id, diagnostic, on_output, cancel):
+    """Run a user-approved command with live output and record it in the session"""
+    # Diagnostic mode changes how the command runs, not what may run
+    if not system_commands._is_command_safe(command):
+        result = {
+            'success': False,
+            'output': 'Command not allowed for security reasons',
+            'error': 'Security validation failed'
+        }
+    elif diagnostic:
+        diagnostic_cmd = DiagnosticCommand(
+            name=description or "Custom Command",
+            description="User-approved diagnostic command",
+            command=command,
+            category="custom",
+            risk_level="low"
+        )
+        success, output = automated_diagnostics.execute_command_stream(diagnostic_cmd, on_output, cancel)
+        result = {'success': success, 'output': output if success else '', 'error': None if success else output}
+    else:
+        require_sudo = system_commands._requires_sudo(command) if os_detector.is_macos() else False
+        result = system_commands.execute_command_stream(command, on_output, require_sudo=require_sudo, cancel=cancel)
+    
+    if session_id:
+        chat_handler.chat_database.store_command_execution(
+            session_id, command, description, 
+            result.get('output', ''), result.get('error', ''),
+            result.get('success', False)
+        )
+    return result
+
+# Slow commands run here so they do not hold a request thread
+job_manager = JobManager(
+    lambda job, on_output, cancel: run_user_command(
+        job.command, job.description, job.session_id, job.diagnostic, on_output, cancel
+    )
+)
+# Kill running jobs' process trees instead of leaving them behind when the server exits
+atexit.register(job_manager.shutdown)
+
+def submit_job(command, description='', session_id=None, diagnostic=False):
+    """Queue a command on the job pool and answer 202 with its job id"""
+    try:
+        job = job_manager.submit(command, description, session_id, diagnostic)
+    except JobQueueFull as e:
+        return jsonify({'success': False, 'error': f'Too many commands are running: {str(e)}'}), 429
+    return jsonify({'job_id': job.id, 'status': job.status}), 202
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -75,7 +133,21 @@ def chat_endpoint():
         session_id = data.get('session_id', None)
         os_type = data.get('os_type', os_detector.detect_os())
         
-        result = chat_handler.process_message(user_message, os_type, session_id)
+        if data.get('stream'):
+            # Newline-delimited JSON: one bot_response_chunk per token batch, then the final bot_response
+            def generate():
+                for event in chat_handler.process_message_stream(user_message, os_type, session_id):
+                    if event['type'] == 'chunk':
+                        yield json.dumps({'event': 'bot_response_chunk', 'content': event['content']}) + '\n'
+                    else:
+                        yield json.dumps({'event': 'bot_response', 'message': event['message']}) + '\n'
+            
+            return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+        
+        if Config.ASYNC_PIPELINE:
+            result = async_runner.run(chat_handler.aprocess_message(user_message, os_type, session_id))
+        else:
+            result = chat_handler.process_message(user_message, os_type, session_id)
         return jsonify(result)
     except Exception as e:
         logger.error(f"Error in chat endpoint: {str(e)}")
@@ -95,6 +167,9 @@ def execute_system_command():
         if password and os_detector.is_macos():
             system_commands.set_sudo_password(password)
         
+        if data.get('async'):
+            return submit_job(command)
+        
         # Check if command requires sudo on macOS
         require_sudo = system_commands._requires_sudo(command) if os_detector.is_macos() else False
         
@@ -154,6 +229,55 @@ def get_cache_stats():
         logger.error(f"Error getting cache stats: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/response-cache/stats')
+def get_response_cache_stats():
+    """Get answer cache statistics"""
+    try:
+        if chat_handler.response_cache is None:
+            return jsonify({'enabled': False})
+        stats = chat_handler.response_cache.get_stats()
+        stats['enabled'] = True
+        return jsonify(stats)
+    except Exception as e:
+        logger.error(f"Error getting response cache stats: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/response-cache/clear', methods=['POST'])
+def clear_response_cache():
+    """Clear the answer cache"""
+    try:
+        if chat_handler.response_cache is not None:
+            chat_handler.response_cache.clear()
+        return jsonify({'success': True, 'message': 'Response cache cleared successfully'})
+    except Exception as e:
+        logger.error(f"Error clearing response cache: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/prompts/stats')
+def get_prompt_stats():
+    """Get token counts for each precomputed system prompt variant"""
+    try:
+        return jsonify(chat_handler.prompt_library.get_stats())
+    except Exception as e:
+        logger.error(f"Error getting prompt stats: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/llm/stats')
+def get_llm_stats():
+    """Get OpenAI client and circuit breaker statistics"""
+    try:
+        stats = chat_handler.llm_client.get_stats()
+        stats['async_pipeline'] = Config.ASYNC_PIPELINE
+        stats['event_loop'] = async_runner.get_stats()
+        stats['coalescing'] = chat_handler.get_inflight_stats()
+        stats['output_reducers'] = chat_handler.output_reducer.get_stats()
+        stats['verdict_engine'] = chat_handler.verdict_engine.get_stats()
+        stats['routing'] = chat_handler.model_router.get_stats()
+        return jsonify(stats)
+    except Exception as e:
+        logger.error(f"Error getting LLM stats: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/session/create', methods=['POST'])
 def create_session():
     """Create a new chat session"""
@@ -197,6 +321,8 @@ def get_session_stats():
     """Get session statistics"""
     try:
         stats = chat_handler.chat_database.get_session_stats()
+        stats['connection_pool'] = chat_handler.chat_database.get_pool_stats()
+        stats['write_behind'] = chat_handler.chat_database.get_writer_stats()
         return jsonify(stats)
     except Exception as e:
         logger.error(f"Error getting session stats: {str(e)}")
@@ -215,18 +341,33 @@ def network_test():
 def check_network_status():
     """Check internet connectivity status"""
     try:
-        internet_available = network_tools.check_internet_connectivity()
-        dns_working = network_tools.check_dns_resolution()
+        # Served from the background connectivity monitor, no probes on the request path
+        status = network_tools.get_connectivity_status()
+        internet_available = status['internet_available']
         
         return jsonify({
             'internet_available': internet_available,
-            'dns_working': dns_working,
-            'status': 'connected' if internet_available else 'disconnected'
+            'dns_working': status['dns_working'],
+            'status': 'connected' if internet_available else 'disconnected',
+            'checked_at': status['checked_at'],
+            'stale': status['stale']
         })
     except Exception as e:
         logger.error(f"Error checking network status: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/network/dns-benchmark')
+def benchmark_dns():
+    """Benchmark the system and public DNS resolvers and recommend the fastest healthy one"""
+    try:
+        results = network_tools.benchmark_dns()
+        if 'error' in results:
+            return jsonify(results), 500
+        return jsonify(results)
+    except Exception as e:
+        logger.error(f"Error benchmarking DNS: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/network/fallback-commands')
 def get_network_fallback_commands():
     """Get fallback commands for network issues"""
@@ -278,6 +419,62 @@ def suggest_diagnostics():
         logger.error(f"Error suggesting diagnostics: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/diagnostics/bundle', methods=['POST'])
+def execute_diagnostic_bundle():
+    """Run the diagnostic playbook for an issue under one deadline
+    
+    Takes ``message`` (categorized like /api/diagnostics/suggest) or
+    ``category``. Independent checks run at once; checks an earlier result
+    rules out are skipped. With ``stream`` the response is newline-delimited
+    JSON: one diagnostic_result per step as it finishes or is skipped, then
+    bundle_complete. All executed results are stored in the session in a
+    single transaction.
+    """
+    try:
+        data = request.get_json()
+        session_id = data.get('session_id')
+        issue_category = data.get('category') or automated_diagnostics.categorize_user_issue(data.get('message', ''))
+        playbook = automated_diagnostics.get_playbook(issue_category)
+        
+        if not playbook.steps:
+            return jsonify({'error': 'No diagnostics available for this issue'}), 400
+        
+        def run_bundle():
+            results = []
+            for result in automated_diagnostics.iter_playbook(playbook):
+                results.append(result)
+                yield result
+            if session_id:
+                chat_handler.chat_database.store_command_executions(session_id, [
+                    dict(result, description=result['name']) for result in results if result['status'] != 'skipped'
+                ])
+        
+        def summary(results, started):
+            return {
+                'issue_category': issue_category,
+                'total': len(results),
+                'succeeded': sum(1 for result in results if result['success']),
+                'skipped': sum(1 for result in results if result['status'] == 'skipped'),
+                'elapsed': round(time.monotonic() - started, 3)
+            }
+        
+        started = time.monotonic()
+        if data.get('stream'):
+            def generate():
+                results = []
+                for result in run_bundle():
+                    results.append(result)
+                    yield json.dumps({'event': 'diagnostic_result', 'result': result}) + '\n'
+                yield json.dumps(dict(summary(results, started), event='bundle_complete')) + '\n'
+            
+            return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+        
+        results = list(run_bundle())
+        return jsonify(dict(summary(results, started), results=results))
+    except Exception as e:
+        logger.error(f"Error executing diagnostic bundle: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/diagnostics/execute', methods=['POST'])
 def execute_diagnostic():
     """Execute a diagnostic command with user permission"""
@@ -294,6 +491,9 @@ def execute_diagnostic():
         if password and os_detector.is_macos():
             system_commands.set_sudo_password(password)
         
+        if data.get('async'):
+            return submit_job(command_text, command_name, data.get('session_id'), diagnostic=True)
+        
         # Check if command requires sudo on macOS
         require_sudo = system_commands._requires_sudo(command_text) if os_detector.is_macos() else False
         
@@ -363,6 +563,9 @@ def execute_gpt_command():
         if password and os_detector.is_macos():
             system_commands.set_sudo_password(password)
         
+        if data.get('async'):
+            return submit_job(command, description, session_id)
+        
         # Check if command requires sudo on macOS
         require_sudo = system_commands._requires_sudo(command) if os_detector.is_macos() else False
         
@@ -390,6 +593,51 @@ def execute_gpt_command():
         logger.error(f"Error executing command: {str(e)}")
         return jsonify({'error': f'Error executing command: {str(e)}'}), 500
 
+@app.route('/api/jobs', methods=['POST'])
+def create_job():
+    """Queue a command to run in the background; poll /api/jobs/<job_id> for its result"""
+    try:
+        data = request.get_json()
+        command = data.get('command', '')
+        password = data.get('password', None)
+        
+        if not command:
+            return jsonify({'error': 'No command provided'}), 400
+        
+        # Set sudo password if provided for macOS
+        if password and os_detector.is_macos():
+            system_commands.set_sudo_password(password)
+        
+        return submit_job(command, data.get('description', ''), data.get('session_id'), bool(data.get('diagnostic')))
+    except Exception as e:
+        logger.error(f"Error submitting job: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/jobs/stats')
+def get_job_stats():
+    """Get background job counts and pool sizing"""
+    try:
+        return jsonify(job_manager.get_stats())
+    except Exception as e:
+        logger.error(f"Error getting job stats: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/jobs/<job_id>')
+def get_job(job_id):
+    """Get a job's status, recent output, resource usage and, once finished, its result"""
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """Cancel a queued job or kill a running one"""
+    job = job_manager.cancel(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify({'job_id': job.id, 'status': job.status})
+
 @app.route('/api/command/analyze', methods=['POST'])
 def analyze_command_result():
     data = request.get_json()
@@ -401,37 +649,21 @@ def analyze_command_result():
     user_message = data.get('user_message', '')
     previous_bot_response = data.get('previous_bot_response', '')
 
-    # Compose context for GPT-4o
-    context = [
-        {"role": "user", "content": user_message or "The user asked for help."},
-        {"role": "assistant", "content": previous_bot_response or "The assistant provided a diagnosis and suggested a command."},
-        {"role": "user", "content": f"I ran the command `{command}`. Here is the result:\nOutput:\n{output or '(no output)'}\nError:\n{error or 'None'}"}
-    ]
-    prompt = (
-        "Given the user's issue, your previous diagnosis, and the command result, "
-        "analyze the result and provide actionable insights or next steps. "
-        "If the issue is resolved, say so. If not, suggest what to try next."
-    )
-    context.insert(0, {"role": "system", "content": prompt})
-
-    # Call GPT-4o
+    # Call GPT-4o through the shared client (pooled connections, deadline, retries, breaker)
     try:
-        import openai
-        client=openai.OpenAI(api_key=Config.OPENAI_API_KEY)
-        response = client.chat.completions.create(
-            model=Config.OPENAI_MODEL,
-            messages=context,
-            max_tokens=Config.OPENAI_MAX_TOKENS,
-            temperature=Config.OPENAI_TEMPERATURE
-        )
-        bot_followup = response.choices[0].message.content
-        # Optionally store this in the session history
-        chat_handler.chat_database.store_message(
-            session_id, f"Command result for {command}", bot_followup, "system", "gpt_analysis"
-        )
-        return jsonify({"response": bot_followup})
+        if Config.ASYNC_PIPELINE:
+            result = async_runner.run(chat_handler.aanalyze_command_result(
+                session_id, command, output, error, user_message, previous_bot_response
+            ))
+        else:
+            result = chat_handler.analyze_command_result(
+                session_id, command, output, error, user_message, previous_bot_response
+            )
+        return jsonify(result)
+    except CircuitOpenError as e:
+        logger.warning(f"Skipping command analysis: {str(e)}")
+        return jsonify({"response": "The AI service is temporarily unavailable. Please review the command output above and try the analysis again in a minute."}), 503
     except Exception as e:
-        import logging
         logging.exception("Error in /api/command/analyze")
         return jsonify({"response": "Sorry, I could not analyze the command result."}), 500
 
@@ -508,6 +740,36 @@ def handle_message(data):
             return
         
         os_type = os_detector.detect_os()
+        
+        if data.get('stream'):
+            for event in chat_handler.process_message_stream(user_message, os_type, session_id):
+                if event['type'] == 'chunk':
+                    emit('bot_response_chunk', {'content': event['content']})
+                else:
+                    emit('bot_response', {
+                        'message': event['message'],
+                        'timestamp': '2024-01-01T00:00:00Z'
+                    })
+            return
+        
+        if Config.ASYNC_PIPELINE:
+            # Hand the turn to the event loop and free this thread; reply when it completes
+            sid = request.sid
+            future = async_runner.submit(chat_handler.aprocess_message(user_message, os_type, session_id))
+            
+            def deliver(done):
+                try:
+                    socketio.emit('bot_response', {
+                        'message': done.result(),
+                        'timestamp': '2024-01-01T00:00:00Z'
+                    }, to=sid)
+                except Exception as e:
+                    logger.error(f"Error handling message: {str(e)}")
+                    socketio.emit('error', {'error': str(e)}, to=sid)
+            
+            future.add_done_callback(deliver)
+            return
+        
         response = chat_handler.process_message(user_message, os_type, session_id)
         
         emit('bot_response', {
@@ -518,5 +780,65 @@ def handle_message(data):
         logger.error(f"Error handling message: {str(e)}")
         emit('error', {'error': str(e)})
 
+@socketio.on('execute_command_stream')
+def handle_command_stream(data):
+    """Run a command and push its output to this client in line batches as it arrives
+    
+    Emits ``command_started``, then ``command_output`` events carrying
+    ``{'execution_id', 'lines': [{'stream', 'line'}, ...]}``, then one
+    ``command_finished`` event with the same fields /api/command/execute returns.
+    """
+    command = (data or {}).get('command', '')
+    if not command:
+        emit('command_finished', {'execution_id': (data or {}).get('execution_id'), 'success': False, 'error': 'No command provided'})
+        return
+    
+    execution_id = data.get('execution_id') or str(uuid.uuid4())
+    password = data.get('password', None)
+    if password and os_detector.is_macos():
+        system_commands.set_sudo_password(password)
+    
+    socketio.start_background_task(
+        stream_command, request.sid, execution_id, command,
+        data.get('description', ''), data.get('session_id'), bool(data.get('diagnostic'))
+    )
+    return {'execution_id': execution_id}
+
+@socketio.on('cancel_command')
+def handle_cancel_command(data):
+    """Stop a streaming command and every process it started"""
+    cancel = running_commands.get((data or {}).get('execution_id'))
+    if cancel is None:
+        return {'cancelled': False}
+    cancel.set()
+    return {'cancelled': True}
+
+def stream_command(sid, execution_id, command, description, session_id, diagnostic=False):
+    """Background task behind execute_command_stream"""
+    def on_output(lines):
+        socketio.emit('command_output', {'execution_id': execution_id, 'lines': lines}, to=sid)
+    
+    cancel = running_commands.setdefault(execution_id, threading.Event())
+    try:
+        socketio.emit('command_started', {'execution_id': execution_id, 'command': command}, to=sid)
+        result = run_user_command(command, description, session_id, diagnostic, on_output, cancel)
+        
+        socketio.emit('command_finished', {
+            'execution_id': execution_id,
+            'success': result.get('success', False),
+            'output': result.get('output', ''),
+            'error': result.get('error', ''),
+            'command': command,
+            'description': description,
+            'requires_password': result.get('requires_password', False)
+        }, to=sid)
+    except Exception as e:
+        logger.error(f"Error streaming command: {str(e)}")
+        socketio.emit('command_finished', {
+            'execution_id': execution_id, 'success': False, 'error': f'Error executing command: {str(e)}'
+        }, to=sid)
+    finally:
+        running_commands.pop(execution_id, None)
+
 if __name__ == '__main__':
     socketio.run(app, debug=True, host='0.0.0.0', port=5000) 
\ No newline at end of file
@@ -16,13 +16,55 @@ class Config:
     OPENAI_MODEL = 'gpt-4o'
     OPENAI_MAX_TOKENS = 1000
     OPENAI_TEMPERATURE = 0.7
+    OPENAI_TIMEOUT = 30  # seconds per call, shared across retries
+    OPENAI_CONNECT_TIMEOUT = 5  # seconds
+    OPENAI_MAX_RETRIES = 2
+    OPENAI_RETRY_BASE_DELAY = 0.5  # seconds, doubled per retry with full jitter
+    OPENAI_RETRY_MAX_DELAY = 8  # seconds
+    OPENAI_MAX_CONNECTIONS = 20  # pooled HTTP connections
+    OPENAI_MAX_KEEPALIVE_CONNECTIONS = 10
+    OPENAI_KEEPALIVE_EXPIRY = 30  # seconds an idle connection is kept open
+    CIRCUIT_FAILURE_THRESHOLD = 5  # consecutive failures before failing fast
+    CIRCUIT_RECOVERY_TIMEOUT = 30  # seconds before a trial call is allowed
+    
+    # Model routing settings
+    MODEL_ROUTING_ENABLED = os.environ.get('MODEL_ROUTING_ENABLED', 'False').lower() == 'true'
+    OPENAI_SMALL_MODEL = os.environ.get('OPENAI_SMALL_MODEL', 'gpt-4o-mini')
+    MODEL_TIERS = {'small': OPENAI_SMALL_MODEL, 'large': OPENAI_MODEL}  # tier name -> model
+    ROUTING_SMALL_MAX_CHARS = 160  # longer messages always go to the large tier
+    ROUTING_SMALL_MAX_HISTORY = 6  # earlier user turns beyond which follow-ups go to the large tier
     
     # Database settings
     DATABASE_PATH = 'chat.db'
+    DATABASE_POOL_SIZE = 8  # pooled SQLite connections
+    DATABASE_BUSY_TIMEOUT = 5000  # milliseconds to wait on a locked database
+    DATABASE_STATEMENT_CACHE = 128  # prepared statements cached per connection
+    DATABASE_CACHE_SIZE_KB = 8192  # page cache per connection
+    DATABASE_MMAP_SIZE = 64 * 1024 * 1024  # bytes of the database file to memory-map
+    DATABASE_WRITE_BEHIND = os.environ.get('DATABASE_WRITE_BEHIND', 'False').lower() == 'true'
+    DATABASE_WRITE_QUEUE_SIZE = 1000  # queued writes before callers write synchronously
+    DATABASE_WRITE_BATCH_SIZE = 100  # writes group-committed per transaction
+    DATABASE_WRITE_FLUSH_INTERVAL = 0.05  # seconds the writer lingers to fill a batch
+    DATABASE_DEADLINE_CHECK_STEPS = 1000  # SQLite VM steps between request deadline checks
     
     # Security settings
     COMMAND_TIMEOUT = 30  # seconds
-    MAX_COMMAND_OUTPUT = 10000  # characters
+    MAX_COMMAND_OUTPUT = 10000  # bytes of each output stream kept, split between head and tail
+    NATIVE_COMMANDS_ENABLED = True  # answer df, free, ps, netstat, ip addr, ... in-process instead of spawning a shell
+    COMMAND_STREAM_BATCH_LINES = 20  # lines per streamed output event
+    COMMAND_STREAM_BATCH_INTERVAL = 0.1  # seconds before a partial batch of lines is sent
+    COMMAND_OUTPUT_HEAD_BYTES = MAX_COMMAND_OUTPUT * 4 // 5  # first bytes of each output stream kept (and streamed)
+    COMMAND_OUTPUT_TAIL_BYTES = MAX_COMMAND_OUTPUT // 5  # last bytes of each output stream kept
+    COMMAND_OUTPUT_MAX_BYTES = 10 * 1024 * 1024  # output after which the command is stopped
+    COMMAND_READ_CHUNK_SIZE = 64 * 1024  # bytes read from a pipe at a time
+    COMMAND_READ_QUEUE_CHUNKS = 16  # chunks buffered between the pipe readers and the consumer
+    JOB_WORKERS = 4  # background commands run at once; further jobs wait in the queue
+    JOB_MAX_PENDING = 32  # queued jobs before new submissions are refused
+    JOB_RETENTION = 600  # seconds a finished job's result stays available for polling
+    JOB_OUTPUT_LINES = 200  # most recent output lines kept per job for status polling
+    OUTPUT_REDUCERS_ENABLED = True  # send parsed facts instead of raw output to /api/command/analyze
+    VERDICT_ENGINE_ENABLED = True  # answer clear-cut command results without calling GPT-4o
+    VERDICT_MIN_CONFIDENCE = 0.9  # rules below this confidence defer to GPT-4o
     
     # Quick tool optimizations
     QUICK_COMMAND_TIMEOUT = 10  # seconds for fast commands
@@ -30,9 +72,39 @@ class Config:
     SLOW_COMMAND_TIMEOUT = 30  # seconds for slow commands
     CACHE_TIMEOUT = 30  # seconds for command caching
     
+    # Command cache settings
+    COMMAND_CACHE_MAX_ENTRIES = 256
+    COMMAND_CACHE_MAX_BYTES = 5 * 1024 * 1024  # 5 MB
+    CACHE_SWEEP_INTERVAL = 60  # seconds between expired-entry sweeps
+    SPECULATIVE_DIAGNOSTICS = os.environ.get('SPECULATIVE_DIAGNOSTICS', 'False').lower() == 'true'
+    PREFETCH_WORKERS = 4  # background threads running speculative low-risk diagnostics
+    DIAGNOSTIC_BUNDLE_WORKERS = 4  # diagnostics of one bundle run at once
+    DIAGNOSTIC_BUNDLE_DEADLINE = 30  # seconds for a whole diagnostic bundle, not per command
+    PREFETCH_TTL = 120  # seconds a prefetched result waits for the user to click "Run"
+    COMMAND_CACHE_TTLS = {  # per-command TTLs in seconds, matched by prefix
+        'ping': 15,
+        'nslookup': 60,
+        'ipconfig': 30,
+        'ifconfig': 30,
+        'df': 60,
+        'echo': 300,
+        'uname': 3600,
+        'hostname': 3600,
+        'whoami': 3600,
+        'sw_vers': 3600
+    }
+    
     # WebSocket settings
     SOCKETIO_ASYNC_MODE = 'threading'
     
+    # Asyncio pipeline settings
+    ASYNC_PIPELINE = os.environ.get('ASYNC_PIPELINE', 'False').lower() == 'true'
+    LLM_MAX_CONCURRENCY = 50  # concurrent upstream OpenAI calls on the async path
+    ASYNC_BLOCKING_WORKERS = 16  # threads for DB and other blocking work on the async path
+    INFLIGHT_WAIT_TIMEOUT = 90  # seconds a duplicate request waits on the identical in-flight one
+    REQUEST_DEADLINE = 45  # seconds for a whole chat turn, shared by DB, network and OpenAI stages
+    PIPELINE_STAGE_WORKERS = 32  # threads running the concurrent pre-LLM stages
+    
     # Logging settings
     LOG_LEVEL = 'INFO'
     LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
@@ -40,11 +112,45 @@ class Config:
     # Network test settings
     PING_TIMEOUT = 5  # seconds
     DNS_TIMEOUT = 3  # seconds
+    PROBE_TIMEOUT = 2  # seconds each in-process probe waits for an answer
+    PROBE_COUNT = 3  # probes sent per target, all in flight at once
+    PROBE_INTERVAL = 0.05  # seconds between the probes to one target
+    PROBE_TCP_PORT = 443  # port for TCP connect probes and the ICMP fallback
+    PROBE_ICMP_ENABLED = True  # use ICMP echo where the process may open an ICMP socket
+    DNS_PROBE_TIMEOUT = 1.5  # seconds each raw DNS query waits for an answer
+    DNS_PROBE_ATTEMPTS = 2  # queries per name per resolver in a benchmark
+    DNS_PROBE_NAMES = ('google.com', 'cloudflare.com', 'wikipedia.org')  # names every resolver must answer
+    DNS_PUBLIC_RESOLVERS = {  # well-known resolvers benchmarked alongside the system's own
+        '1.1.1.1': 'Cloudflare',
+        '8.8.8.8': 'Google',
+        '9.9.9.9': 'Quad9'
+    }
+    DNS_SWITCH_MIN_GAIN_MS = 10  # average latency a resolver must save before switching is recommended
+    
+    # Connectivity monitor settings
+    CONNECTIVITY_TTL = 30  # seconds before a cached verdict is considered stale
+    CONNECTIVITY_POLL_INTERVAL = 15  # seconds between background probes
+    INTERFACE_POLL_INTERVAL = 2  # seconds between network interface change checks
     
     # Chat settings
     MAX_MESSAGE_LENGTH = 1000
     SESSION_TIMEOUT = 3600  # 1 hour
     
+    # Conversation context settings
+    CONTEXT_TOKEN_BUDGET = 3000  # tokens of history (summary + recent turns) sent per call
+    CONTEXT_SUMMARY_TOKEN_BUDGET = 500  # cap on the rolling summary of older turns
+    CONTEXT_MAX_TURN_TOKENS = 600  # longer messages are truncated in the prompt
+    CONTEXT_HISTORY_WINDOW = 50  # most recent unsummarized turns read per call
+    MAX_GENERIC_PROMPTS = 16  # all-OS prompts cached for unrecognised OS names
+    
+    # Response cache settings (first turn of a session only)
+    RESPONSE_CACHE_ENABLED = os.environ.get('RESPONSE_CACHE_ENABLED', 'False').lower() == 'true'
+    RESPONSE_CACHE_TTL = 3600  # seconds a cached answer is reused
+    RESPONSE_CACHE_MAX_ENTRIES = 512
+    RESPONSE_CACHE_SIMILARITY = 0.8  # minimum shingle Jaccard similarity for a near-duplicate hit
+    RESPONSE_CACHE_NUM_PERM = 64  # MinHash signature length
+    RESPONSE_CACHE_BANDS = 16  # LSH bands (NUM_PERM must be a multiple)
+    
     # Approved commands by OS
     WINDOWS_COMMANDS = [
         # Network commands
@@ -0,0 +1,93 @@
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+class AsyncRunner:
+    """Runs a single asyncio event loop on a background thread
+    
+    Flask and Socket.IO handlers are synchronous. They hand coroutines to this
+    loop with ``submit`` (fire and forget, result delivered via a callback) or
+    ``run`` (block until done), so in-flight LLM calls are parked on the loop
+    instead of each pinning an OS thread. Blocking work inside coroutines goes
+    through ``asyncio.to_thread`` on a bounded executor.
+    """
+    
+    def __init__(self, max_blocking_workers=None):
+        self.max_blocking_workers = max_blocking_workers or Config.ASYNC_BLOCKING_WORKERS
+        self.loop = None
+        self._thread = None
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+        self.submitted = 0
+    
+    def start(self):
+        """Start the event loop thread if it is not already running"""
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._ready.clear()
+            self._thread = threading.Thread(target=self._run_loop, name='async-pipeline', daemon=True)
+            self._thread.start()
+        self._ready.wait()
+    
+    def submit(self, coroutine):
+        """Schedule a coroutine on the loop and return a concurrent.futures.Future"""
+        self.start()
+        self.submitted += 1
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+    
+    def run(self, coroutine, timeout=None):
+        """Run a coroutine on the loop and block the calling thread for its result"""
+        return self.submit(coroutine).result(timeout)
+    
+    def stop(self):
+        """Stop the event loop thread"""
+        if self.loop and self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        if self._thread:
+            self._thread.join(timeout=5)
+    
+    def get_stats(self):
+        """Get event loop statistics"""
+        tasks = 0
+        if self.loop and self.loop.is_running():
+            try:
+                tasks = len(asyncio.all_tasks(self.loop))
+            except RuntimeError:
+                # The task set changed while being read from this thread
+                tasks = None
+        return {
+            'running': bool(self._thread and self._thread.is_alive()),
+            'submitted': self.submitted,
+            'pending_tasks': tasks,
+            'max_blocking_workers': self.max_blocking_workers
+        }
+    
+    def _run_loop(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        # Bound the threads asyncio.to_thread may use for DB and other blocking work
+        self.loop.set_default_executor(ThreadPoolExecutor(
+            max_workers=self.max_blocking_workers, thread_name_prefix='async-blocking'
+        ))
+        self._ready.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+
+_async_runner = None
+_async_runner_lock = threading.Lock()
+
+def get_async_runner():
+    """Get the process-wide asyncio runner"""
+    global _async_runner
+    if _async_runner is None:
+        with _async_runner_lock:
+            if _async_runner is None:
+                _async_runner = AsyncRunner()
+    return _async_runner
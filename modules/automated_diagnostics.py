@@ -1,8 +1,15 @@
-import subprocess
 import platform
 import logging
-from typing import Dict, List, Tuple, Optional
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Dict, Iterator, List, Tuple, Optional
 from dataclasses import dataclass
+from config import Config
+from modules.deadline import Deadline
+from modules.diagnostic_playbooks import Playbook, PlaybookEdge, PlaybookStep, has_ip_address, host_reachable, name_resolves
+from modules.output_reducers import parse_output
+from modules.process_runner import ProcessRunner
 
 logger = logging.getLogger(__name__)
 
@@ -22,6 +29,10 @@ class AutomatedDiagnostics:
     def __init__(self):
         self.os_type = platform.system().lower()
         self.diagnostic_commands = self._initialize_commands()
+        self.playbooks = self._initialize_playbooks()
+        self.process_runner = ProcessRunner()
+        self._bundle_executor = None
+        self._bundle_lock = threading.Lock()
     
     def _initialize_commands(self) -> Dict[str, List[DiagnosticCommand]]:
         """Initialize OS-specific diagnostic commands"""
@@ -212,6 +223,32 @@ class AutomatedDiagnostics:
         
         return commands
     
+    def _initialize_playbooks(self) -> Dict[str, Playbook]:
+        """Initialize playbooks for categories whose checks depend on each other"""
+        network = {cmd.name: cmd for cmd in self.diagnostic_commands['network']}
+        reachability = DiagnosticCommand(
+            name="Internet Reachability Test",
+            description="Ping a public IP address, bypassing DNS",
+            command="ping -n 2 8.8.8.8" if self.os_type == 'windows' else "ping -c 2 8.8.8.8",
+            category="network",
+            risk_level="low"
+        )
+        no_address = "No network interface has an IP address"
+        
+        # No address: nothing beyond this host can answer. DNS failing or the
+        # internet being unreachable by IP each make pinging a host name pointless.
+        return {
+            'network': Playbook('network', [
+                PlaybookStep('config', network['Network Configuration']),
+                PlaybookStep('reachability', reachability, [PlaybookEdge('config', has_ip_address, no_address)]),
+                PlaybookStep('dns', network['DNS Resolution Test'], [PlaybookEdge('config', has_ip_address, no_address)]),
+                PlaybookStep('connectivity', network['Network Connectivity Test'], [
+                    PlaybookEdge('dns', name_resolves, "DNS resolution failed"),
+                    PlaybookEdge('reachability', host_reachable, "The internet is unreachable by IP address")
+                ])
+            ])
+        }
+    
     def get_suggested_diagnostics(self, issue_category: str) -> List[DiagnosticCommand]:
         """Get suggested diagnostics based on issue category"""
         suggestions = []
@@ -237,26 +274,131 @@ class AutomatedDiagnostics:
         try:
             logger.info(f"Executing command: {command.command}")
             
-            # Execute the command
-            result = subprocess.run(
-                command.command,
-                shell=True,
-                capture_output=True,
-                text=True,
-                timeout=30  # 30 second timeout
-            )
+            # Output is captured head + tail in fixed memory; runaway commands are stopped
+            result = self.process_runner.run(command.command, 30)
+            if result['success']:
+                return True, result['output']
+            return False, result['error'] or "Command failed with no error output"
             
-            if result.returncode == 0:
-                return True, result.stdout
-            else:
-                return False, result.stderr or "Command failed with no error output"
-                
-        except subprocess.TimeoutExpired:
-            return False, "Command timed out after 30 seconds"
         except Exception as e:
             logger.error(f"Error executing command {command.command}: {str(e)}")
             return False, f"Error executing command: {str(e)}"
     
+    def execute_command_stream(self, command: DiagnosticCommand, on_output, cancel=None) -> Tuple[bool, str]:
+        """Execute a diagnostic command, passing output line batches to on_output as they arrive"""
+        try:
+            logger.info(f"Streaming command: {command.command}")
+            result = self.process_runner.run(command.command, 30, on_output, cancel)
+            if result['success']:
+                return True, result['output']
+            return False, result['error'] or "Command failed with no error output"
+        except Exception as e:
+            logger.error(f"Error executing command {command.command}: {str(e)}")
+            return False, f"Error executing command: {str(e)}"
+    
+    def get_playbook(self, issue_category: str) -> Playbook:
+        """Get the playbook for an issue category; categories without one run their suggestions in parallel"""
+        return self.playbooks.get(issue_category) or Playbook.flat(issue_category, self.get_suggested_diagnostics(issue_category))
+    
+    def iter_playbook(self, playbook: Playbook, deadline: Deadline = None) -> Iterator[Dict]:
+        """Run a playbook, yielding each step's result as soon as it finishes or is skipped
+        
+        A step starts once every step it depends on has finished, so
+        independent branches run concurrently. A step whose edge predicate
+        rules it out is skipped without spawning anything, and so is every
+        step below it. All steps share one aggregate deadline
+        (DIAGNOSTIC_BUNDLE_DEADLINE by default): each may run only for the time
+        the playbook has left, and stragglers are killed when it expires.
+        """
+        deadline = deadline or Deadline(Config.DIAGNOSTIC_BUNDLE_DEADLINE)
+        cancel = threading.Event()
+        executor = self._get_bundle_executor()
+        results = {}
+        waiting = list(playbook.steps)
+        running = {}
+        try:
+            while waiting or running:
+                ready = [step for step in waiting if all(edge.upstream in results for edge in step.edges)]
+                for step in ready:
+                    waiting.remove(step)
+                    reason = playbook.skip_reason(step, results)
+                    if reason is None:
+                        running[executor.submit(self._run_bundle_command, step.command, deadline, cancel)] = step
+                        continue
+                    results[step.id] = self._step_result(step, self._bundle_result(step.command, False, '', None, 0.0), reason)
+                    yield results[step.id]
+                if ready or not running:
+                    # A skip can make further steps ready without waiting on anything
+                    continue
+                
+                # A short grace lets commands killed at the deadline report back
+                done, _ = wait(running, timeout=deadline.remaining() + 1, return_when=FIRST_COMPLETED)
+                if not done:
+                    cancel.set()
+                for future in done:
+                    step = running.pop(future)
+                    results[step.id] = self._step_result(step, future.result())
+                    yield results[step.id]
+        finally:
+            # A consumer that stops early must not leave commands running
+            cancel.set()
+    
+    def iter_bundle(self, commands: List[DiagnosticCommand], deadline: Deadline = None) -> Iterator[Dict]:
+        """Run independent diagnostic commands concurrently, yielding each result as soon as it finishes"""
+        yield from self.iter_playbook(Playbook.flat('bundle', commands), deadline)
+    
+    def execute_bundle(self, commands: List[DiagnosticCommand], deadline: Deadline = None) -> List[Dict]:
+        """Run diagnostic commands concurrently; results are in completion order"""
+        return list(self.iter_bundle(commands, deadline))
+    
+    def _run_bundle_command(self, command: DiagnosticCommand, deadline: Deadline, cancel) -> Dict:
+        started = time.monotonic()
+        try:
+            if deadline.expired or cancel.is_set():
+                return self._bundle_result(command, False, '', f'Not started before the {deadline.seconds}s bundle deadline', 0.0)
+            logger.info(f"Executing bundled command: {command.command}")
+            result = self.process_runner.run(command.command, deadline.timeout(30), cancel=cancel)
+            error = None if result['success'] else (result['error'] or "Command failed with no error output")
+            return self._bundle_result(command, result['success'], result['output'], error, time.monotonic() - started)
+        except Exception as e:
+            logger.error(f"Error executing command {command.command}: {str(e)}")
+            return self._bundle_result(command, False, '', f"Error executing command: {str(e)}", time.monotonic() - started)
+    
+    @staticmethod
+    def _step_result(step: PlaybookStep, result: Dict, skipped_reason: str = None) -> Dict:
+        """Tag a command result with its playbook step, status and parsed facts"""
+        result['step'] = step.id
+        if skipped_reason:
+            result['status'] = 'skipped'
+            result['skipped_reason'] = skipped_reason
+            result['facts'] = None
+            return result
+        result['status'] = 'succeeded' if result['success'] else 'failed'
+        # Failing tools such as ping report on stderr; predicates see both streams
+        text = '\n'.join(part for part in (result['output'], result['error']) if part)
+        result['facts'] = parse_output(step.command.command, text)[1]
+        return result
+    
+    @staticmethod
+    def _bundle_result(command: DiagnosticCommand, success: bool, output: str, error: Optional[str], duration: float) -> Dict:
+        return {
+            'name': command.name,
+            'command': command.command,
+            'category': command.category,
+            'success': success,
+            'output': output,
+            'error': error,
+            'duration': round(duration, 3)
+        }
+    
+    def _get_bundle_executor(self):
+        with self._bundle_lock:
+            if self._bundle_executor is None:
+                self._bundle_executor = ThreadPoolExecutor(
+                    max_workers=Config.DIAGNOSTIC_BUNDLE_WORKERS, thread_name_prefix='diagnostic-bundle'
+                )
+            return self._bundle_executor
+    
     def format_diagnostic_suggestions(self, suggestions: List[DiagnosticCommand]) -> str:
         """Format diagnostic suggestions for display"""
         if not suggestions:
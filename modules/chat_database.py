@@ -1,24 +1,211 @@
-import sqlite3
 import logging
 import json
+import atexit
+import queue
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from typing import List, Dict, Optional
 from config import Config
+from modules.db_connection import SQLiteConnectionPool
 
 logger = logging.getLogger(__name__)
 
+class WriteBehindWriter:
+    """Queues database writes and group-commits them on a dedicated thread
+    
+    Writes are applied in submission order, many per transaction, so bursts of
+    chat turns share one fsync instead of paying one each. The queue is bounded;
+    when it is full the caller waits for room instead of growing memory. Once
+    the writer is stopped, writes are applied on the caller's thread.
+    Rows that are queued but not yet committed are tracked per session so reads
+    can merge them in (read-your-writes).
+    """
+    
+    def __init__(self, pool, max_queue_size=None, batch_size=None, flush_interval=None):
+        self.pool = pool
+        self.batch_size = batch_size or Config.DATABASE_WRITE_BATCH_SIZE
+        self.flush_interval = flush_interval or Config.DATABASE_WRITE_FLUSH_INTERVAL
+        self._queue = queue.Queue(maxsize=max_queue_size or Config.DATABASE_WRITE_QUEUE_SIZE)
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        # Reentrant so _drain can hold it across taking leftovers and committing them
+        self._commit_lock = threading.RLock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='db-write-behind', daemon=True)
+        self._thread.start()
+        atexit.register(self.shutdown)
+        
+        self.queued_writes = 0
+        self.committed_writes = 0
+        self.batches = 0
+        self.sync_fallbacks = 0
+        self.failed_writes = 0
+    
+    def submit(self, write, params, session_id=None, pending_row=None):
+        """Queue write(cursor, params); pending_row is visible to reads until committed"""
+        item = (write, params, session_id, pending_row)
+        if pending_row is not None:
+            with self._pending_lock:
+                self._pending.setdefault(session_id, []).append(pending_row)
+        
+        while not self._stopped.is_set():
+            try:
+                # Wait for room: writing around a full queue would commit ahead of earlier writes
+                self._queue.put(item, timeout=0.5)
+            except queue.Full:
+                continue
+            self.queued_writes += 1
+            if self._stopped.is_set():
+                # Stopped while we were queueing; the writer thread may not take it
+                self._drain()
+            return
+        
+        # Writer stopped: apply the write on the caller's thread, after anything still queued
+        self.sync_fallbacks += 1
+        self._drain([item])
+    
+    def has_pending(self, session_id):
+        """Check if a session has queued rows that are not committed yet"""
+        with self._pending_lock:
+            return session_id in self._pending
+    
+    @contextmanager
+    def consistent_read(self):
+        """Hold off commits while a reader combines committed and pending rows"""
+        with self._commit_lock:
+            yield
+    
+    def get_pending(self, session_id):
+        """Get a snapshot of a session's queued rows in submission order"""
+        with self._pending_lock:
+            return list(self._pending.get(session_id, []))
+    
+    def flush(self, timeout=None):
+        """Block until every queued write has been committed"""
+        if timeout is None:
+            self._queue.join()
+            return True
+        deadline = time.time() + timeout
+        while self._queue.unfinished_tasks:
+            if time.time() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+    
+    def shutdown(self):
+        """Flush outstanding writes and stop the writer thread"""
+        if self._stopped.is_set():
+            return
+        atexit.unregister(self.shutdown)
+        self.flush(timeout=10)
+        self._stopped.set()
+        self._drain()
+    
+    def get_stats(self):
+        """Get write-behind statistics"""
+        return {
+            'queue_depth': self._queue.qsize(),
+            'queued_writes': self.queued_writes,
+            'committed_writes': self.committed_writes,
+            'batches': self.batches,
+            'average_batch_size': round(self.committed_writes / self.batches, 2) if self.batches else 0,
+            'sync_fallbacks': self.sync_fallbacks,
+            'failed_writes': self.failed_writes
+        }
+    
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                first = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            
+            batch = [first]
+            # Linger briefly so a burst lands in a single transaction
+            deadline = time.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.time()
+                try:
+                    batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            
+            try:
+                self._commit(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+    
+    def _drain(self, extra=()):
+        """Commit writes left in the queue, then extra, once the writer thread has stopped"""
+        self._thread.join()
+        with self._commit_lock:
+            batch = []
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if batch or extra:
+                self._commit(batch + list(extra))
+            for _ in batch:
+                self._queue.task_done()
+    
+    def _commit(self, batch):
+        with self._commit_lock:
+            try:
+                with self.pool.transaction() as conn:
+                    cursor = conn.cursor()
+                    for write, params, _, _ in batch:
+                        write(cursor, params)
+                self.committed_writes += len(batch)
+                self.batches += 1
+            except Exception as e:
+                logger.error(f"Error committing batch of {len(batch)} writes, retrying individually: {str(e)}")
+                for item in batch:
+                    try:
+                        with self.pool.transaction() as conn:
+                            item[0](conn.cursor(), item[1])
+                        self.committed_writes += 1
+                    except Exception as item_error:
+                        self.failed_writes += 1
+                        logger.error(f"Error committing queued write: {str(item_error)}")
+            finally:
+                self._clear_pending(batch)
+    
+    def _clear_pending(self, batch):
+        with self._pending_lock:
+            for _, _, session_id, pending_row in batch:
+                if pending_row is None:
+                    continue
+                rows = self._pending.get(session_id)
+                if rows:
+                    try:
+                        rows.remove(pending_row)
+                    except ValueError:
+                        pass
+                    if not rows:
+                        del self._pending[session_id]
+
 class ChatDatabase:
     """Handles conversation history storage and retrieval"""
     
-    def __init__(self, db_path: str = None):
+    def __init__(self, db_path: str = None, write_behind: bool = None):
         """Initialize the chat database"""
         self.db_path = db_path or Config.DATABASE_PATH
+        self.pool = SQLiteConnectionPool(self.db_path)
         self._init_database()
+        
+        if write_behind is None:
+            write_behind = Config.DATABASE_WRITE_BEHIND
+        self.writer = WriteBehindWriter(self.pool) if write_behind else None
     
     def _init_database(self):
         """Initialize the database with required tables"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.transaction() as conn:
                 cursor = conn.cursor()
                 
                 # Create conversation history table
@@ -78,7 +265,17 @@ class ChatDatabase:
                     ON chat_sessions(last_activity)
                 ''')
                 
-                conn.commit()
+                # Create rolling summaries table for long conversations
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS session_summaries (
+                        session_id TEXT PRIMARY KEY,
+                        summary TEXT NOT NULL,
+                        summarized_through INTEGER NOT NULL,
+                        summary_tokens INTEGER DEFAULT 0,
+                        updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                    )
+                ''')
+                
                 logger.info("Database initialized successfully")
                 
         except Exception as e:
@@ -88,67 +285,148 @@ class ChatDatabase:
                      os_type: str = None, intent_category: str = None, message_type: str = 'chat'):
         """Store a message exchange in the database"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
+            params = (session_id, user_message, bot_response, os_type, intent_category, message_type)
+            
+            if self.writer:
+                pending_row = {
+                    'user_message': user_message,
+                    'bot_response': bot_response,
+                    'timestamp': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
+                    'intent_category': intent_category,
+                    'id': None
+                }
+                self.writer.submit(self._write_message, params, session_id, pending_row)
+                return
+            
+            with self.pool.transaction() as conn:
+                self._write_message(conn.cursor(), params)
                 
-                # Insert the message exchange
-                cursor.execute('''
-                    INSERT INTO conversation_history 
-                    (session_id, user_message, bot_response, os_type, intent_category, message_type)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                ''', (session_id, user_message, bot_response, os_type, intent_category, message_type))
+        except Exception as e:
+            logger.error(f"Error storing message: {str(e)}")
+    
+    @staticmethod
+    def _write_message(cursor, params):
+        """Insert a message exchange and bump the session's activity"""
+        session_id, user_message, bot_response, os_type, intent_category, message_type = params
+        
+        # Insert the message exchange
+        cursor.execute('''
+            INSERT INTO conversation_history 
+            (session_id, user_message, bot_response, os_type, intent_category, message_type)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', params)
+        
+        # Update session activity
+        cursor.execute('''
+            INSERT OR REPLACE INTO chat_sessions 
+            (session_id, os_type, last_activity, message_count)
+            VALUES (?, ?, CURRENT_TIMESTAMP, 
+                COALESCE((SELECT message_count FROM chat_sessions WHERE session_id = ?), 0) + 1)
+        ''', (session_id, os_type, session_id))
+        
+        logger.debug(f"Stored message for session {session_id}")
+    
+    def get_conversation_history(self, session_id: str, limit: int = 15, after_id: int = None,
+                                 deadline=None) -> List[Dict]:
+        """Get recent conversation history for context, optionally only rows newer than after_id"""
+        try:
+            if self.writer and self.writer.has_pending(session_id):
+                # Read committed rows and queued rows as one consistent snapshot
+                with self.writer.consistent_read():
+                    history = self._read_history(session_id, limit, after_id, deadline)
+                    pending = self.writer.get_pending(session_id)
+                history = (history + pending)[-limit:] if limit else []
+            else:
+                history = self._read_history(session_id, limit, after_id, deadline)
+            
+            logger.debug(f"Retrieved {len(history)} messages for session {session_id}")
+            return history
                 
-                # Update session activity
+        except Exception as e:
+            logger.error(f"Error retrieving conversation history: {str(e)}")
+            return []
+    
+    def has_conversation_history(self, session_id: str, deadline=None) -> Optional[bool]:
+        """Check if the session has any earlier turns; None when the history could not be read"""
+        try:
+            if self.writer and self.writer.has_pending(session_id):
+                return True
+            return bool(self._read_history(session_id, 1, deadline=deadline))
+        except Exception as e:
+            logger.error(f"Error checking conversation history: {str(e)}")
+            return None
+    
+    def _read_history(self, session_id: str, limit: int, after_id: int = None, deadline=None) -> List[Dict]:
+        """Read committed conversation history in chronological order"""
+        with self.pool.connection(deadline) as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                SELECT user_message, bot_response, timestamp, intent_category, id
+                FROM conversation_history 
+                WHERE session_id = ? AND id > ?
+                ORDER BY timestamp DESC, id DESC 
+                LIMIT ?
+            ''', (session_id, after_id or 0, limit))
+            
+            rows = cursor.fetchall()
+            
+            # Convert to list of dictionaries and reverse to get chronological order
+            history = []
+            for row in reversed(rows):
+                history.append({
+                    'user_message': row[0],
+                    'bot_response': row[1],
+                    'timestamp': row[2],
+                    'intent_category': row[3],
+                    'id': row[4]
+                })
+            return history
+    
+    def get_session_summary(self, session_id: str, deadline=None) -> Optional[Dict]:
+        """Get the rolling summary of a session's older turns"""
+        try:
+            with self.pool.connection(deadline) as conn:
+                cursor = conn.cursor()
                 cursor.execute('''
-                    INSERT OR REPLACE INTO chat_sessions 
-                    (session_id, os_type, last_activity, message_count)
-                    VALUES (?, ?, CURRENT_TIMESTAMP, 
-                        COALESCE((SELECT message_count FROM chat_sessions WHERE session_id = ?), 0) + 1)
-                ''', (session_id, os_type, session_id))
+                    SELECT summary, summarized_through, summary_tokens, updated_at
+                    FROM session_summaries 
+                    WHERE session_id = ?
+                ''', (session_id,))
                 
-                conn.commit()
-                logger.debug(f"Stored message for session {session_id}")
+                row = cursor.fetchone()
+                if row:
+                    return {
+                        'summary': row[0],
+                        'summarized_through': row[1],
+                        'summary_tokens': row[2],
+                        'updated_at': row[3]
+                    }
+                return None
                 
         except Exception as e:
-            logger.error(f"Error storing message: {str(e)}")
+            logger.error(f"Error retrieving session summary: {str(e)}")
+            return None
     
-    def get_conversation_history(self, session_id: str, limit: int = 15) -> List[Dict]:
-        """Get recent conversation history for context"""
+    def store_session_summary(self, session_id: str, summary: str, summarized_through: int, summary_tokens: int = 0):
+        """Store the rolling summary of a session's older turns"""
+        # Written synchronously: the next turn must see the new watermark to avoid re-summarizing
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.transaction() as conn:
                 cursor = conn.cursor()
-                
                 cursor.execute('''
-                    SELECT user_message, bot_response, timestamp, intent_category
-                    FROM conversation_history 
-                    WHERE session_id = ? 
-                    ORDER BY timestamp DESC 
-                    LIMIT ?
-                ''', (session_id, limit))
-                
-                rows = cursor.fetchall()
-                
-                # Convert to list of dictionaries and reverse to get chronological order
-                history = []
-                for row in reversed(rows):
-                    history.append({
-                        'user_message': row[0],
-                        'bot_response': row[1],
-                        'timestamp': row[2],
-                        'intent_category': row[3]
-                    })
-                
-                logger.debug(f"Retrieved {len(history)} messages for session {session_id}")
-                return history
+                    INSERT OR REPLACE INTO session_summaries 
+                    (session_id, summary, summarized_through, summary_tokens, updated_at)
+                    VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+                ''', (session_id, summary, summarized_through, summary_tokens))
                 
         except Exception as e:
-            logger.error(f"Error retrieving conversation history: {str(e)}")
-            return []
+            logger.error(f"Error storing session summary: {str(e)}")
     
     def get_session_info(self, session_id: str) -> Optional[Dict]:
         """Get information about a specific session"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.connection() as conn:
                 cursor = conn.cursor()
                 
                 cursor.execute('''
@@ -172,30 +450,36 @@ class ChatDatabase:
             logger.error(f"Error retrieving session info: {str(e)}")
             return None
     
-    def create_session(self, session_id: str, os_type: str = None) -> bool:
+    def create_session(self, session_id: str, os_type: str = None, deadline=None) -> bool:
         """Create a new chat session"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
-                cursor.execute('''
-                    INSERT OR REPLACE INTO chat_sessions 
-                    (session_id, os_type, created_at, last_activity, message_count)
-                    VALUES (?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP, 0)
-                ''', (session_id, os_type))
-                
-                conn.commit()
-                logger.info(f"Created new session: {session_id}")
+            if self.writer:
+                self.writer.submit(self._write_session, (session_id, os_type))
+                return True
+            
+            with self.pool.transaction(deadline) as conn:
+                self._write_session(conn.cursor(), (session_id, os_type))
                 return True
                 
         except Exception as e:
             logger.error(f"Error creating session: {str(e)}")
             return False
     
+    @staticmethod
+    def _write_session(cursor, params):
+        """Insert or reset a chat session row"""
+        cursor.execute('''
+            INSERT OR REPLACE INTO chat_sessions 
+            (session_id, os_type, created_at, last_activity, message_count)
+            VALUES (?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP, 0)
+        ''', params)
+        
+        logger.info(f"Created new session: {params[0]}")
+    
     def cleanup_old_sessions(self, days: int = 30):
         """Clean up old sessions and messages"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.transaction() as conn:
                 cursor = conn.cursor()
                 
                 cutoff_date = datetime.now() - timedelta(days=days)
@@ -206,13 +490,20 @@ class ChatDatabase:
                     WHERE timestamp < ?
                 ''', (cutoff_date,))
                 
+                # Delete summaries of sessions that are about to expire
+                cursor.execute('''
+                    DELETE FROM session_summaries 
+                    WHERE session_id IN (
+                        SELECT session_id FROM chat_sessions WHERE last_activity < ?
+                    )
+                ''', (cutoff_date,))
+                
                 # Delete old sessions
                 cursor.execute('''
                     DELETE FROM chat_sessions 
                     WHERE last_activity < ?
                 ''', (cutoff_date,))
                 
-                conn.commit()
                 logger.info(f"Cleaned up sessions older than {days} days")
                 
         except Exception as e:
@@ -221,7 +512,7 @@ class ChatDatabase:
     def get_session_stats(self) -> Dict:
         """Get database statistics"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.connection() as conn:
                 cursor = conn.cursor()
                 
                 # Get total messages
@@ -252,21 +543,63 @@ class ChatDatabase:
     def store_command_execution(self, session_id, command, description, output, error, success):
         """Store command execution results in database"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute('''
-                    INSERT INTO command_executions 
-                    (session_id, command, description, output, error, success, timestamp)
-                    VALUES (?, ?, ?, ?, ?, ?, ?)
-                ''', (session_id, command, description, output, error, success, datetime.now()))
-                conn.commit()
+            params = (session_id, command, description, output, error, success, datetime.now())
+            
+            if self.writer:
+                self.writer.submit(self._write_command_execution, params)
+                return
+            
+            with self.pool.transaction() as conn:
+                self._write_command_execution(conn.cursor(), params)
         except Exception as e:
             logger.error(f"Error storing command execution: {str(e)}")
     
+    @staticmethod
+    def _write_command_execution(cursor, params):
+        """Insert a command execution row"""
+        cursor.execute('''
+            INSERT INTO command_executions 
+            (session_id, command, description, output, error, success, timestamp)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', params)
+    
+    def store_command_executions(self, session_id, executions):
+        """Store several command executions in one transaction
+        
+        ``executions`` are dicts with command, description, output, error and success.
+        """
+        try:
+            timestamp = datetime.now()
+            rows = [
+                (session_id, execution['command'], execution.get('description', ''),
+                 execution.get('output', ''), execution.get('error', ''), execution.get('success', False), timestamp)
+                for execution in executions
+            ]
+            if not rows:
+                return
+            
+            if self.writer:
+                self.writer.submit(self._write_command_executions, rows)
+                return
+            
+            with self.pool.transaction() as conn:
+                self._write_command_executions(conn.cursor(), rows)
+        except Exception as e:
+            logger.error(f"Error storing command executions: {str(e)}")
+    
+    @staticmethod
+    def _write_command_executions(cursor, rows):
+        """Insert several command execution rows"""
+        cursor.executemany('''
+            INSERT INTO command_executions 
+            (session_id, command, description, output, error, success, timestamp)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+    
     def get_command_executions(self, session_id, limit=10):
         """Get command executions for a session"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.connection() as conn:
                 cursor = conn.cursor()
                 cursor.execute('''
                     SELECT command, description, output, error, success, timestamp
@@ -278,4 +611,23 @@ class ChatDatabase:
                 return cursor.fetchall()
         except Exception as e:
             logger.error(f"Error getting command executions: {str(e)}")
-            return [] 
\ No newline at end of file
+            return []
+    
+    def get_pool_stats(self) -> Dict:
+        """Get connection pool statistics"""
+        return self.pool.get_stats()
+    
+    def get_writer_stats(self) -> Dict:
+        """Get write-behind queue statistics"""
+        return self.writer.get_stats() if self.writer else {'enabled': False}
+    
+    def flush(self):
+        """Wait until all queued writes are committed"""
+        if self.writer:
+            self.writer.flush()
+    
+    def close(self):
+        """Flush queued writes and close all pooled database connections"""
+        if self.writer:
+            self.writer.shutdown()
+        self.pool.close_all()
@@ -1,354 +1,798 @@
-import openai
+import asyncio
+import copy
+import hashlib
+import json
 import logging
+import re
+import threading
+import time
 import uuid
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from datetime import datetime
 from config import Config
 from modules.automated_diagnostics import AutomatedDiagnostics
 from modules.chat_database import ChatDatabase
+from modules.context_builder import ContextBuilder
+from modules.deadline import Deadline, DeadlineExceeded
+from modules.prompts import get_prompt_library
+from modules.llm_client import get_llm_client, CircuitOpenError
+from modules.model_router import ModelRouter, is_valid_reply
 from modules.network_tools import NetworkTools
+from modules.output_reducers import OutputReducer
+from modules.response_cache import ResponseCache
+from modules.system_commands import SystemCommands
+from modules.verdict_engine import VerdictEngine
 
 logger = logging.getLogger(__name__)
 
+class ResponseFieldStreamer:
+    """Incrementally extracts the ``response`` string from a streamed JSON reply
+    
+    GPT-4o streams the whole JSON object token by token. Only the decoded text of
+    the top-level ``response`` field is meant for the user, so this keeps just
+    enough state to emit that text as soon as it arrives.
+    """
+    
+    _KEY_PATTERN = re.compile(r'"response"\s*:\s*"')
+    _ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+    
+    def __init__(self):
+        self.buffer = ''
+        self.position = 0
+        self.started = False
+        self.finished = False
+    
+    def feed(self, delta):
+        """Add a raw chunk and return any newly decoded response text"""
+        if self.finished:
+            return ''
+        self.buffer += delta
+        
+        if not self.started:
+            match = self._KEY_PATTERN.search(self.buffer)
+            if not match:
+                return ''
+            self.started = True
+            self.position = match.end()
+        
+        decoded = []
+        while self.position < len(self.buffer):
+            char = self.buffer[self.position]
+            if char == '"':
+                self.finished = True
+                break
+            if char != '\\':
+                decoded.append(char)
+                self.position += 1
+                continue
+            
+            # Escape sequences may be split across chunks; wait for the rest
+            if self.position + 1 >= len(self.buffer):
+                break
+            escape = self.buffer[self.position + 1]
+            if escape == 'u':
+                hex_digits = self.buffer[self.position + 2:self.position + 6]
+                if len(hex_digits) < 4:
+                    break
+                try:
+                    code_point = int(hex_digits, 16)
+                except ValueError:
+                    code_point = None
+                if code_point is not None and 0xD800 <= code_point <= 0xDBFF:
+                    # Emoji arrive as surrogate pairs; combine them before emitting
+                    low = self.buffer[self.position + 6:self.position + 12]
+                    if len(low) < 6:
+                        break
+                    if low.startswith('\\u'):
+                        try:
+                            low_point = int(low[2:], 16)
+                        except ValueError:
+                            low_point = None
+                        if low_point is not None and 0xDC00 <= low_point <= 0xDFFF:
+                            decoded.append(chr(0x10000 + ((code_point - 0xD800) << 10) + (low_point - 0xDC00)))
+                            self.position += 12
+                            continue
+                if code_point is not None:
+                    decoded.append(chr(code_point))
+                self.position += 6
+            else:
+                decoded.append(self._ESCAPES.get(escape, escape))
+                self.position += 2
+        
+        return ''.join(decoded)
+
 class ChatHandler:
     """Handles GPT-4o integration for intelligent IT support"""
     
-    def __init__(self):
+    def __init__(self, system_commands=None):
         """Initialize the chat handler with OpenAI configuration"""
-        try:
-            self.client = openai.OpenAI(api_key=Config.OPENAI_API_KEY)
-            self.chat_database = ChatDatabase()
-            self.automated_diagnostics = AutomatedDiagnostics()
-            self.network_tools = NetworkTools()
-        except Exception as e:
-            logger.error(f"Error initializing OpenAI client: {str(e)}")
-            self.client = None
-            self.chat_database = ChatDatabase()
-            self.automated_diagnostics = AutomatedDiagnostics()
-            self.network_tools = NetworkTools()
+        # Shared client: pooled connections, deadlines, retries and circuit breaker
+        self.llm_client = get_llm_client()
+        self.chat_database = ChatDatabase()
+        self.automated_diagnostics = AutomatedDiagnostics()
+        self.network_tools = NetworkTools()
+        # Shared with the command endpoints so prefetched diagnostics land in their cache
+        self.system_commands = system_commands or SystemCommands()
+        self.output_reducer = OutputReducer()
+        self.verdict_engine = VerdictEngine()
+        # Sends simple turns to a cheaper model tier and hard ones to GPT-4o
+        self.model_router = ModelRouter()
+        self.context_builder = ContextBuilder(self.chat_database)
+        self.prompt_library = get_prompt_library()
+        # Opt-in answer cache for repeated first-turn questions
+        self.response_cache = ResponseCache() if Config.RESPONSE_CACHE_ENABLED else None
+        # In-flight registry: identical concurrent requests share one GPT-4o call
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+        self.leader_requests = 0
+        self.coalesced_requests = 0
+        self.coalesce_fallbacks = 0
+        # Runs the independent pre-LLM stages of a request side by side
+        self.stage_executor = ThreadPoolExecutor(
+            max_workers=Config.PIPELINE_STAGE_WORKERS, thread_name_prefix='chat-stage'
+        )
     
     def process_message(self, user_message, os_type, session_id=None):
         """Process user message with GPT-4o for dynamic analysis and command generation"""
+        if not session_id:
+            session_id = str(uuid.uuid4())
+        
+        key, future, leader = self._join_inflight(session_id, user_message, os_type)
+        if not leader:
+            result = self._await_inflight(future)
+            if result is not None:
+                return result
+            return self._process_message(user_message, os_type, session_id)
+        
+        result = None
+        try:
+            result = self._process_message(user_message, os_type, session_id)
+            return result
+        finally:
+            self._settle_inflight(key, future, result)
+    
+    def _process_message(self, user_message, os_type, session_id=None):
         try:
             # Generate session ID if not provided
             if not session_id:
                 session_id = str(uuid.uuid4())
             
-            # Create or update session
-            self.chat_database.create_session(session_id, os_type)
+            # One deadline for the whole request, shared by every stage below
+            deadline = Deadline(Config.REQUEST_DEADLINE)
+            
+            # Session write, cache eligibility, connectivity, prompt and history run concurrently
+            turn = self._prepare_turn(session_id, user_message, os_type, deadline)
             
-            # Check internet connectivity first
-            internet_available = self.network_tools.check_internet_connectivity()
+            # Common first questions are answered from the cache without calling GPT-4o
+            first_turn = turn['first_turn']
+            if first_turn:
+                cached = self._answer_from_cache(session_id, user_message, os_type)
+                if cached is not None:
+                    return cached
             
             # Check if OpenAI client is available and internet is working
-            if self.client is None or not internet_available:
+            internet_available = turn['connectivity']
+            if not self.llm_client.available or not internet_available:
                 logger.warning("OpenAI client not available or no internet connection, using fallback response")
-                fallback_response = self._get_fallback_response(user_message, os_type, internet_available)
+                return self._store_fallback(session_id, user_message, os_type, 'fallback', internet_available)
+            
+            # Build the system prompt, conversation history and current message
+            messages = self._build_messages(turn['system_prompt'], turn['conversation'], user_message)
+            
+            # Call OpenAI API within what is left of the request deadline
+            deadline.check('the GPT-4o call')
+            self._prefetch_diagnostics(user_message)
+            decision = self._route_turn(user_message, turn['conversation'])
+            bot_response_text = self._complete_turn(decision, messages, deadline)
+            return self._finalize_response(session_id, user_message, os_type, bot_response_text, first_turn)
+            
+        except CircuitOpenError as e:
+            logger.warning(f"Skipping GPT-4o call: {str(e)}")
+            return self._store_fallback(session_id, user_message, os_type, 'fallback', True)
+        except DeadlineExceeded as e:
+            logger.warning(f"Request deadline exceeded: {str(e)}")
+            return self._store_fallback(session_id, user_message, os_type, 'timeout', True)
+        except Exception as e:
+            logger.error(f"Error processing message with GPT-4o: {str(e)}")
+            fallback_response = self._get_fallback_response(user_message, os_type, False)
+            if session_id:
                 self.chat_database.store_message(
                     session_id, user_message, fallback_response, 
-                    os_type, 'fallback'
+                    os_type, 'error'
                 )
-                return {
-                    'response': fallback_response or '',
-                    'system_commands': [],
-                    'escalation': False
-                }
-            
-            # Create dynamic system prompt for IT support
-            system_prompt = self._create_dynamic_system_prompt(os_type)
+            return {
+                'response': fallback_response or '',
+                'system_commands': [],
+                'escalation': False
+            }
+    
+    def process_message_stream(self, user_message, os_type, session_id=None):
+        """Process user message with GPT-4o, yielding response text as tokens arrive
+        
+        Yields ``{'type': 'chunk', 'content': ...}`` events for each piece of the
+        ``response`` field and finishes with a single ``{'type': 'done', 'message': ...}``
+        event carrying the same payload ``process_message`` returns. A duplicate of
+        a request already in flight only gets the ``done`` event.
+        """
+        if not session_id:
+            session_id = str(uuid.uuid4())
+        
+        key, future, leader = self._join_inflight(session_id, user_message, os_type)
+        if not leader:
+            result = self._await_inflight(future)
+            if result is None:
+                result = self._process_message(user_message, os_type, session_id)
+            yield {'type': 'done', 'message': result}
+            return
+        
+        result = None
+        try:
+            for event in self._process_message_stream(user_message, os_type, session_id):
+                if event['type'] == 'done':
+                    result = event['message']
+                yield event
+        finally:
+            # Also runs when the client disconnects and the generator is closed early
+            self._settle_inflight(key, future, result)
+    
+    def _process_message_stream(self, user_message, os_type, session_id=None):
+        try:
+            if not session_id:
+                session_id = str(uuid.uuid4())
             
-            # Get conversation history for context (last 15 interactions)
-            conversation = self._get_conversation_context(session_id, user_message)
+            deadline = Deadline(Config.REQUEST_DEADLINE)
+            turn = self._prepare_turn(session_id, user_message, os_type, deadline)
             
-            # Prepare messages for OpenAI
-            messages = [
-                {"role": "system", "content": system_prompt}
-            ]
+            first_turn = turn['first_turn']
+            if first_turn:
+                cached = self._answer_from_cache(session_id, user_message, os_type)
+                if cached is not None:
+                    yield {'type': 'done', 'message': cached}
+                    return
             
-            # Add conversation history
-            messages.extend(conversation)
+            internet_available = turn['connectivity']
+            if not self.llm_client.available or not internet_available:
+                logger.warning("OpenAI client not available or no internet connection, using fallback response")
+                yield {'type': 'done', 'message': self._store_fallback(
+                    session_id, user_message, os_type, 'fallback', internet_available
+                )}
+                return
             
-            # Add current user message
-            messages.append({"role": "user", "content": user_message})
+            messages = self._build_messages(turn['system_prompt'], turn['conversation'], user_message)
             
-            # Call OpenAI API
-            response = self.client.chat.completions.create(
-                model=Config.OPENAI_MODEL,
+            deadline.check('the GPT-4o call')
+            self._prefetch_diagnostics(user_message)
+            decision = self._route_turn(user_message, turn['conversation'])
+            started = time.perf_counter()
+            stream = self.llm_client.chat_completion(
+                timeout=deadline.timeout(Config.OPENAI_TIMEOUT),
+                model=decision.model,
                 messages=messages,
                 max_tokens=Config.OPENAI_MAX_TOKENS,
                 temperature=Config.OPENAI_TEMPERATURE,
-                response_format={"type": "json_object"}
+                response_format={"type": "json_object"},
+                stream=True,
+                stream_options={"include_usage": True}
             )
             
-            bot_response_text = response.choices[0].message.content
+            streamer = ResponseFieldStreamer()
+            raw_parts = []
+            usage = None
+            for chunk in stream:
+                # With include_usage the last chunk carries token counts and no choices
+                if getattr(chunk, 'usage', None):
+                    usage = chunk.usage
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if not delta:
+                    continue
+                raw_parts.append(delta)
+                text = streamer.feed(delta)
+                if text:
+                    yield {'type': 'chunk', 'content': text}
             
-            # Try to parse JSON response
-            try:
-                import json
-                parsed_response = json.loads(bot_response_text)
-                
-                # Extract components from JSON
-                response_text = parsed_response.get('response', '')
-                if not isinstance(response_text, str):
-                    response_text = str(response_text) if response_text is not None else ''
-                system_commands = parsed_response.get('system_commands', [])
-                escalation = parsed_response.get('escalation', False)
-                
-                # Store in conversation history (store only the markdown response for chat history)
-                self.chat_database.store_message(
-                    session_id, user_message, response_text, 
-                    os_type, 'gpt_analysis'
-                )
-                
-                return {
-                    'response': response_text or '',
-                    'system_commands': system_commands,
-                    'escalation': escalation
-                }
-                
-            except json.JSONDecodeError as e:
-                # If JSON parsing fails, use the original response
-                logger.warning(f"Failed to parse JSON response from GPT-4o: {str(e)}")
-                logger.warning(f"Raw response: {bot_response_text[:500]}...")
-                self.chat_database.store_message(
-                    session_id, user_message, bot_response_text, 
-                    os_type, 'gpt_analysis'
-                )
-                return {
-                    'response': bot_response_text or '',
-                    'system_commands': [],
-                    'escalation': False
-                }
+            bot_response_text = ''.join(raw_parts)
+            self.model_router.record(decision.tier, time.perf_counter() - started, usage)
+            if decision.tier != 'large' and not is_valid_reply(bot_response_text):
+                # The done event replaces whatever the small model streamed
+                decision = self.model_router.escalate(decision)
+                deadline.check('the escalated GPT-4o call')
+                bot_response_text = self._call_tier(decision, messages, deadline)
+            yield {'type': 'done', 'message': self._finalize_response(
+                session_id, user_message, os_type, bot_response_text, first_turn
+            )}
+        except CircuitOpenError as e:
+            logger.warning(f"Skipping GPT-4o call: {str(e)}")
+            yield {'type': 'done', 'message': self._store_fallback(session_id, user_message, os_type, 'fallback', True)}
+        except DeadlineExceeded as e:
+            logger.warning(f"Request deadline exceeded: {str(e)}")
+            yield {'type': 'done', 'message': self._store_fallback(session_id, user_message, os_type, 'timeout', True)}
         except Exception as e:
-            logger.error(f"Error processing message with GPT-4o: {str(e)}")
+            logger.error(f"Error streaming message with GPT-4o: {str(e)}")
             fallback_response = self._get_fallback_response(user_message, os_type, False)
             if session_id:
                 self.chat_database.store_message(
                     session_id, user_message, fallback_response, 
                     os_type, 'error'
                 )
-            return {
+            yield {'type': 'done', 'message': {
                 'response': fallback_response or '',
                 'system_commands': [],
                 'escalation': False
+            }}
+    
+    async def aprocess_message(self, user_message, os_type, session_id=None):
+        """Async variant of process_message for the asyncio pipeline
+        
+        The GPT-4o call is awaited on the event loop (bounded by LLM_MAX_CONCURRENCY)
+        and database work runs in the loop's bounded thread pool.
+        """
+        if not session_id:
+            session_id = str(uuid.uuid4())
+        
+        key, future, leader = self._join_inflight(session_id, user_message, os_type)
+        if not leader:
+            result = await self._aawait_inflight(future)
+            if result is not None:
+                return result
+            return await self._aprocess_message(user_message, os_type, session_id)
+        
+        result = None
+        try:
+            result = await self._aprocess_message(user_message, os_type, session_id)
+            return result
+        finally:
+            self._settle_inflight(key, future, result)
+    
+    async def _aprocess_message(self, user_message, os_type, session_id=None):
+        try:
+            if not session_id:
+                session_id = str(uuid.uuid4())
+            
+            deadline = Deadline(Config.REQUEST_DEADLINE)
+            turn = await self._aprepare_turn(session_id, user_message, os_type, deadline)
+            
+            first_turn = turn['first_turn']
+            if first_turn:
+                cached = await asyncio.to_thread(self._answer_from_cache, session_id, user_message, os_type)
+                if cached is not None:
+                    return cached
+            
+            internet_available = turn['connectivity']
+            if not self.llm_client.available or not internet_available:
+                logger.warning("OpenAI client not available or no internet connection, using fallback response")
+                return await asyncio.to_thread(
+                    self._store_fallback, session_id, user_message, os_type, 'fallback', internet_available
+                )
+            
+            messages = self._build_messages(turn['system_prompt'], turn['conversation'], user_message)
+            
+            deadline.check('the GPT-4o call')
+            self._prefetch_diagnostics(user_message)
+            decision = self._route_turn(user_message, turn['conversation'])
+            bot_response_text = await self._acomplete_turn(decision, messages, deadline)
+            return await asyncio.to_thread(
+                self._finalize_response, session_id, user_message, os_type, bot_response_text, first_turn
+            )
+            
+        except CircuitOpenError as e:
+            logger.warning(f"Skipping GPT-4o call: {str(e)}")
+            return await asyncio.to_thread(
+                self._store_fallback, session_id, user_message, os_type, 'fallback', True
+            )
+        except DeadlineExceeded as e:
+            logger.warning(f"Request deadline exceeded: {str(e)}")
+            return await asyncio.to_thread(
+                self._store_fallback, session_id, user_message, os_type, 'timeout', True
+            )
+        except Exception as e:
+            logger.error(f"Error processing message with GPT-4o: {str(e)}")
+            return await asyncio.to_thread(
+                self._store_fallback, session_id, user_message, os_type, 'error', False
+            )
+    
+    def analyze_command_result(self, session_id, command, output, error, user_message='', previous_bot_response=''):
+        """Ask GPT-4o to interpret a command result and suggest next steps"""
+        # Clear-cut results (100% loss, full disk, NXDOMAIN, ...) are answered locally
+        verdict = self._local_verdict(command, output, error)
+        if verdict:
+            self.chat_database.store_message(
+                session_id, f"Command result for {command}", verdict['response'], "system", "verdict_rule"
+            )
+            return verdict
+        
+        messages, reduction = self._build_analysis_messages(command, output, error, user_message, previous_bot_response)
+        response = self.llm_client.chat_completion(
+            model=Config.OPENAI_MODEL,
+            messages=messages,
+            max_tokens=Config.OPENAI_MAX_TOKENS,
+            temperature=Config.OPENAI_TEMPERATURE
+        )
+        bot_followup = response.choices[0].message.content
+        # Optionally store this in the session history
+        self.chat_database.store_message(
+            session_id, f"Command result for {command}", bot_followup, "system", "gpt_analysis"
+        )
+        return self._analysis_result(bot_followup, reduction)
+    
+    async def aanalyze_command_result(self, session_id, command, output, error, user_message='', previous_bot_response=''):
+        """Async variant of analyze_command_result for the asyncio pipeline"""
+        verdict = self._local_verdict(command, output, error)
+        if verdict:
+            await asyncio.to_thread(
+                self.chat_database.store_message,
+                session_id, f"Command result for {command}", verdict['response'], "system", "verdict_rule"
+            )
+            return verdict
+        
+        messages, reduction = self._build_analysis_messages(command, output, error, user_message, previous_bot_response)
+        response = await self.llm_client.achat_completion(
+            model=Config.OPENAI_MODEL,
+            messages=messages,
+            max_tokens=Config.OPENAI_MAX_TOKENS,
+            temperature=Config.OPENAI_TEMPERATURE
+        )
+        bot_followup = response.choices[0].message.content
+        await asyncio.to_thread(
+            self.chat_database.store_message,
+            session_id, f"Command result for {command}", bot_followup, "system", "gpt_analysis"
+        )
+        return self._analysis_result(bot_followup, reduction)
+    
+    def _local_verdict(self, command, output, error):
+        """Answer a command result from the verdict rules, or return None to ask GPT-4o"""
+        if not Config.VERDICT_ENGINE_ENABLED:
+            return None
+        verdict = self.verdict_engine.evaluate(command, output, error, self.system_commands.os_type)
+        if not verdict:
+            return None
+        rule, response = verdict
+        return {'response': response, 'verdict': rule}
+    
+    def _build_analysis_messages(self, command, output, error, user_message, previous_bot_response):
+        """Compose the context for a command result follow-up
+        
+        Output of known diagnostics (ping, df, ps, netstat, ipconfig, ...) is sent
+        as compact parsed facts instead of raw text. Returns ``(messages, reduction)``.
+        """
+        reduction = None
+        if Config.OUTPUT_REDUCERS_ENABLED:
+            reduction = self.output_reducer.reduce(command, output)
+        if reduction and reduction['reducer']:
+            result_text = f"Key facts parsed from the output (JSON):\n{reduction['text']}"
+            logger.info(
+                f"Reduced output of `{command}` with the {reduction['reducer']} parser: "
+                f"{reduction['tokens_before']} -> {reduction['tokens_after']} tokens"
+            )
+        else:
+            result_text = f"Output:\n{output or '(no output)'}"
+        
+        context = [
+            {"role": "user", "content": user_message or "The user asked for help."},
+            {"role": "assistant", "content": previous_bot_response or "The assistant provided a diagnosis and suggested a command."},
+            {"role": "user", "content": f"I ran the command `{command}`. Here is the result:\n{result_text}\nError:\n{error or 'None'}"}
+        ]
+        prompt = (
+            "Given the user's issue, your previous diagnosis, and the command result, "
+            "analyze the result and provide actionable insights or next steps. "
+            "If the issue is resolved, say so. If not, suggest what to try next."
+        )
+        context.insert(0, {"role": "system", "content": prompt})
+        return context, reduction
+    
+    @staticmethod
+    def _analysis_result(bot_followup, reduction):
+        """Build the analyze response, reporting how much the command output was reduced"""
+        result = {'response': bot_followup}
+        if reduction:
+            result['output_tokens'] = {
+                'reducer': reduction['reducer'],
+                'before': reduction['tokens_before'],
+                'after': reduction['tokens_after']
+            }
+        return result
+    
+    def get_inflight_stats(self):
+        """Get statistics on coalesced duplicate requests"""
+        with self._inflight_lock:
+            in_flight = len(self._inflight)
+        return {
+            'in_flight': in_flight,
+            'leader_requests': self.leader_requests,
+            'coalesced_requests': self.coalesced_requests,
+            'coalesce_fallbacks': self.coalesce_fallbacks
+        }
+    
+    def _join_inflight(self, session_id, user_message, os_type):
+        """Register a request as in flight, or find the identical one already running
+        
+        Returns ``(key, future, is_leader)``. The leader runs the request and
+        settles the future; duplicates wait on it instead of calling GPT-4o.
+        """
+        digest = hashlib.sha256((user_message or '').encode('utf-8')).hexdigest()
+        key = (session_id, os_type, digest)
+        with self._inflight_lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                self.coalesced_requests += 1
+                logger.info(f"Coalescing duplicate request for session {session_id}")
+                return key, future, False
+            future = Future()
+            self._inflight[key] = future
+            self.leader_requests += 1
+            return key, future, True
+    
+    def _await_inflight(self, future):
+        """Wait for the leader's result; None means the caller should process the message itself"""
+        try:
+            result = future.result(timeout=Config.INFLIGHT_WAIT_TIMEOUT)
+        except Exception as e:
+            logger.warning(f"Coalesced request could not use the in-flight result: {str(e)}")
+            result = None
+        return self._inflight_result(result)
+    
+    async def _aawait_inflight(self, future):
+        """Async _await_inflight that waits on the event loop instead of a worker thread"""
+        try:
+            # shield: timing out must not cancel the leader's future for the other duplicates
+            result = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), Config.INFLIGHT_WAIT_TIMEOUT)
+        except Exception as e:
+            logger.warning(f"Coalesced request could not use the in-flight result: {str(e) or type(e).__name__}")
+            result = None
+        return self._inflight_result(result)
+    
+    def _inflight_result(self, result):
+        if result is None:
+            self.coalesce_fallbacks += 1
+            return None
+        return copy.deepcopy(result)
+    
+    def _settle_inflight(self, key, future, result):
+        """Remove a finished request from the registry and release its duplicates"""
+        with self._inflight_lock:
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+        if not future.done():
+            if result is not None:
+                future.set_result(result)
+            else:
+                future.set_exception(RuntimeError("In-flight request ended without a response"))
+    
+    def _prefetch_diagnostics(self, user_message):
+        """Start the issue category's low-risk diagnostics while GPT-4o is thinking (opt-in)"""
+        if not Config.SPECULATIVE_DIAGNOSTICS:
+            return
+        try:
+            category = self.automated_diagnostics.categorize_user_issue(user_message)
+            commands = [
+                diagnostic.command
+                for diagnostic in self.automated_diagnostics.get_suggested_diagnostics(category)
+                if diagnostic.risk_level == 'low'
+            ]
+            scheduled = self.system_commands.prefetch(commands)
+            if scheduled:
+                logger.info(f"Prefetching {len(scheduled)} {category} diagnostics: {', '.join(scheduled)}")
+        except Exception as e:
+            logger.warning(f"Error starting diagnostic prefetch: {str(e)}")
+    
+    def _is_first_turn(self, session_id, deadline=None):
+        """Check if the answer cache applies: it is enabled and the session has no earlier turns"""
+        if self.response_cache is None:
+            return False
+        # A failed read (None) is not proof of a new session: serving a canned answer mid-conversation is worse than a miss
+        return self.chat_database.has_conversation_history(session_id, deadline=deadline) is False
+    
+    def _answer_from_cache(self, session_id, user_message, os_type):
+        """Store and return a cached answer to a repeated first question, or None"""
+        cached = self.response_cache.get(os_type, user_message)
+        if cached is None:
+            return None
+        self.chat_database.store_message(
+            session_id, user_message, cached['response'], 
+            os_type, 'cached_answer'
+        )
+        return cached
+    
+    def _store_fallback(self, session_id, user_message, os_type, intent_category, internet_available):
+        """Store and return a fallback response for when GPT-4o cannot be used"""
+        fallback_response = self._get_fallback_response(user_message, os_type, internet_available)
+        self.chat_database.store_message(
+            session_id, user_message, fallback_response, 
+            os_type, intent_category
+        )
+        return {
+            'response': fallback_response or '',
+            'system_commands': [],
+            'escalation': False
+        }
+    
+    def _prepare_turn(self, session_id, user_message, os_type, deadline):
+        """Run the independent pre-LLM stages of a request concurrently within its deadline
+        
+        Returns the stage results keyed by stage name. Raises DeadlineExceeded if
+        a stage has not finished when the deadline passes; the stage itself also
+        receives the deadline and gives up on its own.
+        """
+        timings = {}
+        started = time.perf_counter()
+        futures = {
+            name: self.stage_executor.submit(self._timed_stage, timings, name, function, *args)
+            for name, function, args in self._pre_llm_stages(session_id, user_message, os_type, deadline)
+        }
+        # The prompt lookup is a dictionary read; do it here while the others run
+        results = {'system_prompt': self._timed_stage(
+            timings, 'system_prompt', self._create_dynamic_system_prompt, os_type
+        )}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result(timeout=deadline.remaining())
+            except FutureTimeoutError:
+                raise DeadlineExceeded(f"Pre-LLM stage '{name}' did not finish before the deadline")
+        self._log_stage_timings(session_id, timings, started)
+        return results
+    
+    async def _aprepare_turn(self, session_id, user_message, os_type, deadline):
+        """Async variant of _prepare_turn using the event loop's thread pool"""
+        timings = {}
+        started = time.perf_counter()
+        stages = self._pre_llm_stages(session_id, user_message, os_type, deadline)
+        try:
+            values = await asyncio.wait_for(asyncio.gather(*(
+                asyncio.to_thread(self._timed_stage, timings, name, function, *args)
+                for name, function, args in stages
+            )), timeout=deadline.remaining())
+        except asyncio.TimeoutError:
+            raise DeadlineExceeded("Pre-LLM stages did not finish before the deadline")
+        results = dict(zip((name for name, _, _ in stages), values))
+        results['system_prompt'] = self._timed_stage(
+            timings, 'system_prompt', self._create_dynamic_system_prompt, os_type
+        )
+        self._log_stage_timings(session_id, timings, started)
+        return results
+    
+    def _pre_llm_stages(self, session_id, user_message, os_type, deadline):
+        """The blocking stages that must finish before GPT-4o is called; none depends on another"""
+        return [
+            ('create_session', self.chat_database.create_session, (session_id, os_type, deadline)),
+            ('first_turn', self._is_first_turn, (session_id, deadline)),
+            ('connectivity', self.network_tools.check_internet_connectivity, (deadline,)),
+            ('conversation', self._get_conversation_context, (session_id, user_message, deadline))
+        ]
+    
+    @staticmethod
+    def _timed_stage(timings, name, function, *args):
+        started = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            timings[name] = (time.perf_counter() - started) * 1000
+    
+    def _log_stage_timings(self, session_id, timings, started):
+        """Log how long each pre-LLM stage took and which one bounded the request"""
+        total = (time.perf_counter() - started) * 1000
+        critical = max(timings, key=timings.get)
+        breakdown = ', '.join(f"{name}={elapsed:.1f}ms" for name, elapsed in timings.items())
+        logger.info(
+            f"Pre-LLM stages for session {session_id} took {total:.1f}ms "
+            f"(critical path: {critical}); {breakdown}"
+        )
+    
+    def _route_turn(self, user_message, conversation):
+        """Pick the model tier for a turn from its category, length and history depth"""
+        category = self.automated_diagnostics.categorize_user_issue(user_message)
+        history_depth = sum(1 for message in conversation if message.get('role') == 'user')
+        decision = self.model_router.route(user_message, category, history_depth)
+        logger.info(f"Routing turn to {decision.model} ({decision.tier} tier): {decision.reason}")
+        return decision
+    
+    def _complete_turn(self, decision, messages, deadline):
+        """Call the routed model, escalating to the large tier if its reply is not valid JSON"""
+        bot_response_text = self._call_tier(decision, messages, deadline)
+        if decision.tier != 'large' and not is_valid_reply(bot_response_text):
+            decision = self.model_router.escalate(decision)
+            deadline.check('the escalated GPT-4o call')
+            bot_response_text = self._call_tier(decision, messages, deadline)
+        return bot_response_text
+    
+    async def _acomplete_turn(self, decision, messages, deadline):
+        """Async variant of _complete_turn"""
+        bot_response_text = await self._acall_tier(decision, messages, deadline)
+        if decision.tier != 'large' and not is_valid_reply(bot_response_text):
+            decision = self.model_router.escalate(decision)
+            deadline.check('the escalated GPT-4o call')
+            bot_response_text = await self._acall_tier(decision, messages, deadline)
+        return bot_response_text
+    
+    def _call_tier(self, decision, messages, deadline):
+        """Call one model tier within the request deadline and record its latency and tokens"""
+        started = time.perf_counter()
+        response = self.llm_client.chat_completion(
+            timeout=deadline.timeout(Config.OPENAI_TIMEOUT),
+            model=decision.model,
+            messages=messages,
+            max_tokens=Config.OPENAI_MAX_TOKENS,
+            temperature=Config.OPENAI_TEMPERATURE,
+            response_format={"type": "json_object"}
+        )
+        self.model_router.record(decision.tier, time.perf_counter() - started, getattr(response, 'usage', None))
+        return response.choices[0].message.content
+    
+    async def _acall_tier(self, decision, messages, deadline):
+        """Async variant of _call_tier"""
+        started = time.perf_counter()
+        response = await self.llm_client.achat_completion(
+            timeout=deadline.timeout(Config.OPENAI_TIMEOUT),
+            model=decision.model,
+            messages=messages,
+            max_tokens=Config.OPENAI_MAX_TOKENS,
+            temperature=Config.OPENAI_TEMPERATURE,
+            response_format={"type": "json_object"}
+        )
+        self.model_router.record(decision.tier, time.perf_counter() - started, getattr(response, 'usage', None))
+        return response.choices[0].message.content
+    
+    def _build_messages(self, system_prompt, conversation, user_message):
+        """Assemble the message list sent to OpenAI for this turn"""
+        # Most stable content first so consecutive calls share the longest possible
+        # prefix for provider-side prompt caching: per-OS system prompt (never
+        # changes), then the rolling summary (changes rarely), then recent turns
+        messages = [
+            {"role": "system", "content": system_prompt}
+        ]
+        messages.extend(conversation)
+        messages.append({"role": "user", "content": user_message})
+        return messages
+    
+    def _finalize_response(self, session_id, user_message, os_type, bot_response_text, cacheable=False):
+        """Parse the raw GPT-4o JSON reply, store it and build the response payload"""
+        try:
+            parsed_response = json.loads(bot_response_text)
+            
+            # Extract components from JSON
+            response_text = parsed_response.get('response', '')
+            if not isinstance(response_text, str):
+                response_text = str(response_text) if response_text is not None else ''
+            system_commands = parsed_response.get('system_commands', [])
+            escalation = parsed_response.get('escalation', False)
+            
+            # Store in conversation history (store only the markdown response for chat history)
+            self.chat_database.store_message(
+                session_id, user_message, response_text, 
+                os_type, 'gpt_analysis'
+            )
+            
+            result = {
+                'response': response_text or '',
+                'system_commands': system_commands,
+                'escalation': escalation
+            }
+            if cacheable and response_text:
+                self.response_cache.set(os_type, user_message, result)
+            return result
+            
+        except (json.JSONDecodeError, AttributeError) as e:
+            # If JSON parsing fails, use the original response
+            logger.warning(f"Failed to parse JSON response from GPT-4o: {str(e)}")
+            logger.warning(f"Raw response: {(bot_response_text or '')[:500]}...")
+            self.chat_database.store_message(
+                session_id, user_message, bot_response_text, 
+                os_type, 'gpt_analysis'
+            )
+            return {
+                'response': bot_response_text or '',
+                'system_commands': [],
+                'escalation': False
             }
     
     def _create_dynamic_system_prompt(self, os_type):
-        """Create dynamic system prompt for GPT-4o IT support"""
-        return f"""You are an intelligent IT support assistant for {os_type}. Your role is to analyze PC problems and provide solutions.
-
-**CRITICAL: You MUST respond in JSON format ONLY. NO OTHER TEXT ALLOWED.**
-
-Your response must be a valid JSON object with this exact structure:
-
-```json
-{{
-    "response": "Your conversational response to the user with explanations, step-by-step guidance, and any clarifying questions",
-    "system_commands": [
-        {{
-            "command": "actual_command_to_run",
-            "description": "What this command does and why it helps"
-        }}
-    ],
-    "escalation": false
-}}
-```
-
-**JSON RULES:**
-- `response`: Your detailed response to the user (can include markdown formatting)
-- `system_commands`: Array of commands that can be executed in {os_type} terminal/command prompt
-- `escalation`: Set to `true` only if you cannot determine the issue and need human intervention
-- Only include commands that are safe and can run in {os_type} terminal/command prompt
-- If no commands are needed, use empty array: `"system_commands": []`
-- ALWAYS wrap your entire response in the JSON format above
-- NEVER include any text outside the JSON structure
-- NEVER include any explanations about the JSON format in your response
-- Your response must be parseable JSON only
-
-**SUPPORT AREAS:**
-- Hardware issues (peripherals, components, drivers)
-- Software issues (applications, OS problems, performance)
-- Network issues (connectivity, DNS, WiFi, Ethernet)
-- System issues (disk space, processes, security)
-- Peripheral issues (printers, audio, displays)
-
-**OS-SPECIFIC COMMAND EXAMPLES:**
-
-**Windows Commands:**
-- `ping google.com -n 4` - Test internet connectivity
-- `ipconfig /all` - View network configuration
-- `systeminfo` - Get system information
-- `tasklist /v` - List running processes
-- `wmic logicaldisk get size,freespace,caption` - Check disk space
-- `nslookup google.com` - Test DNS resolution
-- `netstat -an` - Check network connections
-- `sfc /scannow` - System file checker
-- `chkdsk C:` - Check disk for errors
-- `wmic printer list brief` - List printers
-- `sc query spooler` - Check print spooler service
-- `netsh wlan show profiles` - Show WiFi profiles
-- `getmac /v` - Get MAC addresses
-- `route print` - Show routing table
-
-**macOS Commands:**
-- `ping -c 4 google.com` - Test internet connectivity
-- `ifconfig` - View network configuration
-- `system_profiler SPHardwareDataType` - Get system information
-- `ps aux --sort=-%cpu | head -20` - List top processes
-- `df -h` - Check disk space
-- `nslookup google.com` - Test DNS resolution
-- `netstat -an` - Check network connections
-- `diskutil list` - List disk information
-- `sw_vers` - Get macOS version
-- `system_profiler SPUSBDataType` - List USB devices
-- `system_profiler SPAudioDataType` - List audio devices
-- `system_profiler SPDisplaysDataType` - List display devices
-- `networksetup -listallnetworkservices` - List network services
-- `networksetup -getinfo Wi-Fi` - Get WiFi information
-- `launchctl list | grep -i printer` - Check printer services
-- `sudo dscacheutil -flushcache` - Flush DNS cache
-- `sudo killall -HUP mDNSResponder` - Restart mDNS responder
-
-**Linux Commands:**
-- `ping -c 4 google.com` - Test internet connectivity
-- `ifconfig` or `ip addr` - View network configuration
-- `uname -a` - Get system information
-- `ps aux --sort=-%cpu | head -20` - List top processes
-- `df -h` - Check disk space
-- `nslookup google.com` - Test DNS resolution
-- `netstat -an` - Check network connections
-- `lscpu` - CPU information
-- `free -h` - Memory information
-- `lspci` - List PCI devices
-- `lsusb` - List USB devices
-- `lshw` - List hardware
-- `systemctl status` - Check system services
-- `journalctl -f` - View system logs
-
-**macOS SECURITY NOTES:**
-- Some macOS commands require sudo privileges
-- Commands like `system_profiler`, `diskutil`, `ioreg` may need password
-- Network commands like `networksetup` may require admin privileges
-- Always suggest non-privileged alternatives when possible
-- If a command requires sudo, mention it in the description
-
-**EXAMPLE RESPONSES:**
-
-**Network Issue on Windows:**
-```json
-{{
-    "response": "I understand you're having internet connectivity issues. Let me help you diagnose this step by step.\n\n**Step-by-Step Diagnosis:**\n1. First, let's test basic internet connectivity\n2. Check your network configuration\n3. Test DNS resolution\n4. Verify network connections\n\nI can run these diagnostic commands to help identify the issue:",
-    "system_commands": [
-        {{
-            "command": "ping google.com -n 4",
-            "description": "Test basic internet connectivity"
-        }},
-        {{
-            "command": "ipconfig /all",
-            "description": "View detailed network configuration"
-        }},
-        {{
-            "command": "nslookup google.com",
-            "description": "Test DNS resolution"
-        }}
-    ],
-    "escalation": false
-}}
-```
-
-**Network Issue on macOS:**
-```json
-{{
-    "response": "I understand you're having internet connectivity issues on macOS. Let me help you diagnose this step by step.\n\n**Step-by-Step Diagnosis:**\n1. First, let's test basic internet connectivity\n2. Check your network configuration\n3. Test DNS resolution\n4. Verify network services\n\nI can run these diagnostic commands to help identify the issue:",
-    "system_commands": [
-        {{
-            "command": "ping -c 4 google.com",
-            "description": "Test basic internet connectivity"
-        }},
-        {{
-            "command": "ifconfig",
-            "description": "View network configuration"
-        }},
-        {{
-            "command": "networksetup -listallnetworkservices",
-            "description": "List all network services"
-        }},
-        {{
-            "command": "nslookup google.com",
-            "description": "Test DNS resolution"
-        }}
-    ],
-    "escalation": false
-}}
-```
-
-**Printer Issue on Windows:**
-```json
-{{
-    "response": "I understand you're having printer problems on Windows. Let me help you troubleshoot this.\n\n**Step-by-Step Diagnosis:**\n1. Check if printer is recognized by the system\n2. Verify print spooler service\n3. Test basic printing functionality\n\nI can run these diagnostic commands to help identify the issue:",
-    "system_commands": [
-        {{
-            "command": "wmic printer list brief",
-            "description": "Check if printer is recognized by Windows"
-        }},
-        {{
-            "command": "sc query spooler",
-            "description": "Check print spooler service status"
-        }}
-    ],
-    "escalation": false
-}}
-```
-
-**Printer Issue on macOS:**
-```json
-{{
-    "response": "I understand you're having printer problems on macOS. Let me help you troubleshoot this.\n\n**Step-by-Step Diagnosis:**\n1. Check if printer is recognized by the system\n2. Verify print services\n3. Test basic printing functionality\n\nI can run these diagnostic commands to help identify the issue:",
-    "system_commands": [
-        {{
-            "command": "system_profiler SPUSBDataType",
-            "description": "Check USB devices including printers"
-        }},
-        {{
-            "command": "launchctl list | grep -i printer",
-            "description": "Check printer services"
-        }},
-        {{
-            "command": "lpstat -p",
-            "description": "List available printers"
-        }}
-    ],
-    "escalation": false
-}}
-```
-
-**Escalation Case:**
-```json
-{{
-    "response": "I'm not entirely sure about the specific issue you're describing. This may require escalation to an IT technician who can provide more specialized assistance.\n\n**Escalation Reason:**\nThe issue you're experiencing involves complex hardware diagnostics that require physical inspection or specialized tools that aren't available through remote commands.\n\n**Next Steps:**\nPlease contact your IT support team for assistance with this issue.",
-    "system_commands": [],
-    "escalation": true
-}}
-```
-
-**Remember:**
-- ALWAYS respond in the exact JSON format above
-- NEVER include any text outside the JSON structure
-- Only include commands that can run in {os_type} terminal/command prompt
-- Make commands safe and non-destructive
-- Escalate only when you truly cannot determine the issue
-- Provide clear explanations in the response field
-- For macOS, mention if commands require sudo privileges
-- Always suggest OS-specific commands based on the user's operating system"""
-    
-    def _get_conversation_context(self, session_id, current_message):
-        """Get recent conversation history for context"""
-        # Fetch last 15 interactions for context
-        interactions = self.chat_database.get_conversation_history(session_id, limit=15)
-        messages = []
-        for interaction in interactions:
-            messages.append({"role": "user", "content": interaction['user_message']})
-            messages.append({"role": "assistant", "content": interaction['bot_response']})
-        return messages
+        """Get the precomputed system prompt for GPT-4o IT support on this OS"""
+        return self.prompt_library.get(os_type)
+    
+    def _get_conversation_context(self, session_id, current_message, deadline=None):
+        """Get recent conversation history for context, bounded by the token budget"""
+        # Recent turns verbatim, older turns folded into a rolling summary
+        return self.context_builder.build(session_id, deadline)
     
     def _get_fallback_response(self, user_message, os_type, internet_available=True):
         """Provide fallback response when GPT-4o is unavailable"""
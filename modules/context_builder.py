@@ -0,0 +1,135 @@
+import logging
+import math
+import re
+from typing import Dict, List, Optional
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+try:
+    import tiktoken
+    _ENCODING = tiktoken.get_encoding('o200k_base')
+except Exception:  # tiktoken is optional; fall back to a character estimate
+    _ENCODING = None
+
+# Per-message overhead the chat format adds on top of the content tokens
+MESSAGE_OVERHEAD_TOKENS = 4
+
+def count_tokens(text: str) -> int:
+    """Count tokens in text, exactly with tiktoken or approximately (~4 chars per token)"""
+    if not text:
+        return 0
+    if _ENCODING is not None:
+        return len(_ENCODING.encode(text))
+    return math.ceil(len(text) / 4)
+
+def count_message_tokens(messages: List[Dict]) -> int:
+    """Count tokens in a list of chat messages including per-message overhead"""
+    return sum(count_tokens(message.get('content', '')) + MESSAGE_OVERHEAD_TOKENS for message in messages)
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Trim text to roughly max_tokens, marking where it was cut"""
+    if count_tokens(text) <= max_tokens:
+        return text
+    if _ENCODING is not None:
+        return _ENCODING.decode(_ENCODING.encode(text)[:max_tokens]) + ' …(truncated)'
+    return text[:max_tokens * 4] + ' …(truncated)'
+
+class ContextBuilder:
+    """Fits conversation history into a token budget with a rolling summary
+    
+    The newest turns are sent verbatim until the history budget is used up.
+    Turns that no longer fit are folded into a per-session summary stored in
+    ``session_summaries`` together with the id of the last summarized turn, so
+    each turn is summarized once and later calls only read newer rows.
+    """
+    
+    SUMMARY_HEADER = 'Summary of earlier conversation:'
+    
+    def __init__(self, chat_database, token_budget: int = None, summary_token_budget: int = None,
+                 max_turn_tokens: int = None, history_window: int = None):
+        self.chat_database = chat_database
+        self.token_budget = token_budget or Config.CONTEXT_TOKEN_BUDGET
+        self.summary_token_budget = summary_token_budget or Config.CONTEXT_SUMMARY_TOKEN_BUDGET
+        self.max_turn_tokens = max_turn_tokens or Config.CONTEXT_MAX_TURN_TOKENS
+        self.history_window = history_window or Config.CONTEXT_HISTORY_WINDOW
+    
+    def build(self, session_id: str, deadline=None) -> List[Dict]:
+        """Build the history messages for a session within the token budget"""
+        summary_row = self.chat_database.get_session_summary(session_id, deadline)
+        summary = summary_row['summary'] if summary_row else ''
+        summarized_through = summary_row['summarized_through'] if summary_row else 0
+        
+        turns = self.chat_database.get_conversation_history(
+            session_id, limit=self.history_window, after_id=summarized_through, deadline=deadline
+        )
+        
+        turn_messages = [self._turn_messages(turn) for turn in turns]
+        costs = [count_message_tokens(messages) for messages in turn_messages]
+        
+        # Reserve room for the summary as soon as one exists or is about to be needed
+        available = self.token_budget
+        if summary or sum(costs) > available:
+            available -= self.summary_token_budget + count_tokens(self.SUMMARY_HEADER) + MESSAGE_OVERHEAD_TOKENS
+        
+        # Walk newest to oldest, keeping turns while they fit next to the summary
+        kept = []
+        for index in range(len(turns) - 1, -1, -1):
+            cost = costs[index]
+            if cost > available and kept:
+                overflow = turns[:index + 1]
+                summary = self._fold_into_summary(session_id, summary, overflow, summarized_through)
+                break
+            available -= cost
+            kept = turn_messages[index] + kept
+        
+        messages = []
+        if summary:
+            messages.append({'role': 'system', 'content': f"{self.SUMMARY_HEADER}\n{summary}"})
+        messages.extend(kept)
+        return messages
+    
+    def _turn_messages(self, turn: Dict) -> List[Dict]:
+        return [
+            {'role': 'user', 'content': truncate_to_tokens(turn['user_message'] or '', self.max_turn_tokens)},
+            {'role': 'assistant', 'content': truncate_to_tokens(turn['bot_response'] or '', self.max_turn_tokens)}
+        ]
+    
+    def _fold_into_summary(self, session_id: str, summary: str, overflow: List[Dict],
+                           summarized_through: int) -> str:
+        """Append overflowing turns to the rolling summary and persist the new watermark"""
+        # Queued (write-behind) rows have no id yet; they are summarized once committed
+        committed = [turn for turn in overflow if turn.get('id')]
+        if not committed:
+            return summary
+        
+        lines = summary.split('\n') if summary else []
+        lines.extend(self._summarize_turn(turn) for turn in committed)
+        
+        # Keep the summary bounded by dropping its oldest lines
+        while len(lines) > 1 and count_tokens('\n'.join(lines)) > self.summary_token_budget:
+            lines.pop(0)
+        summary = '\n'.join(lines)
+        
+        through = max(summarized_through or 0, committed[-1]['id'])
+        self.chat_database.store_session_summary(session_id, summary, through, count_tokens(summary))
+        logger.debug(f"Folded {len(committed)} turns into summary for session {session_id}")
+        return summary
+    
+    @staticmethod
+    def _summarize_turn(turn: Dict) -> str:
+        """Compress one exchange into a single line"""
+        return f"- User: {_first_sentence(turn['user_message'], 160)} | Assistant: {_first_sentence(turn['bot_response'], 200)}"
+
+def _first_sentence(text: Optional[str], max_chars: int) -> str:
+    """Return the first meaningful sentence of a markdown/HTML message"""
+    if not text:
+        return '(empty)'
+    plain = re.sub(r'<[^>]+>', ' ', text)
+    plain = re.sub(r'[*_`#>]+', '', plain)
+    plain = ' '.join(plain.split())
+    match = re.match(r'(.+?[.!?])(\s|$)', plain)
+    sentence = match.group(1) if match else plain
+    if len(sentence) > max_chars:
+        sentence = sentence[:max_chars - 1].rstrip() + '…'
+    return sentence
@@ -0,0 +1,161 @@
+import sqlite3
+import logging
+import queue
+import threading
+from contextlib import contextmanager
+from config import Config
+from modules.deadline import DeadlineExceeded
+
+logger = logging.getLogger(__name__)
+
+class PoolExhausted(Exception):
+    """Raised when no pooled connection is handed back within the busy timeout"""
+
+class SQLiteConnectionPool:
+    """Pool of reusable SQLite connections tuned for concurrent chat traffic
+    
+    Flask and Socket.IO run each request on its own thread, so connections are
+    pooled rather than kept per thread. Every connection is opened once in WAL
+    mode with tuned PRAGMAs and keeps its own prepared statement cache, so
+    repeated queries skip both the connect and the SQL parse.
+    """
+    
+    def __init__(self, db_path, max_connections=None, busy_timeout=None, cached_statements=None):
+        self.db_path = db_path
+        self.max_connections = max_connections or Config.DATABASE_POOL_SIZE
+        self.busy_timeout = busy_timeout or Config.DATABASE_BUSY_TIMEOUT
+        self.cached_statements = cached_statements or Config.DATABASE_STATEMENT_CACHE
+        
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._all_connections = []
+        self.connections_opened = 0
+        self.acquisitions = 0
+        self.waits = 0
+        self.deadline_acquisitions = 0
+    
+    @contextmanager
+    def connection(self, deadline=None):
+        """Borrow a connection from the pool for the duration of the block
+        
+        With a deadline, waiting for a connection, waiting on a lock and running
+        queries all stop once it passes; SQLite then raises OperationalError.
+        """
+        conn = self._acquire(deadline)
+        if deadline is not None:
+            self._apply_deadline(conn, deadline)
+        try:
+            yield conn
+        finally:
+            if deadline is not None:
+                self._clear_deadline(conn)
+            self._release(conn)
+    
+    @contextmanager
+    def transaction(self, deadline=None):
+        """Borrow a connection and commit on success or roll back on error"""
+        with self.connection(deadline) as conn:
+            try:
+                yield conn
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+    
+    def close_all(self):
+        """Close every connection owned by the pool"""
+        with self._lock:
+            connections = list(self._all_connections)
+            self._all_connections.clear()
+        while True:
+            try:
+                self._idle.get_nowait()
+            except queue.Empty:
+                break
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.Error as e:
+                logger.debug(f"Error closing database connection: {str(e)}")
+    
+    def get_stats(self):
+        """Get pool statistics"""
+        return {
+            'max_connections': self.max_connections,
+            'open_connections': len(self._all_connections),
+            'idle_connections': self._idle.qsize(),
+            'connections_opened': self.connections_opened,
+            'acquisitions': self.acquisitions,
+            'waits': self.waits,
+            'deadline_acquisitions': self.deadline_acquisitions
+        }
+    
+    def _acquire(self, deadline=None):
+        if deadline is not None:
+            deadline.check('acquiring a database connection')
+        self.acquisitions += 1
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        
+        with self._lock:
+            if len(self._all_connections) < self.max_connections:
+                conn = self._open_connection()
+                self._all_connections.append(conn)
+                return conn
+        
+        # Pool exhausted: wait for another request to hand its connection back
+        self.waits += 1
+        timeout = self.busy_timeout / 1000
+        if deadline is not None:
+            timeout = deadline.timeout(timeout)
+        try:
+            return self._idle.get(timeout=timeout)
+        except queue.Empty:
+            if deadline is not None and deadline.expired:
+                raise DeadlineExceeded(f"No database connection free before the deadline ({timeout:.2f}s)")
+            raise PoolExhausted(f"No database connection free within {timeout:.2f}s")
+    
+    def _release(self, conn):
+        with self._lock:
+            owned = conn in self._all_connections
+        if not owned:
+            # The pool was closed while this connection was borrowed
+            conn.close()
+            return
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+    
+    def _apply_deadline(self, conn, deadline):
+        busy_ms = int(min(self.busy_timeout, deadline.remaining() * 1000))
+        conn.execute(f'PRAGMA busy_timeout={busy_ms}')
+        # Checked every N virtual machine steps; a true result interrupts the query
+        conn.set_progress_handler(lambda: deadline.expired, Config.DATABASE_DEADLINE_CHECK_STEPS)
+        self.deadline_acquisitions += 1
+    
+    def _clear_deadline(self, conn):
+        try:
+            conn.set_progress_handler(None, 0)
+            conn.execute(f'PRAGMA busy_timeout={int(self.busy_timeout)}')
+        except sqlite3.Error as e:
+            logger.debug(f"Error resetting connection deadline: {str(e)}")
+    
+    def _open_connection(self):
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.busy_timeout / 1000,
+            check_same_thread=False,
+            cached_statements=self.cached_statements
+        )
+        # WAL lets readers proceed while a writer commits; NORMAL sync is safe under WAL
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA busy_timeout={int(self.busy_timeout)}')
+        conn.execute(f'PRAGMA cache_size=-{int(Config.DATABASE_CACHE_SIZE_KB)}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute(f'PRAGMA mmap_size={int(Config.DATABASE_MMAP_SIZE)}')
+        self.connections_opened += 1
+        logger.debug(f"Opened database connection {self.connections_opened} to {self.db_path}")
+        return conn
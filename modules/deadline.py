@@ -0,0 +1,35 @@
+import time
+
+class DeadlineExceeded(Exception):
+    """Raised when work cannot finish before its request deadline"""
+
+class Deadline:
+    """A fixed point in time by which a request must finish
+    
+    One Deadline is created per chat request and handed down to every stage
+    (database, connectivity probe, OpenAI call), so each stage waits at most
+    for the time the request has left instead of its own full timeout.
+    """
+    
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+    
+    def remaining(self):
+        """Seconds left before the deadline (never negative)"""
+        return max(self.expires_at - time.monotonic(), 0.0)
+    
+    @property
+    def expired(self):
+        """Check if the deadline has passed"""
+        return time.monotonic() >= self.expires_at
+    
+    def timeout(self, cap=None):
+        """Seconds a single call may block: the time left, bounded by cap"""
+        remaining = self.remaining()
+        return remaining if cap is None else min(cap, remaining)
+    
+    def check(self, what='request'):
+        """Raise DeadlineExceeded if the deadline has passed"""
+        if self.expired:
+            raise DeadlineExceeded(f"Deadline of {self.seconds}s exceeded before {what}")
@@ -0,0 +1,102 @@
+import logging
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+def has_ip_address(facts):
+    """An interface or adapter other than loopback has a routable IPv4 or global-scope IPv6 address"""
+    interfaces = facts.get('interfaces', []) + facts.get('adapters', [])
+    addresses = []
+    for iface in interfaces:
+        if iface.get('loopback'):
+            continue
+        # IPv6-only and NAT64 hosts have no IPv4 at all; the reducers keep only global-scope IPv6
+        if iface.get('ipv6_global'):
+            return True
+        ipv4 = iface.get('ipv4') or []
+        addresses.extend(ipv4 if isinstance(ipv4, list) else [ipv4])
+    return any(not address.startswith('169.254.') for address in addresses)
+
+def name_resolves(facts):
+    """nslookup returned at least one address"""
+    return bool(facts.get('addresses')) and 'error' not in facts
+
+def host_reachable(facts):
+    """Ping got at least one reply"""
+    return facts.get('received', 1) > 0
+
+@dataclass
+class PlaybookEdge:
+    """A dependency on an upstream step, optionally gated on that step's parsed facts
+    
+    The downstream step runs only if ``predicate(facts)`` is true. Output that
+    could not be parsed proves nothing, so the step runs anyway.
+    """
+    upstream: str
+    predicate: Optional[Callable[[Dict], bool]] = None
+    reason: str = ''
+    
+    def allows(self, result):
+        if self.predicate is None or not result.get('facts'):
+            return True
+        try:
+            return bool(self.predicate(result['facts']))
+        except Exception as e:
+            logger.warning(f"Playbook predicate on {self.upstream} failed: {str(e)}")
+            return True
+
+@dataclass
+class PlaybookStep:
+    """One diagnostic command in a playbook and the edges it waits on"""
+    id: str
+    command: object  # DiagnosticCommand
+    edges: List[PlaybookEdge] = field(default_factory=list)
+
+@dataclass
+class Playbook:
+    """Diagnostic steps forming a DAG
+    
+    Steps without a path between them run in parallel. When an edge's
+    predicate proves the downstream step pointless (no IP address, so no DNS
+    lookup), that step and everything below it are skipped.
+    """
+    name: str
+    steps: List[PlaybookStep]
+    
+    def __post_init__(self):
+        self.steps = self._topological_order()
+    
+    @classmethod
+    def flat(cls, name, commands):
+        """A playbook of independent steps, one per command"""
+        return cls(name, [PlaybookStep(f'{index}:{command.name}', command) for index, command in enumerate(commands)])
+    
+    def skip_reason(self, step, results):
+        """Why a step whose upstream steps have all finished should not run, or None"""
+        for edge in step.edges:
+            upstream = results[edge.upstream]
+            if upstream['status'] == 'skipped':
+                return f"{upstream['name']} was skipped"
+            if not edge.allows(upstream):
+                return edge.reason or f"ruled out by {upstream['name']}"
+        return None
+    
+    def _topological_order(self):
+        steps = {step.id: step for step in self.steps}
+        if len(steps) != len(self.steps):
+            raise ValueError(f"Playbook {self.name} has duplicate step ids")
+        for step in self.steps:
+            for edge in step.edges:
+                if edge.upstream not in steps:
+                    raise ValueError(f"Playbook {self.name}: step {step.id} depends on unknown step {edge.upstream}")
+        
+        ordered, placed = [], set()
+        while len(ordered) < len(self.steps):
+            ready = [step for step in self.steps
+                     if step.id not in placed and all(edge.upstream in placed for edge in step.edges)]
+            if not ready:
+                raise ValueError(f"Playbook {self.name} has a dependency cycle")
+            ordered.extend(ready)
+            placed.update(step.id for step in ready)
+        return ordered
@@ -0,0 +1,162 @@
+import asyncio
+import ipaddress
+import logging
+import secrets
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict
+from config import Config
+from modules.async_runner import get_async_runner
+from modules.probe_engine import dns_query, read_system_resolvers, summarize_rtts
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class Resolver:
+    """A DNS server to query directly"""
+    address: str
+    name: str
+    port: int = 53
+    system: bool = False  # configured on this machine rather than a public alternative
+
+def default_resolvers():
+    """The system's configured resolvers followed by the well-known public ones"""
+    resolvers = [Resolver(address, 'System resolver', system=True) for address in read_system_resolvers()]
+    configured = {resolver.address for resolver in resolvers}
+    resolvers.extend(
+        Resolver(address, name) for address, name in Config.DNS_PUBLIC_RESOLVERS.items() if address not in configured
+    )
+    return resolvers
+
+def _bogus_address(address):
+    """Addresses a public name should never resolve to (sinkholes, captive portals, blocking)"""
+    ip = ipaddress.ip_address(address)
+    return ip.is_private or ip.is_loopback or ip.is_unspecified or ip.is_reserved or ip.is_multicast
+
+class DnsProbe:
+    """Benchmarks resolvers with raw UDP queries sent in parallel
+    
+    Each resolver is asked for every name in ``names`` ``attempts`` times and
+    for one random name under ``.invalid``, all at once and each bounded by
+    ``timeout``. A resolver is healthy when every real name resolves to public
+    addresses and the made-up name returns NXDOMAIN (resolvers that invent
+    answers for missing names are not). The report ranks resolvers by average
+    latency and recommends the fastest healthy one.
+    """
+    
+    def __init__(self, resolvers=None, names=None, timeout=None, attempts=None):
+        self.resolvers = resolvers
+        self.names = list(names or Config.DNS_PROBE_NAMES)
+        self.timeout = timeout or Config.DNS_PROBE_TIMEOUT
+        self.attempts = attempts or Config.DNS_PROBE_ATTEMPTS
+        self._lock = threading.Lock()
+        self.benchmarks = 0
+        self.queries = 0
+    
+    def benchmark(self) -> Dict:
+        """Benchmark the resolvers from synchronous code"""
+        return get_async_runner().run(self.abenchmark(), timeout=self.timeout + 5)
+    
+    async def abenchmark(self) -> Dict:
+        """Query every resolver in parallel and rank them"""
+        started = time.monotonic()
+        resolvers = self._resolvers()
+        missing_name = f'{secrets.token_hex(6)}.invalid'
+        reports = await asyncio.gather(*(self._benchmark_resolver(resolver, missing_name) for resolver in resolvers))
+        
+        # Healthy resolvers first, fastest first within each group
+        reports.sort(key=lambda report: (not report['healthy'], (report.get('rtt_ms') or {}).get('avg', float('inf'))))
+        recommended = next((report for report in reports if report['healthy']), None)
+        with self._lock:
+            self.benchmarks += 1
+        return {
+            'resolvers': reports,
+            'recommended': recommended and {
+                'address': recommended['address'],
+                'name': recommended['name'],
+                'avg_ms': recommended['rtt_ms']['avg']
+            },
+            'recommendation': self._recommend(reports, recommended),
+            'elapsed': round(time.monotonic() - started, 3)
+        }
+    
+    def check_resolution(self, name='google.com', timeout=None) -> bool:
+        """Quick health check: does any configured resolver answer name within timeout?"""
+        return get_async_runner().run(self._acheck_resolution(name, timeout or self.timeout), timeout=(timeout or self.timeout) + 5)
+    
+    async def _acheck_resolution(self, name, timeout):
+        resolvers = [resolver for resolver in self._resolvers() if resolver.system]
+        if not resolvers:
+            # No resolv.conf (e.g. Windows): ask the OS resolver, but never wait longer than timeout
+            try:
+                loop = asyncio.get_running_loop()
+                return bool(await asyncio.wait_for(loop.getaddrinfo(name, None), timeout))
+            except (OSError, asyncio.TimeoutError):
+                return False
+        answers = await asyncio.gather(*(self._query(resolver, name, timeout) for resolver in resolvers))
+        return any(answer and answer['rcode'] == 'NOERROR' and answer['addresses'] for _, answer in answers)
+    
+    def _resolvers(self):
+        return self.resolvers if self.resolvers is not None else default_resolvers()
+    
+    def get_stats(self):
+        """Get benchmark and query counts"""
+        with self._lock:
+            return {'benchmarks': self.benchmarks, 'queries': self.queries}
+    
+    async def _query(self, resolver, name, timeout=None):
+        """One query; returns (rtt ms or None, response or None)"""
+        started = time.perf_counter()
+        with self._lock:
+            self.queries += 1
+        try:
+            response = await asyncio.wait_for(dns_query(resolver.address, name, resolver.port), timeout or self.timeout)
+        except (OSError, asyncio.TimeoutError):
+            return None, None
+        return (time.perf_counter() - started) * 1000, response
+    
+    async def _benchmark_resolver(self, resolver, missing_name):
+        queries = [(name, self._query(resolver, name)) for name in self.names for _ in range(self.attempts)]
+        outcomes = await asyncio.gather(self._query(resolver, missing_name), *(query for _, query in queries))
+        missing_outcome, outcomes = outcomes[0], outcomes[1:]
+        
+        issues = []
+        for (name, _), (rtt, response) in zip(queries, outcomes):
+            if response is None:
+                continue
+            if response['rcode'] != 'NOERROR' or not response['addresses']:
+                issues.append(f"{name}: {response['rcode'] if response['rcode'] != 'NOERROR' else 'no addresses'}")
+            elif any(_bogus_address(address) for address in response['addresses']):
+                issues.append(f"{name}: answered with non-public address {response['addresses'][0]}")
+        missing_response = missing_outcome[1]
+        if missing_response is not None and missing_response['rcode'] != 'NXDOMAIN':
+            issues.append(f"answers for names that do not exist ({missing_response['rcode']})")
+        
+        report = {'address': resolver.address, 'name': resolver.name, 'system': resolver.system}
+        report.update(summarize_rtts([rtt for rtt, _ in outcomes]))
+        if report['received'] == 0:
+            issues.append('no response')
+        report['issues'] = list(dict.fromkeys(issues))
+        report['healthy'] = not report['issues'] and report['loss_pct'] < 50
+        return report
+    
+    @staticmethod
+    def _recommend(reports, recommended) -> str:
+        if recommended is None:
+            return "No DNS resolver answered correctly. Check the network connection before changing DNS settings."
+        current = [report for report in reports if report['system']]
+        label = f"{recommended['name']} ({recommended['address']})"
+        if recommended['system']:
+            return f"Your current DNS resolver {recommended['address']} is healthy and the fastest ({recommended['rtt_ms']['avg']} ms)."
+        if not current:
+            return f"The fastest healthy DNS resolver is {label} at {recommended['rtt_ms']['avg']} ms."
+        system = current[0]
+        if not system['healthy']:
+            return (f"Your current DNS resolver {system['address']} has problems ({'; '.join(system['issues'])}). "
+                    f"Switch to {label}, which answered correctly in {recommended['rtt_ms']['avg']} ms.")
+        if system['rtt_ms']['avg'] - recommended['rtt_ms']['avg'] < Config.DNS_SWITCH_MIN_GAIN_MS:
+            return (f"Your current DNS resolver {system['address']} is healthy ({system['rtt_ms']['avg']} ms); "
+                    f"{label} is only marginally faster, so there is no need to change it.")
+        return (f"{label} answers in {recommended['rtt_ms']['avg']} ms versus {system['rtt_ms']['avg']} ms "
+                f"for your current resolver {system['address']}; switching DNS may speed up browsing.")
@@ -0,0 +1,192 @@
+import logging
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+FINISHED_STATES = (SUCCEEDED, FAILED, CANCELLED)
+
+class JobQueueFull(Exception):
+    """Raised by JobManager.submit when too many jobs are already waiting"""
+
+@dataclass
+class Job:
+    """A command submitted to run in the background"""
+    id: str
+    command: str
+    description: str = ''
+    session_id: str = None
+    diagnostic: bool = False
+    status: str = QUEUED
+    submitted_at: float = field(default_factory=time.time)
+    started_at: float = None
+    finished_at: float = None
+    result: dict = None
+    resources: dict = None
+    output_lines: deque = None
+    line_count: int = 0
+    cancel: threading.Event = field(default_factory=threading.Event)
+    future: object = None
+    
+    def to_dict(self, include_result=True):
+        """JSON-ready status; the result is included once the job has finished"""
+        data = {
+            'job_id': self.id,
+            'command': self.command,
+            'description': self.description,
+            'status': self.status,
+            'submitted_at': self.submitted_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'line_count': self.line_count,
+            'recent_output': list(self.output_lines or ()),
+            'resources': self.resources
+        }
+        if include_result and self.result is not None:
+            data.update({
+                'success': self.result.get('success', False),
+                'output': self.result.get('output', ''),
+                'error': self.result.get('error', ''),
+                'requires_password': self.result.get('requires_password', False)
+            })
+        return data
+
+class JobManager:
+    """Runs long commands on a bounded worker pool instead of a request thread
+    
+    ``submit`` returns a job at once; callers poll ``get`` for status, recent
+    output and, when finished, the result. ``execute(job, on_output, cancel)``
+    does the actual work and returns the usual command result dict. Queued
+    jobs are capped at ``max_pending`` and finished jobs are forgotten after
+    ``retention`` seconds. Each job records wall time, the worker's CPU time
+    and, for spawned commands, the CPU and peak memory of its processes.
+    """
+    
+    def __init__(self, execute, workers=None, max_pending=None, retention=None, output_lines=None):
+        self.execute = execute
+        self.workers = workers or Config.JOB_WORKERS
+        self.max_pending = max_pending or Config.JOB_MAX_PENDING
+        self.retention = retention or Config.JOB_RETENTION
+        self.output_lines = output_lines or Config.JOB_OUTPUT_LINES
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='command-job')
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self.counts = {'submitted': 0, 'rejected': 0, SUCCEEDED: 0, FAILED: 0, CANCELLED: 0}
+    
+    def submit(self, command, description='', session_id=None, diagnostic=False):
+        """Queue a command and return its Job without waiting for it to run"""
+        with self._lock:
+            self._prune()
+            pending = sum(1 for job in self._jobs.values() if job.status == QUEUED)
+            if pending >= self.max_pending:
+                self.counts['rejected'] += 1
+                raise JobQueueFull(f'{pending} jobs are already waiting')
+            
+            job = Job(
+                id=str(uuid.uuid4()), command=command, description=description,
+                session_id=session_id, diagnostic=diagnostic,
+                output_lines=deque(maxlen=self.output_lines)
+            )
+            self._jobs[job.id] = job
+            self.counts['submitted'] += 1
+            job.future = self.executor.submit(self._run, job)
+        
+        logger.info(f"Queued job {job.id}: {command}")
+        return job
+    
+    def get(self, job_id):
+        """Get a job by id, or None if it is unknown or has been forgotten"""
+        with self._lock:
+            return self._jobs.get(job_id)
+    
+    def cancel(self, job_id):
+        """Cancel a job; a running job has its whole process tree killed
+        
+        Returns the job, or None if it is unknown. Finished jobs are left as they are.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.status in FINISHED_STATES:
+                return job
+            job.cancel.set()
+            if job.status == QUEUED and job.future.cancel():
+                self._finish(job, CANCELLED, {'success': False, 'output': '', 'error': 'Command cancelled'})
+        return job
+    
+    def get_stats(self):
+        """Get job counts by state and pool sizing"""
+        with self._lock:
+            self._prune()
+            states = {}
+            for job in self._jobs.values():
+                states[job.status] = states.get(job.status, 0) + 1
+            return {
+                'workers': self.workers,
+                'max_pending': self.max_pending,
+                'jobs': states,
+                'totals': dict(self.counts)
+            }
+    
+    def shutdown(self):
+        """Cancel every unfinished job and stop the worker pool"""
+        with self._lock:
+            job_ids = list(self._jobs)
+        for job_id in job_ids:
+            self.cancel(job_id)
+        self.executor.shutdown(wait=True)
+    
+    def _run(self, job):
+        with self._lock:
+            if job.cancel.is_set():
+                self._finish(job, CANCELLED, {'success': False, 'output': '', 'error': 'Command cancelled'})
+                return
+            job.status = RUNNING
+            job.started_at = time.time()
+        
+        def on_output(lines):
+            with self._lock:
+                job.output_lines.extend(item['line'] for item in lines)
+                job.line_count += len(lines)
+        
+        started = time.monotonic()
+        worker_cpu = time.thread_time()
+        try:
+            result = self.execute(job, on_output, job.cancel)
+        except Exception as e:
+            logger.error(f"Error running job {job.id}: {str(e)}")
+            result = {'success': False, 'output': '', 'error': f'Command execution failed: {str(e)}'}
+        
+        resources = dict(result.get('resources') or {})
+        resources['wall_time'] = round(time.monotonic() - started, 3)
+        # In-process work such as native commands shows up only here
+        resources['worker_cpu'] = round(time.thread_time() - worker_cpu, 3)
+        with self._lock:
+            job.resources = resources
+            if job.cancel.is_set():
+                status = CANCELLED
+            else:
+                status = SUCCEEDED if result.get('success') else FAILED
+            self._finish(job, status, result)
+        logger.info(f"Job {job.id} {status} in {resources['wall_time']}s")
+    
+    def _finish(self, job, status, result):
+        job.status = status
+        job.result = result
+        job.finished_at = time.time()
+        self.counts[status] += 1
+    
+    def _prune(self):
+        cutoff = time.time() - self.retention
+        expired = [job_id for job_id, job in self._jobs.items() if job.finished_at and job.finished_at < cutoff]
+        for job_id in expired:
+            del self._jobs[job_id]
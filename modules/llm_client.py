@@ -0,0 +1,273 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+import httpx
+import openai
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# Errors that indicate the upstream is slow or unhealthy and are worth retrying
+RETRYABLE_ERRORS = (
+    openai.APIConnectionError,
+    openai.APITimeoutError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+)
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling OpenAI while the circuit breaker is open"""
+
+class CircuitBreaker:
+    """Fails fast after repeated upstream failures
+    
+    After ``failure_threshold`` consecutive failures the breaker opens and
+    rejects calls for ``recovery_timeout`` seconds. It then lets a single trial
+    call through (half-open); success closes it again, failure re-opens it.
+    """
+    
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+    
+    def __init__(self, failure_threshold=None, recovery_timeout=None):
+        self.failure_threshold = failure_threshold or Config.CIRCUIT_FAILURE_THRESHOLD
+        self.recovery_timeout = recovery_timeout or Config.CIRCUIT_RECOVERY_TIMEOUT
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.times_opened = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+    
+    def allow_request(self):
+        """Check if a call may go upstream right now"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.recovery_timeout:
+                self.state = self.HALF_OPEN
+                self.trial_in_flight = False
+            if self.state == self.HALF_OPEN and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return True
+            self.rejected += 1
+            return False
+    
+    def record_success(self):
+        """Record a successful upstream call"""
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info("OpenAI circuit breaker closed")
+            self.state = self.CLOSED
+            self.consecutive_failures = 0
+            self.trial_in_flight = False
+    
+    def record_failure(self):
+        """Record a failed upstream call"""
+        with self._lock:
+            self.consecutive_failures += 1
+            self.trial_in_flight = False
+            if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.times_opened += 1
+                    logger.warning(f"OpenAI circuit breaker opened after {self.consecutive_failures} failures")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+    
+    def release(self):
+        """Release a half-open trial slot without judging upstream health"""
+        with self._lock:
+            self.trial_in_flight = False
+    
+    def get_stats(self):
+        """Get circuit breaker statistics"""
+        return {
+            'state': self.state,
+            'consecutive_failures': self.consecutive_failures,
+            'failure_threshold': self.failure_threshold,
+            'recovery_timeout': self.recovery_timeout,
+            'times_opened': self.times_opened,
+            'rejected_calls': self.rejected
+        }
+
+def backoff_delay(attempt):
+    """Full-jitter exponential backoff for the given retry attempt (0-based)"""
+    ceiling = min(Config.OPENAI_RETRY_MAX_DELAY, Config.OPENAI_RETRY_BASE_DELAY * (2 ** attempt))
+    return random.uniform(0, ceiling)
+
+class LLMClient:
+    """Shared OpenAI client with pooled connections, deadlines, retries and a circuit breaker"""
+    
+    def __init__(self, api_key=None, breaker=None):
+        self.api_key = api_key or Config.OPENAI_API_KEY
+        self.breaker = breaker or CircuitBreaker()
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+        self.max_concurrency = Config.LLM_MAX_CONCURRENCY
+        self.async_in_flight = 0
+        self.async_waiting = 0
+        self.async_peak_in_flight = 0
+        self._async_client = None
+        self._async_loop = None
+        self._semaphore = None
+        try:
+            self.http_client = openai.DefaultHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=Config.OPENAI_MAX_CONNECTIONS,
+                    max_keepalive_connections=Config.OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=Config.OPENAI_KEEPALIVE_EXPIRY
+                ),
+                timeout=httpx.Timeout(Config.OPENAI_TIMEOUT, connect=Config.OPENAI_CONNECT_TIMEOUT)
+            )
+            # Retries are handled here so they share one deadline and feed the breaker
+            self.client = openai.OpenAI(
+                api_key=self.api_key,
+                http_client=self.http_client,
+                max_retries=0
+            )
+        except Exception as e:
+            logger.error(f"Error initializing OpenAI client: {str(e)}")
+            self.http_client = None
+            self.client = None
+    
+    @property
+    def available(self):
+        """Check if an OpenAI client could be created"""
+        return self.client is not None
+    
+    def chat_completion(self, timeout=None, **kwargs):
+        """Create a chat completion within a deadline, retrying transient failures with jitter
+        
+        Raises CircuitOpenError without calling upstream while the breaker is open.
+        With ``stream=True`` the retries cover opening the stream only.
+        """
+        if self.client is None:
+            raise RuntimeError("OpenAI client is not configured")
+        if not self.breaker.allow_request():
+            raise CircuitOpenError("OpenAI is temporarily unavailable (circuit open)")
+        
+        deadline = time.monotonic() + (timeout or Config.OPENAI_TIMEOUT)
+        attempt = 0
+        while True:
+            self.calls += 1
+            remaining = deadline - time.monotonic()
+            try:
+                response = self.client.chat.completions.create(timeout=max(remaining, 0.1), **kwargs)
+                self.breaker.record_success()
+                return response
+            except RETRYABLE_ERRORS as e:
+                delay = backoff_delay(attempt)
+                if attempt >= Config.OPENAI_MAX_RETRIES or time.monotonic() + delay >= deadline:
+                    self.failures += 1
+                    self.breaker.record_failure()
+                    raise
+                attempt += 1
+                self.retries += 1
+                logger.warning(f"OpenAI call failed ({type(e).__name__}), retry {attempt} in {delay:.2f}s")
+                time.sleep(delay)
+            except Exception:
+                # Client-side errors (bad request, auth) say nothing about upstream health
+                self.failures += 1
+                self.breaker.release()
+                raise
+    
+    async def achat_completion(self, timeout=None, **kwargs):
+        """Async chat_completion: same deadline, retries and breaker, plus a concurrency cap
+        
+        At most ``LLM_MAX_CONCURRENCY`` calls are upstream at once; the rest wait
+        on a semaphore, and that wait counts against the call's deadline.
+        """
+        if self.client is None:
+            raise RuntimeError("OpenAI client is not configured")
+        client, semaphore = self._get_async_resources()
+        
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + (timeout or Config.OPENAI_TIMEOUT)
+        self.async_waiting += 1
+        try:
+            await asyncio.wait_for(semaphore.acquire(), timeout=max(deadline - loop.time(), 0.1))
+        finally:
+            self.async_waiting -= 1
+        
+        self.async_in_flight += 1
+        self.async_peak_in_flight = max(self.async_peak_in_flight, self.async_in_flight)
+        try:
+            if not self.breaker.allow_request():
+                raise CircuitOpenError("OpenAI is temporarily unavailable (circuit open)")
+            
+            attempt = 0
+            while True:
+                self.calls += 1
+                remaining = deadline - loop.time()
+                try:
+                    response = await client.chat.completions.create(timeout=max(remaining, 0.1), **kwargs)
+                    self.breaker.record_success()
+                    return response
+                except RETRYABLE_ERRORS as e:
+                    delay = backoff_delay(attempt)
+                    if attempt >= Config.OPENAI_MAX_RETRIES or loop.time() + delay >= deadline:
+                        self.failures += 1
+                        self.breaker.record_failure()
+                        raise
+                    attempt += 1
+                    self.retries += 1
+                    logger.warning(f"OpenAI call failed ({type(e).__name__}), retry {attempt} in {delay:.2f}s")
+                    await asyncio.sleep(delay)
+                except Exception:
+                    self.failures += 1
+                    self.breaker.release()
+                    raise
+        finally:
+            self.async_in_flight -= 1
+            semaphore.release()
+    
+    def _get_async_resources(self):
+        """Get the async client and semaphore bound to the running event loop"""
+        loop = asyncio.get_running_loop()
+        if self._async_loop is not loop:
+            self._async_client = openai.AsyncOpenAI(
+                api_key=self.api_key,
+                http_client=openai.DefaultAsyncHttpxClient(
+                    limits=httpx.Limits(
+                        max_connections=max(Config.OPENAI_MAX_CONNECTIONS, self.max_concurrency),
+                        max_keepalive_connections=Config.OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+                        keepalive_expiry=Config.OPENAI_KEEPALIVE_EXPIRY
+                    ),
+                    timeout=httpx.Timeout(Config.OPENAI_TIMEOUT, connect=Config.OPENAI_CONNECT_TIMEOUT)
+                ),
+                max_retries=0
+            )
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._async_loop = loop
+        return self._async_client, self._semaphore
+    
+    def get_stats(self):
+        """Get client statistics"""
+        return {
+            'available': self.available,
+            'calls': self.calls,
+            'retries': self.retries,
+            'failures': self.failures,
+            'max_concurrency': self.max_concurrency,
+            'async_in_flight': self.async_in_flight,
+            'async_waiting': self.async_waiting,
+            'async_peak_in_flight': self.async_peak_in_flight,
+            'circuit_breaker': self.breaker.get_stats()
+        }
+
+_llm_client = None
+_llm_client_lock = threading.Lock()
+
+def get_llm_client():
+    """Get the process-wide OpenAI client"""
+    global _llm_client
+    if _llm_client is None:
+        with _llm_client_lock:
+            if _llm_client is None:
+                _llm_client = LLMClient()
+    return _llm_client
@@ -0,0 +1,125 @@
+import json
+import logging
+import re
+import threading
+from dataclasses import dataclass
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# Closing or acknowledgement turns that need no troubleshooting
+ACKNOWLEDGEMENT_PATTERN = re.compile(
+    r"^\W*(?:ok(?:ay)?|thanks?(?: you)?|thx|ty|great|perfect|cool|awesome|got it|sounds good|"
+    r"(?:that |it )?(?:works?|worked|fixed it|solved it)(?: now)?|(?:all )?(?:good|set|done) now|yes|yep|sure)"
+    r"(?:[\s,.!]+(?:thanks?(?: you)?|thx|it works?|that worked|now|so much|a lot|!+))*\W*$",
+    re.IGNORECASE
+)
+
+# Short negative replies, usually to "did that fix it?": the issue is still open
+STILL_BROKEN_PATTERN = re.compile(r"^\W*(?:no|nope|nah|not really|still (?:not|broken|the same))\b", re.IGNORECASE)
+
+# Categories from AutomatedDiagnostics.categorize_user_issue that need real diagnosis
+TECHNICAL_CATEGORIES = ('network', 'performance', 'storage', 'system')
+
+@dataclass
+class RouteDecision:
+    """Which model tier a turn is sent to and why"""
+    tier: str
+    model: str
+    reason: str
+
+def is_valid_reply(text):
+    """Check a reply is the JSON object the system prompt asks for"""
+    try:
+        parsed = json.loads(text or '')
+    except (TypeError, ValueError):
+        return False
+    return isinstance(parsed, dict) and isinstance(parsed.get('response'), str) and bool(parsed['response'])
+
+class ModelRouter:
+    """Routes each chat turn to a small or large model tier
+    
+    Acknowledgements and short follow-ups in a shallow conversation go to the
+    small tier; new issues, technical categories, long messages and deep
+    conversations go to the large tier (GPT-4o). A small-tier reply that is
+    not valid JSON is escalated to the large tier by the caller. Latency and
+    token usage are recorded per tier.
+    """
+    
+    def __init__(self, tiers=None, enabled=None):
+        self.tiers = tiers or Config.MODEL_TIERS
+        self.enabled = Config.MODEL_ROUTING_ENABLED if enabled is None else enabled
+        self._lock = threading.Lock()
+        self._metrics = {tier: self._empty_metrics() for tier in self.tiers}
+        self.reasons = {}
+    
+    def route(self, user_message, category, history_depth):
+        """Pick the tier for a turn from its category, length and history depth"""
+        message = (user_message or '').strip()
+        if not self.enabled:
+            tier, reason = 'large', 'routing disabled'
+        elif STILL_BROKEN_PATTERN.match(message):
+            tier, reason = 'large', 'issue still open'
+        elif ACKNOWLEDGEMENT_PATTERN.match(message):
+            tier, reason = 'small', 'acknowledgement'
+        elif len(message) > Config.ROUTING_SMALL_MAX_CHARS:
+            tier, reason = 'large', 'long message'
+        elif category in TECHNICAL_CATEGORIES:
+            tier, reason = 'large', f'{category} issue'
+        elif history_depth == 0:
+            tier, reason = 'large', 'new conversation'
+        elif history_depth > Config.ROUTING_SMALL_MAX_HISTORY:
+            tier, reason = 'large', 'deep conversation'
+        else:
+            tier, reason = 'small', 'short follow-up'
+        
+        with self._lock:
+            self.reasons[reason] = self.reasons.get(reason, 0) + 1
+        return RouteDecision(tier, self.tiers[tier], reason)
+    
+    def escalate(self, decision):
+        """The large-tier decision used when a small-tier reply is unusable"""
+        with self._lock:
+            self._metrics[decision.tier]['escalations'] += 1
+        logger.warning(f"Escalating turn from {decision.model} to {self.tiers['large']}: invalid JSON reply")
+        return RouteDecision('large', self.tiers['large'], f'escalated from {decision.tier}')
+    
+    def record(self, tier, latency, usage=None):
+        """Record one completed call on a tier"""
+        with self._lock:
+            metrics = self._metrics[tier]
+            metrics['calls'] += 1
+            metrics['latency_total'] += latency
+            metrics['latency_max'] = max(metrics['latency_max'], latency)
+            for field in ('prompt_tokens', 'completion_tokens'):
+                value = getattr(usage, field, None)
+                if isinstance(value, int):
+                    metrics[field] += value
+    
+    def get_stats(self):
+        """Get per-tier call, latency and token metrics"""
+        with self._lock:
+            tiers = {}
+            for tier, metrics in self._metrics.items():
+                calls = metrics['calls']
+                tiers[tier] = {
+                    'model': self.tiers[tier],
+                    'calls': calls,
+                    'escalations': metrics['escalations'],
+                    'avg_latency': round(metrics['latency_total'] / calls, 3) if calls else 0.0,
+                    'max_latency': round(metrics['latency_max'], 3),
+                    'prompt_tokens': metrics['prompt_tokens'],
+                    'completion_tokens': metrics['completion_tokens']
+                }
+            return {'enabled': self.enabled, 'tiers': tiers, 'reasons': dict(self.reasons)}
+    
+    @staticmethod
+    def _empty_metrics():
+        return {
+            'calls': 0,
+            'escalations': 0,
+            'latency_total': 0.0,
+            'latency_max': 0.0,
+            'prompt_tokens': 0,
+            'completion_tokens': 0
+        }
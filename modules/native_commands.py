@@ -0,0 +1,368 @@
+import getpass
+import logging
+import math
+import os
+import platform
+import re
+import socket
+import subprocess
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Callable, Tuple
+import psutil
+from config import Config
+from modules.process_runner import BoundedCapture
+
+try:
+    import pwd
+except ImportError:
+    pwd = None  # Windows: process owners are shown as numeric ids
+
+logger = logging.getLogger(__name__)
+
+# Characters ps prints as '?' in command lines
+CONTROL_CHARS = re.compile(r'[\x00-\x1f\x7f]')
+
+# psutil TCP status -> netstat state column
+TCP_STATES = {
+    psutil.CONN_ESTABLISHED: 'ESTABLISHED',
+    psutil.CONN_SYN_SENT: 'SYN_SENT',
+    psutil.CONN_SYN_RECV: 'SYN_RECV',
+    psutil.CONN_FIN_WAIT1: 'FIN_WAIT1',
+    psutil.CONN_FIN_WAIT2: 'FIN_WAIT2',
+    psutil.CONN_TIME_WAIT: 'TIME_WAIT',
+    psutil.CONN_CLOSE: 'CLOSE',
+    psutil.CONN_CLOSE_WAIT: 'CLOSE_WAIT',
+    psutil.CONN_LAST_ACK: 'LAST_ACK',
+    psutil.CONN_LISTEN: 'LISTEN',
+    psutil.CONN_CLOSING: 'CLOSING'
+}
+
+def _human_size(value, suffix='i'):
+    """Format bytes like GNU tools' -h flag: 1024-based, one decimal below 10, rounded up"""
+    if value < 1024:
+        return f"{int(value)}B"
+    for unit in 'KMGTPE':
+        value /= 1024
+        if value < 1024 or unit == 'E':
+            if value < 10:
+                return f"{math.ceil(value * 10) / 10:.1f}{unit}{suffix}"
+            return f"{math.ceil(value)}{unit}{suffix}"
+
+def native_df(human=True):
+    """df / df -h from psutil.disk_partitions and disk_usage"""
+    if human:
+        lines = [f"{'Filesystem':<15} {'Size':>5} {'Used':>5} {'Avail':>5} {'Use%':>4} Mounted on"]
+    else:
+        lines = [f"{'Filesystem':<15} {'1K-blocks':>10} {'Used':>10} {'Available':>10} {'Use%':>4} Mounted on"]
+    for partition in psutil.disk_partitions(all=False):
+        try:
+            usage = psutil.disk_usage(partition.mountpoint)
+        except OSError:
+            continue
+        # df rounds the percentage up over the space available to unprivileged users
+        capacity = usage.used + usage.free
+        use_pct = f"{math.ceil(100 * usage.used / capacity)}%" if capacity else '-'
+        if human:
+            lines.append(
+                f"{partition.device:<15} {_human_size(usage.total, ''):>5} {_human_size(usage.used, ''):>5} "
+                f"{_human_size(usage.free, ''):>5} {use_pct:>4} {partition.mountpoint}"
+            )
+        else:
+            lines.append(
+                f"{partition.device:<15} {usage.total // 1024:>10} {usage.used // 1024:>10} "
+                f"{usage.free // 1024:>10} {use_pct:>4} {partition.mountpoint}"
+            )
+    return '\n'.join(lines) + '\n'
+
+def native_free(human=True):
+    """free / free -h from psutil.virtual_memory and swap_memory"""
+    memory = psutil.virtual_memory()
+    swap = psutil.swap_memory()
+    size = _human_size if human else (lambda value: str(value // 1024))
+    buff_cache = getattr(memory, 'buffers', 0) + getattr(memory, 'cached', 0)
+    header = ''.join(f"{column:>12}" for column in ('total', 'used', 'free', 'shared', 'buff/cache', 'available'))
+    mem_row = ''.join(f"{size(value):>12}" for value in (
+        memory.total, memory.used, memory.free, getattr(memory, 'shared', 0), buff_cache, memory.available
+    ))
+    swap_row = ''.join(f"{size(value):>12}" for value in (swap.total, swap.used, swap.free))
+    return f"{'':<8}{header}\n{'Mem:':<8}{mem_row}\n{'Swap:':<8}{swap_row}\n"
+
+def native_uptime():
+    """uptime from psutil.boot_time, users and getloadavg"""
+    seconds = int(time.time() - psutil.boot_time())
+    days, remainder = divmod(seconds, 86400)
+    hours, minutes = divmod(remainder // 60, 60)
+    parts = []
+    if days:
+        parts.append(f"{days} day{'s' if days != 1 else ''}")
+    parts.append(f"{hours:2d}:{minutes:02d}" if hours else f"{minutes} min")
+    users = len(psutil.users())
+    load = ', '.join(f"{value:.2f}" for value in os.getloadavg())
+    return (
+        f" {datetime.now():%H:%M:%S} up {',  '.join(parts)},  {users} user{'s' if users != 1 else ''},  "
+        f"load average: {load}\n"
+    )
+
+def native_ps(limit=None):
+    """ps aux from /proc, optionally sorted by CPU and cut to ``limit`` rows like ``--sort=-%cpu | head``
+    
+    Reads /proc/<pid>/stat and cmdline directly, as ps does; psutil.process_iter
+    costs more per process than spawning ps itself.
+    """
+    now = time.time()
+    today = datetime.now().date()
+    boot_time = psutil.boot_time()
+    total_memory = psutil.virtual_memory().total
+    clock_ticks = os.sysconf('SC_CLK_TCK')
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    users = {}
+    rows = []
+    for entry in os.scandir('/proc'):
+        if not entry.name.isdigit():
+            continue
+        try:
+            uid = entry.stat().st_uid
+            with open(f"/proc/{entry.name}/stat", 'rb') as handle:
+                stat = handle.read()
+            with open(f"/proc/{entry.name}/cmdline", 'rb') as handle:
+                cmdline = handle.read()
+        except OSError:
+            continue  # the process exited while we were reading it
+        # The command name is parenthesized and may itself contain spaces or parentheses
+        name_end = stat.rfind(b')')
+        name = stat[stat.find(b'(') + 1:name_end].decode(errors='replace')
+        fields = stat[name_end + 2:].split()
+        cpu_seconds = (int(fields[11]) + int(fields[12])) / clock_ticks
+        created = boot_time + int(fields[19]) / clock_ticks
+        vsz = int(fields[20])
+        rss = int(fields[21]) * page_size
+        # Like ps, %CPU is CPU time over the process lifetime, not a fresh sample
+        cpu_pct = 100 * cpu_seconds / max(now - created, 1e-6)
+        if uid not in users:
+            try:
+                users[uid] = pwd.getpwuid(uid).pw_name if pwd else str(uid)
+            except KeyError:
+                users[uid] = str(uid)
+        started = datetime.fromtimestamp(created)
+        start = f"{started:%H:%M}" if started.date() == today else f"{started:%b%d}"
+        minutes, secs = divmod(int(cpu_seconds), 60)
+        # ps shows non-printable characters in arguments as '?'
+        command = CONTROL_CHARS.sub('?', cmdline.rstrip(b'\0').replace(b'\0', b' ').decode(errors='replace')) or f"[{name}]"
+        rows.append((cpu_pct, (
+            f"{users[uid][:10]:<10} {entry.name:>7} {cpu_pct:>4.1f} {100 * rss / total_memory:>4.1f} "
+            f"{vsz // 1024:>7} {rss // 1024:>6} {_tty_name(int(fields[4])):<8} {fields[0].decode():<4} "
+            f"{start:>5} {minutes:>3}:{secs:02d} {command}"
+        )))
+    if limit:
+        rows.sort(key=lambda row: row[0], reverse=True)
+        rows = rows[:limit - 1]
+    header = f"{'USER':<10} {'PID':>7} {'%CPU':>4} {'%MEM':>4} {'VSZ':>7} {'RSS':>6} {'TTY':<8} {'STAT':<4} {'START':>5} {'TIME':>6} COMMAND"
+    return '\n'.join([header] + [line for _, line in rows]) + '\n'
+
+def _tty_name(tty_nr):
+    """Decode the controlling terminal device number from /proc/<pid>/stat"""
+    major = (tty_nr >> 8) & 0xfff
+    minor = (tty_nr & 0xff) | ((tty_nr >> 12) & 0xfff00)
+    if 136 <= major <= 143:
+        return f"pts/{(major - 136) * 256 + minor}"
+    if major == 4 and minor < 64:
+        return f"tty{minor}"
+    return '?'
+
+def native_netstat():
+    """netstat -an (internet sockets) from psutil.net_connections"""
+    lines = [
+        'Active Internet connections (servers and established)',
+        f"{'Proto':<5} {'Recv-Q':>6} {'Send-Q':>6} {'Local Address':<23} {'Foreign Address':<23} State"
+    ]
+    for connection in psutil.net_connections(kind='inet'):
+        tcp = connection.type == socket.SOCK_STREAM
+        proto = ('tcp' if tcp else 'udp') + ('6' if connection.family == socket.AF_INET6 else '')
+        wildcard = '::' if connection.family == socket.AF_INET6 else '0.0.0.0'
+        local = f"{connection.laddr.ip}:{connection.laddr.port}" if connection.laddr else f"{wildcard}:*"
+        remote = f"{connection.raddr.ip}:{connection.raddr.port}" if connection.raddr else f"{wildcard}:*"
+        state = TCP_STATES.get(connection.status, '') if tcp else ''
+        # Queue sizes are not exposed by psutil
+        lines.append(f"{proto:<5} {0:>6} {0:>6} {local:<23} {remote:<23} {state}".rstrip())
+    return '\n'.join(lines) + '\n'
+
+def native_ip_addr():
+    """ip addr from psutil.net_if_addrs and net_if_stats"""
+    addresses = psutil.net_if_addrs()
+    stats = psutil.net_if_stats()
+    lines = []
+    for name in sorted(addresses, key=lambda name: _interface_index(name)):
+        stat = stats.get(name)
+        # ip reports carrier as LOWER_UP rather than RUNNING
+        flags = [flag.upper() for flag in (getattr(stat, 'flags', '') or '').split(',') if flag and flag != 'running']
+        loopback = 'LOOPBACK' in flags or name == 'lo'
+        if stat and stat.isup and 'LOWER_UP' not in flags:
+            flags.append('LOWER_UP')
+        state = 'UNKNOWN' if loopback else ('UP' if stat and stat.isup else 'DOWN')
+        lines.append(f"{_interface_index(name)}: {name}: <{','.join(flags)}> mtu {stat.mtu if stat else 0} state {state}")
+        # ip lists the link layer address first, then IPv4, then IPv6
+        family_order = {psutil.AF_LINK: 0, socket.AF_INET: 1, socket.AF_INET6: 2}
+        for address in sorted(addresses[name], key=lambda address: family_order.get(address.family, 3)):
+            scope = 'host' if loopback else 'global'
+            if address.family == psutil.AF_LINK:
+                kind = 'loopback' if loopback else 'ether'
+                broadcast = address.broadcast or ('00:00:00:00:00:00' if loopback else 'ff:ff:ff:ff:ff:ff')
+                lines.append(f"    link/{kind} {address.address} brd {broadcast}")
+            elif address.family == socket.AF_INET:
+                broadcast = f" brd {address.broadcast}" if address.broadcast else ''
+                lines.append(f"    inet {address.address}/{_prefix_length(address.netmask)}{broadcast} scope {scope} {name}")
+            elif address.family == socket.AF_INET6:
+                ip = address.address.split('%')[0]
+                if ip.lower().startswith('fe80'):
+                    scope = 'link'
+                lines.append(f"    inet6 {ip}/{_prefix_length(address.netmask)} scope {scope}")
+    return '\n'.join(lines) + '\n'
+
+def _interface_index(name):
+    try:
+        return socket.if_nametoindex(name)
+    except OSError:
+        return 0
+
+def _prefix_length(netmask):
+    if not netmask:
+        return 0
+    if ':' in netmask:
+        return sum(bin(int(group, 16)).count('1') for group in netmask.split(':') if group)
+    return sum(bin(int(octet)).count('1') for octet in netmask.split('.'))
+
+def _read_file(path):
+    with open(path) as handle:
+        return handle.read()
+
+@dataclass
+class NativeCommand:
+    """An allowlisted read-only command answered in-process"""
+    command: str
+    platforms: Tuple[str, ...]
+    handler: Callable[[], str]
+
+# Output mimics the GNU/Linux tools, so most entries are Linux-only
+NATIVE_COMMANDS = [
+    NativeCommand('df -h', ('linux',), native_df),
+    NativeCommand('df', ('linux',), lambda: native_df(human=False)),
+    NativeCommand('free -h', ('linux',), native_free),
+    NativeCommand('free', ('linux',), lambda: native_free(human=False)),
+    NativeCommand('uptime', ('linux',), native_uptime),
+    NativeCommand('ps aux', ('linux',), native_ps),
+    NativeCommand('ps aux --sort=-%cpu | head -20', ('linux',), lambda: native_ps(limit=20)),
+    NativeCommand('netstat -an', ('linux',), native_netstat),
+    NativeCommand('ip addr', ('linux',), native_ip_addr),
+    NativeCommand('cat /proc/meminfo', ('linux',), lambda: _read_file('/proc/meminfo')),
+    NativeCommand('cat /proc/cpuinfo', ('linux',), lambda: _read_file('/proc/cpuinfo')),
+    NativeCommand('hostname', ('linux', 'darwin', 'windows'), lambda: socket.gethostname() + '\n'),
+    NativeCommand('whoami', ('linux', 'darwin'), lambda: getpass.getuser() + '\n'),
+]
+
+class NativeCommands:
+    """Answers common read-only commands in-process instead of spawning a shell
+    
+    ``execute`` returns the same result dictionary as the subprocess path, with
+    output formatted like the real tool, or None when the command has no
+    native implementation on this OS (or the implementation fails) and must
+    be spawned.
+    """
+    
+    def __init__(self, os_type=None, enabled=None):
+        self.os_type = os_type or platform.system().lower()
+        self.enabled = Config.NATIVE_COMMANDS_ENABLED if enabled is None else enabled
+        self.registry = {
+            entry.command: entry for entry in NATIVE_COMMANDS if self.os_type in entry.platforms
+        }
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.failures = 0
+        self.total_time = 0.0
+    
+    def supports(self, command):
+        """Check if a command is answered natively on this OS"""
+        return self.enabled and self._normalize(command) in self.registry
+    
+    def execute(self, command):
+        """Run a command in-process, or return None to fall back to the shell"""
+        if not self.enabled:
+            return None
+        entry = self.registry.get(self._normalize(command))
+        if entry is None:
+            return None
+        
+        started = time.perf_counter()
+        try:
+            output = entry.handler()
+        except Exception as e:
+            logger.warning(f"Native `{entry.command}` failed, falling back to the shell: {str(e)}")
+            with self._lock:
+                self.failures += 1
+            return None
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.hits += 1
+            self.total_time += elapsed
+        # Same head + tail bound as spawned commands
+        capture = BoundedCapture(Config.COMMAND_OUTPUT_HEAD_BYTES, Config.COMMAND_OUTPUT_TAIL_BYTES)
+        capture.write(output.encode('utf-8', errors='replace'))
+        return {
+            'success': True,
+            'output': capture.text(),
+            'error': None,
+            'return_code': 0,
+            'execution_time': time.time(),
+            'native': True,
+            'output_bytes': capture.total,
+            'dropped_bytes': capture.dropped
+        }
+    
+    def get_stats(self):
+        """Get native execution counts and average latency"""
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'commands': sorted(self.registry),
+                'hits': self.hits,
+                'failures': self.failures,
+                'avg_ms': round(1000 * self.total_time / self.hits, 3) if self.hits else 0.0
+            }
+    
+    @staticmethod
+    def _normalize(command):
+        return ' '.join((command or '').split())
+
+def benchmark(commands=None, iterations=20):
+    """Compare native and spawned execution of each supported command
+    
+    Returns {command: {'native_ms', 'spawn_ms', 'speedup'}} with median timings.
+    """
+    native = NativeCommands(enabled=True)
+    results = {}
+    for command in commands or sorted(native.registry):
+        if not native.supports(command):
+            continue
+        native_times, spawn_times = [], []
+        for _ in range(iterations):
+            started = time.perf_counter()
+            native.execute(command)
+            native_times.append(time.perf_counter() - started)
+            started = time.perf_counter()
+            subprocess.run(command, shell=True, capture_output=True, text=True, timeout=Config.COMMAND_TIMEOUT)
+            spawn_times.append(time.perf_counter() - started)
+        native_ms = 1000 * sorted(native_times)[len(native_times) // 2]
+        spawn_ms = 1000 * sorted(spawn_times)[len(spawn_times) // 2]
+        results[command] = {
+            'native_ms': round(native_ms, 3),
+            'spawn_ms': round(spawn_ms, 3),
+            'speedup': round(spawn_ms / native_ms, 1) if native_ms else None
+        }
+    return results
+
+if __name__ == '__main__':
+    print(f"{'command':<34} {'native ms':>10} {'spawn ms':>10} {'speedup':>8}")
+    for command, timing in benchmark().items():
+        print(f"{command:<34} {timing['native_ms']:>10.3f} {timing['spawn_ms']:>10.3f} {timing['speedup'] or '-':>7}x")
@@ -1,52 +1,239 @@
-import subprocess
 import platform
 import logging
 import socket
+import threading
+import time
+import psutil
 import requests
 from config import Config
+from modules.deadline import DeadlineExceeded
+from modules.dns_probe import DnsProbe
+from modules.probe_engine import ProbeEngine, ProbeTarget, format_probe_result, read_system_resolvers
+from modules.process_runner import run_in_group
 
 logger = logging.getLogger(__name__)
 
-class NetworkTools:
-    """Network diagnostic and testing tools"""
-    
-    def __init__(self):
-        """Initialize network tools"""
-        self.os_type = platform.system().lower()
-    
-    def check_internet_connectivity(self):
-        """Check if internet is available"""
+def probe_internet_connectivity(timeout=3, deadline=None):
+    """Check if internet is available by opening a TCP connection to public DNS servers"""
+    for host in ("8.8.8.8", "8.8.4.4", "1.1.1.1"):
+        if deadline is not None:
+            if deadline.expired:
+                break
+            timeout = deadline.timeout(timeout)
         try:
-            # Try to connect to a reliable host
-            socket.create_connection(("8.8.8.8", 53), timeout=3)
+            # Google DNS, then its secondary, then Cloudflare DNS
+            connection = socket.create_connection((host, 53), timeout=timeout)
+            connection.close()
             return True
         except OSError:
             pass
+    
+    return False
+
+def probe_dns_resolution(timeout=3):
+    """Check if DNS resolution is working
+    
+    Queries the configured resolvers directly with a bounded wait instead of
+    gethostbyname, which can block for the system resolver's whole retry budget.
+    """
+    try:
+        return DnsProbe().check_resolution('google.com', timeout)
+    except Exception as e:
+        logger.warning(f"DNS resolution probe failed: {str(e)}")
+        return False
+
+class ConnectivityMonitor:
+    """Keeps connectivity and DNS state fresh in a background thread
+    
+    Request handlers read the last verdict without touching the network. The
+    monitor re-probes every ``poll_interval`` seconds, marks the verdict stale
+    once it is older than ``ttl`` and re-probes immediately when the set of
+    network interfaces or their addresses changes.
+    """
+    
+    def __init__(self, ttl=None, poll_interval=None, interface_poll_interval=None, probe_timeout=3):
+        self.ttl = ttl or Config.CONNECTIVITY_TTL
+        self.poll_interval = poll_interval or Config.CONNECTIVITY_POLL_INTERVAL
+        self.interface_poll_interval = interface_poll_interval or Config.INTERFACE_POLL_INTERVAL
+        self.probe_timeout = probe_timeout
         
-        try:
-            # Try to connect to Google DNS
-            socket.create_connection(("8.8.4.4", 53), timeout=3)
-            return True
-        except OSError:
-            pass
+        self._state = None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._interface_fingerprint = self._get_interface_fingerprint()
+        self.refresh_count = 0
+        self.invalidation_count = 0
+    
+    def start(self):
+        """Start the background monitor thread if it is not already running"""
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='connectivity-monitor', daemon=True)
+            self._thread.start()
+    
+    def stop(self):
+        """Stop the background monitor thread"""
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout=self.probe_timeout * 3 + 1)
+    
+    def get_status(self, deadline=None):
+        """Return the cached connectivity verdict"""
+        state = self._state
+        if state is None:
+            # Nothing probed yet: the very first caller pays for one probe
+            self.start()
+            wait = -1 if deadline is None else deadline.remaining()
+            if not self._refresh_lock.acquire(timeout=wait):
+                raise DeadlineExceeded("Deadline exceeded waiting for the first connectivity probe")
+            try:
+                state = self._state or self.refresh(deadline)
+            finally:
+                self._refresh_lock.release()
         
-        try:
-            # Try to connect to Cloudflare DNS
-            socket.create_connection(("1.1.1.1", 53), timeout=3)
-            return True
-        except OSError:
-            pass
+        age = time.time() - state['checked_at']
+        stale = age > self.ttl
+        if stale:
+            self._wake.set()
         
-        return False
+        status = dict(state)
+        status['age'] = round(age, 3)
+        status['stale'] = stale
+        return status
+    
+    def is_internet_available(self, deadline=None):
+        """Return the cached internet connectivity verdict"""
+        return self.get_status(deadline)['internet_available']
+    
+    def is_dns_working(self):
+        """Return the cached DNS resolution verdict"""
+        return self.get_status()['dns_working']
+    
+    def invalidate(self):
+        """Force a re-probe on the next monitor cycle"""
+        self.invalidation_count += 1
+        self._wake.set()
+    
+    def refresh(self, deadline=None):
+        """Probe connectivity and DNS now and store the result"""
+        internet_available = probe_internet_connectivity(self.probe_timeout, deadline)
+        if deadline is not None and deadline.expired:
+            raise DeadlineExceeded("Deadline exceeded during the connectivity probe")
+        dns_working = probe_dns_resolution(self.probe_timeout) if internet_available else False
+        state = {
+            'internet_available': internet_available,
+            'dns_working': dns_working,
+            'checked_at': time.time()
+        }
+        self._state = state
+        self.refresh_count += 1
+        return state
+    
+    def get_stats(self):
+        """Get monitor statistics"""
+        state = self._state
+        return {
+            'running': bool(self._thread and self._thread.is_alive()),
+            'ttl': self.ttl,
+            'poll_interval': self.poll_interval,
+            'refresh_count': self.refresh_count,
+            'invalidation_count': self.invalidation_count,
+            'last_checked_at': state['checked_at'] if state else None
+        }
+    
+    def _run(self):
+        """Background loop: re-probe on schedule, on invalidation or on interface changes"""
+        force = False
+        while not self._stop.is_set():
+            fingerprint = self._get_interface_fingerprint()
+            if fingerprint != self._interface_fingerprint:
+                logger.info("Network interfaces changed, refreshing connectivity state")
+                self._interface_fingerprint = fingerprint
+                self.invalidation_count += 1
+                force = True
+            
+            state = self._state
+            if force or state is None or time.time() - state['checked_at'] >= self.poll_interval:
+                try:
+                    with self._refresh_lock:
+                        # Skip if a request-triggered probe finished while we waited for the lock
+                        if self._state is state:
+                            self.refresh()
+                except Exception as e:
+                    logger.error(f"Error refreshing connectivity state: {str(e)}")
+                force = False
+            
+            if self._wake.wait(timeout=self.interface_poll_interval):
+                self._wake.clear()
+                force = not self._stop.is_set()
+    
+    def _get_interface_fingerprint(self):
+        """Summarise interface addresses and link state so changes can be detected"""
+        try:
+            addresses = psutil.net_if_addrs()
+            stats = psutil.net_if_stats()
+            return tuple(sorted(
+                (name, stats[name].isup if name in stats else None,
+                 tuple(sorted(address.address for address in addrs)))
+                for name, addrs in addresses.items()
+            ))
+        except Exception as e:
+            logger.debug(f"Unable to read network interfaces: {str(e)}")
+            return None
+
+_connectivity_monitor = None
+_connectivity_monitor_lock = threading.Lock()
+
+def get_connectivity_monitor():
+    """Get the process-wide connectivity monitor, starting it on first use"""
+    global _connectivity_monitor
+    if _connectivity_monitor is None:
+        with _connectivity_monitor_lock:
+            if _connectivity_monitor is None:
+                monitor = ConnectivityMonitor()
+                monitor.start()
+                _connectivity_monitor = monitor
+    return _connectivity_monitor
+
+class NetworkTools:
+    """Network diagnostic and testing tools"""
+    
+    def __init__(self):
+        """Initialize network tools"""
+        self.os_type = platform.system().lower()
+        self.probe_engine = ProbeEngine()
+        self.dns_probe = DnsProbe()
+    
+    @property
+    def connectivity_monitor(self):
+        """Shared background connectivity monitor"""
+        return get_connectivity_monitor()
+    
+    def check_internet_connectivity(self, deadline=None):
+        """Check if internet is available (cached by the background monitor)"""
+        return self.connectivity_monitor.is_internet_available(deadline)
     
     def check_dns_resolution(self):
-        """Check if DNS resolution is working"""
+        """Check if DNS resolution is working (cached by the background monitor)"""
+        return self.connectivity_monitor.is_dns_working()
+    
+    def benchmark_dns(self):
+        """Compare the system and public DNS resolvers and recommend the fastest healthy one"""
         try:
-            # Try to resolve a domain
-            socket.gethostbyname("google.com")
-            return True
-        except socket.gaierror:
-            return False
+            return self.dns_probe.benchmark()
+        except Exception as e:
+            logger.error(f"Error benchmarking DNS resolvers: {str(e)}")
+            return {'error': str(e)}
+    
+    def get_connectivity_status(self):
+        """Get the full cached connectivity verdict including its age"""
+        return self.connectivity_monitor.get_status()
     
     def get_network_fallback_commands(self, os_type):
         """Get fallback commands for network issues based on OS"""
@@ -225,7 +412,12 @@ class NetworkTools:
             }
     
     def run_basic_diagnostics(self):
-        """Run basic network diagnostics"""
+        """Run basic network diagnostics
+        
+        Every host and domain is probed at once in-process (ICMP, or TCP where
+        ICMP sockets are not permitted, and UDP DNS queries to the system
+        resolver), so the whole run takes a single probe timeout.
+        """
         try:
             results = {
                 'connectivity': {},
@@ -233,62 +425,41 @@ class NetworkTools:
                 'interfaces': {}
             }
             
-            # Test connectivity to common hosts
             hosts = ['google.com', 'cloudflare.com', '1.1.1.1']
-            for host in hosts:
-                try:
-                    if self.os_type == 'windows':
-                        result = subprocess.run(f'ping {host} -n 1', shell=True, capture_output=True, text=True, timeout=5)
-                    else:
-                        result = subprocess.run(f'ping -c 1 {host}', shell=True, capture_output=True, text=True, timeout=5)
-                    
-                    results['connectivity'][host] = {
-                        'success': result.returncode == 0,
-                        'output': result.stdout
-                    }
-                except Exception as e:
-                    results['connectivity'][host] = {
-                        'success': False,
-                        'error': str(e)
-                    }
-            
-            # Test DNS resolution
             domains = ['google.com', 'cloudflare.com']
+            resolvers = read_system_resolvers()
+            targets = [ProbeTarget(f'connectivity:{host}', 'icmp', host) for host in hosts]
             for domain in domains:
-                try:
-                    result = subprocess.run(f'nslookup {domain}', shell=True, capture_output=True, text=True, timeout=5)
-                    results['dns'][domain] = {
-                        'success': result.returncode == 0,
-                        'output': result.stdout
-                    }
-                except Exception as e:
-                    results['dns'][domain] = {
-                        'success': False,
-                        'error': str(e)
-                    }
-            
-            # Get network interfaces
-            try:
-                if self.os_type == 'windows':
-                    result = subprocess.run('ipconfig', shell=True, capture_output=True, text=True, timeout=10)
+                if resolvers:
+                    targets.append(ProbeTarget(f'dns:{domain}', 'dns', resolvers[0], query=domain))
                 else:
-                    result = subprocess.run('ifconfig', shell=True, capture_output=True, text=True, timeout=10)
-                
-                results['interfaces'] = {
-                    'success': result.returncode == 0,
-                    'output': result.stdout
-                }
-            except Exception as e:
-                results['interfaces'] = {
-                    'success': False,
-                    'error': str(e)
-                }
+                    targets.append(ProbeTarget(f'dns:{domain}', 'resolve', domain))
             
+            for name, probe in self.probe_engine.probe(targets).items():
+                section, host = name.split(':', 1)
+                success = probe['success'] and probe.get('rcode', 'NOERROR') == 'NOERROR'
+                results[section][host] = dict(probe, success=success, output=format_probe_result(probe))
+            
+            results['interfaces'] = self._describe_interfaces()
             return results
         except Exception as e:
             logger.error(f"Error running network diagnostics: {str(e)}")
             return {'error': str(e)}
     
+    def _describe_interfaces(self):
+        """Interfaces with state and IPv4 addresses, read in-process instead of running ifconfig"""
+        try:
+            stats = psutil.net_if_stats()
+            lines = []
+            for name, addresses in sorted(psutil.net_if_addrs().items()):
+                state = 'UP' if name in stats and stats[name].isup else 'DOWN'
+                ipv4 = [address.address for address in addresses if address.family == socket.AF_INET]
+                mtu = f", mtu {stats[name].mtu}" if name in stats else ''
+                lines.append(f"{name}: {state}{mtu}, inet {', '.join(ipv4) or 'none'}")
+            return {'success': True, 'output': '\n'.join(lines)}
+        except Exception as e:
+            return {'success': False, 'error': str(e)}
+    
     def get_macos_network_info(self):
         """Get macOS-specific network information"""
         try:
@@ -296,14 +467,14 @@ class NetworkTools:
             
             # Get WiFi information
             try:
-                result = subprocess.run('networksetup -getinfo Wi-Fi', shell=True, capture_output=True, text=True, timeout=10)
+                result = run_in_group('networksetup -getinfo Wi-Fi', timeout=10)
                 results['wifi_info'] = result.stdout if result.returncode == 0 else "Unable to get WiFi information"
             except Exception as e:
                 results['wifi_info'] = f"Error getting WiFi info: {str(e)}"
             
             # Get network services
             try:
-                result = subprocess.run('networksetup -listallnetworkservices', shell=True, capture_output=True, text=True, timeout=10)
+                result = run_in_group('networksetup -listallnetworkservices', timeout=10)
                 results['network_services'] = result.stdout if result.returncode == 0 else "Unable to get network services"
             except Exception as e:
                 results['network_services'] = f"Error getting network services: {str(e)}"
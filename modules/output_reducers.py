@@ -0,0 +1,420 @@
+import ipaddress
+import json
+import logging
+import re
+import threading
+from modules.context_builder import count_tokens
+
+logger = logging.getLogger(__name__)
+
+# Rows kept in list-valued facts so a huge table cannot blow up the prompt
+MAX_ROWS = 8
+
+# Pseudo filesystems that say nothing about the user's disks
+PSEUDO_FILESYSTEMS = ('tmpfs', 'devtmpfs', 'overlay', 'shm', 'udev', 'none', 'devfs', 'map ', 'squashfs')
+
+_IPV4 = r'\d{1,3}(?:\.\d{1,3}){3}'
+
+def _number(text):
+    """Parse an int or float out of a numeric string, or return None"""
+    try:
+        value = float(text)
+    except (TypeError, ValueError):
+        return None
+    return int(value) if value.is_integer() else value
+
+def _global_ipv6(text):
+    """Return an IPv6 address with its zone and prefix stripped if it is routable beyond the link, or None"""
+    candidate = re.split(r'[%/(]', (text or '').strip())[0]
+    try:
+        address = ipaddress.IPv6Address(candidate)
+    except ValueError:
+        return None
+    if address.is_link_local or address.is_loopback or address.is_unspecified or address.is_multicast:
+        return None
+    return str(address)
+
+def _size_mib(text):
+    """Convert sizes like 7.7Gi, 512M, 1.2T or plain KiB counts to MiB"""
+    match = re.fullmatch(r'([\d.]+)\s*([KMGTP]?)(i?B?)?', (text or '').strip(), re.IGNORECASE)
+    if not match:
+        return None
+    value = float(match.group(1))
+    unit = match.group(2).upper()
+    if not unit and not match.group(3):
+        unit = 'K'  # free and df report plain numbers in KiB
+    factor = {'': 1 / (1024 * 1024), 'K': 1 / 1024, 'M': 1, 'G': 1024, 'T': 1024 * 1024, 'P': 1024 ** 3}[unit]
+    return round(value * factor, 1)
+
+def reduce_ping(output):
+    """Summarize ping: target, packet loss, round-trip times and errors"""
+    facts = {}
+    target = re.search(r'^PING\s+(\S+)\s+\((' + _IPV4 + r')\)', output, re.MULTILINE) or \
+        re.search(r'^Pinging\s+(\S+)\s+\[?(' + _IPV4 + r'|[0-9a-f:]+)\]?', output, re.MULTILINE | re.IGNORECASE)
+    if target:
+        facts['host'], facts['ip'] = target.group(1), target.group(2)
+    
+    unix = re.search(r'(\d+) packets transmitted, (\d+) (?:packets )?received.*?([\d.]+)% packet loss', output)
+    windows = re.search(r'Sent = (\d+), Received = (\d+), Lost = \d+ \((\d+)% loss', output)
+    stats = unix or windows
+    if stats:
+        facts['sent'] = int(stats.group(1))
+        facts['received'] = int(stats.group(2))
+        facts['loss_pct'] = _number(stats.group(3))
+    
+    rtt = re.search(r'(?:rtt|round-trip) min/avg/max/(?:mdev|stddev) = ([\d.]+)/([\d.]+)/([\d.]+)', output)
+    if rtt:
+        facts['rtt_ms'] = {'min': _number(rtt.group(1)), 'avg': _number(rtt.group(2)), 'max': _number(rtt.group(3))}
+    else:
+        rtt = re.search(r'Minimum = (\d+)ms, Maximum = (\d+)ms, Average = (\d+)ms', output)
+        if rtt:
+            facts['rtt_ms'] = {'min': int(rtt.group(1)), 'avg': int(rtt.group(3)), 'max': int(rtt.group(2))}
+    
+    errors = []
+    for pattern, label in (
+        (r'unknown host|could not find host|Name or service not known|cannot resolve', 'name resolution failed'),
+        (r'Request timed out', 'request timed out'),
+        (r'Destination (?:host|net) unreachable', 'destination unreachable'),
+        (r'Network is unreachable|General failure', 'network unreachable'),
+    ):
+        count = len(re.findall(pattern, output, re.IGNORECASE))
+        if count:
+            errors.append(f"{label} (x{count})" if count > 1 else label)
+    if errors:
+        facts['errors'] = errors
+    return facts or None
+
+def reduce_df(output):
+    """Summarize df: the fullest real filesystems first"""
+    lines = [line for line in output.splitlines() if line.strip()]
+    if not lines or not lines[0].lower().startswith('filesystem'):
+        return None
+    # "Mounted on" is two header words but one column
+    columns = len(lines[0].split()) - 1
+    filesystems = []
+    for line in lines[1:]:
+        parts = line.split()
+        if len(parts) < columns or parts[0].lower().startswith(PSEUDO_FILESYSTEMS) or parts[0].startswith('/dev/loop'):
+            continue
+        use = next((part for part in parts[1:columns] if part.endswith('%')), None)
+        filesystems.append({
+            'mount': ' '.join(parts[columns - 1:]),
+            'size': parts[1],
+            'used': parts[2],
+            'avail': parts[3],
+            'use_pct': _number(use.rstrip('%')) if use else None
+        })
+    if not filesystems:
+        return None
+    filesystems.sort(key=lambda fs: fs['use_pct'] or 0, reverse=True)
+    facts = {'filesystems': filesystems[:MAX_ROWS], 'count': len(filesystems)}
+    nearly_full = [fs['mount'] for fs in filesystems if (fs['use_pct'] or 0) >= 90]
+    if nearly_full:
+        facts['nearly_full'] = nearly_full
+    return facts
+
+def reduce_free(output):
+    """Summarize free: memory and swap usage in MiB"""
+    lines = output.splitlines()
+    header = next((line.split() for line in lines if 'total' in line and 'used' in line), None)
+    if not header:
+        return None
+    facts = {}
+    for line in lines:
+        label, _, rest = line.partition(':')
+        label = label.strip().lower()
+        if label not in ('mem', 'swap'):
+            continue
+        values = dict(zip(header, rest.split()))
+        row = {key: _size_mib(values[key]) for key in ('total', 'used', 'free', 'available') if key in values}
+        if row.get('total'):
+            row['used_pct'] = round(100 * (row.get('used') or 0) / row['total'], 1)
+        facts[f"{label}_mib"] = row
+    return facts or None
+
+def reduce_ps(output):
+    """Summarize ps aux: process count and the heaviest processes by CPU and memory"""
+    lines = output.splitlines()
+    if not lines or 'PID' not in lines[0] or '%CPU' not in lines[0]:
+        return None
+    header = lines[0].split()
+    command_index = len(header) - 1
+    processes = []
+    for line in lines[1:]:
+        parts = line.split(None, command_index)
+        if len(parts) <= command_index:
+            continue
+        row = dict(zip(header, parts))
+        processes.append({
+            'pid': _number(row.get('PID')),
+            'user': row.get('USER'),
+            'cpu': _number(row.get('%CPU')) or 0,
+            'mem': _number(row.get('%MEM')) or 0,
+            'command': parts[command_index][:80]
+        })
+    if not processes:
+        return None
+    top_cpu = sorted(processes, key=lambda p: p['cpu'], reverse=True)[:5]
+    top_mem = sorted(processes, key=lambda p: p['mem'], reverse=True)[:5]
+    return {
+        'process_count': len(processes),
+        'total_cpu_pct': round(sum(p['cpu'] for p in processes), 1),
+        'top_cpu': top_cpu,
+        'top_mem': [p for p in top_mem if p not in top_cpu] or None
+    }
+
+def reduce_netstat(output):
+    """Summarize netstat socket listings: states, listening ports and busiest peers"""
+    states = {}
+    listening = set()
+    peers = {}
+    sockets = 0
+    for line in output.splitlines():
+        parts = line.split()
+        if len(parts) < 3 or not parts[0].lower().startswith(('tcp', 'udp')):
+            continue
+        # Linux/macOS: proto recv-q send-q local foreign [state]; Windows: proto local foreign [state]
+        first = 3 if parts[1].isdigit() else 1
+        if len(parts) < first + 2:
+            continue
+        sockets += 1
+        local, foreign = parts[first], parts[first + 1]
+        state = parts[first + 2].upper() if len(parts) > first + 2 else 'NONE'
+        if not re.fullmatch(r'[A-Z][A-Z0-9_]*', state):
+            state = 'NONE'
+        if state == 'LISTENING':
+            state = 'LISTEN'
+        states[state] = states.get(state, 0) + 1
+        port = re.split(r'[:.]', local)[-1]
+        if state == 'LISTEN' and port.isdigit():
+            listening.add(int(port))
+        elif state == 'ESTABLISHED':
+            host = re.sub(r'[:.]\d+$', '', foreign)
+            peers[host] = peers.get(host, 0) + 1
+    if not sockets:
+        return None
+    facts = {'sockets': sockets, 'states': states, 'listening_ports': sorted(listening)[:20]}
+    if peers:
+        busiest = sorted(peers.items(), key=lambda item: item[1], reverse=True)[:5]
+        facts['top_established_peers'] = [{'host': host, 'connections': count} for host, count in busiest]
+    return facts
+
+def reduce_interfaces(output):
+    """Summarize ifconfig or ip addr: interfaces with state, addresses and MAC"""
+    interfaces = []
+    current = None
+    for line in output.splitlines():
+        header = re.match(r'^(?:\d+:\s+)?([\w.@-]+):?\s+(?:<([^>]*)>|flags=\d+<([^>]*)>)', line)
+        if header and not line.startswith((' ', '\t')):
+            flags = (header.group(2) or header.group(3) or '').split(',')
+            current = {'name': header.group(1).split('@')[0], 'up': 'UP' in flags, 'ipv4': [], 'ipv6': 0}
+            if 'LOOPBACK' in flags:
+                current['loopback'] = True
+            if re.search(r'\bstate DOWN\b', line):
+                current['up'] = False
+            interfaces.append(current)
+            continue
+        if current is None:
+            continue
+        stripped = line.strip()
+        ipv4 = re.match(r'inet (?:addr:)?(' + _IPV4 + r'(?:/\d+)?)', stripped)
+        if ipv4:
+            current['ipv4'].append(ipv4.group(1))
+        elif stripped.startswith('inet6'):
+            current['ipv6'] += 1
+            ipv6 = re.match(r'inet6 (?:addr:\s*)?(\S+)', stripped)
+            address = _global_ipv6(ipv6.group(1)) if ipv6 else None
+            if address:
+                current.setdefault('ipv6_global', []).append(address)
+        mac = re.match(r'(?:link/ether|ether|HWaddr)\s+([0-9a-f:]{17})', stripped, re.IGNORECASE)
+        if mac:
+            current['mac'] = mac.group(1)
+        status = re.match(r'status:\s*(\w+)', stripped)
+        if status:
+            current['up'] = current['up'] and status.group(1) == 'active'
+    if not interfaces:
+        return None
+    # Loopback and address-less virtual interfaces rarely matter; keep them as names only
+    relevant = [iface for iface in interfaces
+                if (iface['ipv4'] or iface.get('ipv6_global')) and not iface.get('loopback')]
+    facts = {'interfaces': relevant[:MAX_ROWS] or interfaces[:MAX_ROWS]}
+    others = [iface['name'] for iface in interfaces if iface not in facts['interfaces']]
+    if others:
+        facts['other_interfaces'] = others[:20]
+    return facts
+
+def reduce_ipconfig(output):
+    """Summarize Windows ipconfig: connected adapters with address, gateway and DNS"""
+    adapters = []
+    current = None
+    last_key = None
+    for line in output.splitlines():
+        adapter = re.match(r'^(\S.*adapter .+?):\s*$', line)
+        if adapter:
+            current = {'name': adapter.group(1)}
+            adapters.append(current)
+            last_key = None
+            continue
+        if current is None or not line.strip():
+            continue
+        if last_key and ' : ' not in line and re.match(r'^\s{20,}\S', line):
+            # Continuation lines list further gateways or DNS servers
+            current[last_key].append(line.strip())
+            continue
+        field = re.match(r'^\s+([^.:]+?)[ .]*:\s*(.*)$', line)
+        if not field:
+            continue
+        key, value = field.group(1).strip().lower(), field.group(2).strip()
+        last_key = None
+        if key == 'media state':
+            current['disconnected'] = 'disconnected' in value.lower()
+        elif key.startswith('ipv4 address') or key == 'ip address':
+            current['ipv4'] = re.sub(r'\(.*\)', '', value)
+        elif key.startswith(('ipv6 address', 'temporary ipv6 address')):
+            address = _global_ipv6(value)
+            if address:
+                current.setdefault('ipv6_global', []).append(address)
+        elif key == 'subnet mask':
+            current['mask'] = value
+        elif key in ('default gateway', 'dns servers'):
+            last_key = 'gateway' if key == 'default gateway' else 'dns'
+            current[last_key] = [value] if value else []
+        elif key == 'dhcp enabled':
+            current['dhcp'] = value.lower() == 'yes'
+        elif key == 'physical address':
+            current['mac'] = value
+    if not adapters:
+        return None
+    connected = [a for a in adapters if not a.get('disconnected')]
+    facts = {'adapters': connected[:MAX_ROWS]}
+    disconnected = [a['name'] for a in adapters if a.get('disconnected')]
+    if disconnected:
+        facts['disconnected'] = disconnected
+    return facts
+
+def reduce_nslookup(output):
+    """Summarize nslookup: resolver used, answers and failures"""
+    facts = {}
+    server = re.search(r'^Server:\s*(\S+)', output, re.MULTILINE)
+    if server:
+        facts['server'] = server.group(1)
+    sections = re.split(r'Non-authoritative answer:|Name:', output, maxsplit=1)
+    answer = output[len(sections[0]):] if len(sections) > 1 else ''
+    name = re.search(r'Name:\s*(\S+)', answer)
+    if name:
+        facts['name'] = name.group(1)
+    facts['addresses'] = re.findall(r'(' + _IPV4 + r'|[0-9a-f]*:[0-9a-f:]+)', answer.split('Name:', 1)[-1] if name else answer)
+    facts['non_authoritative'] = 'Non-authoritative answer' in output
+    
+    error = re.search(r"\*\*\s*(.+)|(connection timed out.*)|(DNS request timed out.*)", output, re.IGNORECASE)
+    if error:
+        facts['error'] = next(group for group in error.groups() if group).strip()
+    if not facts.get('addresses') and 'error' not in facts and 'server' not in facts:
+        return None
+    # nslookup on Linux prints each name once per address; keep unique addresses in order
+    facts['addresses'] = list(dict.fromkeys(facts['addresses']))[:MAX_ROWS]
+    return facts
+
+# First word of the command (and for `ip`, the object) -> reducer
+REDUCERS = {
+    'ping': reduce_ping,
+    'df': reduce_df,
+    'free': reduce_free,
+    'ps': reduce_ps,
+    'netstat': reduce_netstat,
+    'ifconfig': reduce_interfaces,
+    'ip addr': reduce_interfaces,
+    'ipconfig': reduce_ipconfig,
+    'nslookup': reduce_nslookup,
+}
+
+def find_reducer(command):
+    """Return the (name, reducer) for a command line, or (None, None)"""
+    words = (command or '').strip().lower().split()
+    if words and words[0] == 'sudo':
+        words = words[1:]
+    if not words:
+        return None, None
+    if words[0] == 'ip' and len(words) > 1 and words[1] in ('a', 'addr', 'address'):
+        return 'ip addr', REDUCERS['ip addr']
+    name = words[0].rsplit('/', 1)[-1]
+    if name in REDUCERS and name != 'ip addr':
+        return name, REDUCERS[name]
+    return None, None
+
+def parse_output(command, output):
+    """Parse a command's output with its reducer; returns (reducer name, facts) or (None, None)"""
+    name, reducer = find_reducer(command)
+    if not reducer or not (output or '').strip():
+        return None, None
+    try:
+        return name, reducer(output)
+    except Exception as e:
+        logger.warning(f"Error reducing output of '{command}': {str(e)}")
+        return None, None
+
+def format_facts(facts):
+    """Render facts as compact JSON for the prompt"""
+    return json.dumps(facts, separators=(',', ':'), ensure_ascii=False)
+
+class OutputReducer:
+    """Turns raw diagnostic command output into compact structured facts
+    
+    Tools like ``ipconfig /all``, ``ps aux`` and ``netstat -an`` print far more
+    than the model needs to interpret a result. Known commands are parsed into a
+    few facts; anything unrecognised (or a parse that finds nothing) is passed
+    through unchanged so the analysis never loses information it cannot replace.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.reduced = 0
+        self.tokens_before = 0
+        self.tokens_after = 0
+        self.by_reducer = {}
+    
+    def reduce(self, command, output):
+        """Reduce a command's output for the prompt
+        
+        Returns a dict with the prompt ``text``, the ``reducer`` used (None when the
+        raw output is kept), the parsed ``facts`` and token counts before and after.
+        """
+        output = output or ''
+        name, facts = parse_output(command, output)
+        
+        text = format_facts(facts) if facts else output
+        tokens_before = count_tokens(output)
+        # A reduction that does not shrink the output is not worth the lost detail
+        if facts and count_tokens(text) >= tokens_before:
+            name, facts, text = None, None, output
+        tokens_after = count_tokens(text)
+        
+        with self._lock:
+            self.calls += 1
+            self.tokens_before += tokens_before
+            self.tokens_after += tokens_after
+            if facts:
+                self.reduced += 1
+                self.by_reducer[name] = self.by_reducer.get(name, 0) + 1
+        return {
+            'reducer': name if facts else None,
+            'facts': facts,
+            'text': text,
+            'tokens_before': tokens_before,
+            'tokens_after': tokens_after
+        }
+    
+    def get_stats(self):
+        """Get reduction statistics"""
+        with self._lock:
+            saved = self.tokens_before - self.tokens_after
+            return {
+                'calls': self.calls,
+                'reduced': self.reduced,
+                'by_reducer': dict(self.by_reducer),
+                'tokens_before': self.tokens_before,
+                'tokens_after': self.tokens_after,
+                'tokens_saved': saved,
+                'reduction_pct': round(100 * saved / self.tokens_before, 1) if self.tokens_before else 0.0
+            }
@@ -0,0 +1,414 @@
+import asyncio
+import logging
+import os
+import random
+import socket
+import statistics
+import struct
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+from config import Config
+from modules.async_runner import get_async_runner
+
+logger = logging.getLogger(__name__)
+
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+DNS_TYPE_A = 1
+DNS_RCODES = {0: 'NOERROR', 1: 'FORMERR', 2: 'SERVFAIL', 3: 'NXDOMAIN', 4: 'NOTIMP', 5: 'REFUSED'}
+
+@dataclass
+class ProbeTarget:
+    """Something to probe repeatedly
+    
+    ``kind`` is 'icmp' (falls back to 'tcp' where ICMP sockets are not
+    permitted), 'tcp' (connect to ``port``), 'dns' (UDP query for ``query``
+    sent to the resolver at ``host``) or 'resolve' (the system resolver
+    looking up ``host``).
+    """
+    name: str
+    kind: str
+    host: str
+    port: Optional[int] = None
+    query: Optional[str] = None
+
+def summarize_rtts(rtts):
+    """Loss and min/avg/max/jitter in ms from per-probe round trips (None = lost)"""
+    received = [rtt for rtt in rtts if rtt is not None]
+    stats = {
+        'sent': len(rtts),
+        'received': len(received),
+        'loss_pct': round(100 * (len(rtts) - len(received)) / len(rtts), 1) if rtts else 0.0
+    }
+    if received:
+        # Jitter as the mean difference between consecutive round trips (RFC 3550 style)
+        jitter = statistics.mean(abs(b - a) for a, b in zip(received, received[1:])) if len(received) > 1 else 0.0
+        stats['rtt_ms'] = {
+            'min': round(min(received), 2),
+            'avg': round(statistics.mean(received), 2),
+            'max': round(max(received), 2),
+            'jitter': round(jitter, 2)
+        }
+    return stats
+
+def build_dns_query(name, query_id, qtype=DNS_TYPE_A):
+    """Encode a recursive DNS query for one name"""
+    header = struct.pack('!HHHHHH', query_id, 0x0100, 1, 0, 0, 0)
+    labels = b''.join(bytes([len(label)]) + label.encode('idna') for label in name.rstrip('.').split('.') if label)
+    return header + labels + b'\x00' + struct.pack('!HH', qtype, 1)
+
+def _skip_name(data, offset):
+    while True:
+        length = data[offset]
+        if length == 0:
+            return offset + 1
+        if length & 0xC0 == 0xC0:
+            return offset + 2
+        offset += length + 1
+
+def parse_dns_response(data):
+    """Decode the id, response code and IPv4 answers of a DNS response"""
+    query_id, flags, questions, answer_count = struct.unpack('!HHHH', data[:8])
+    offset = 12
+    for _ in range(questions):
+        offset = _skip_name(data, offset) + 4
+    addresses = []
+    for _ in range(answer_count):
+        offset = _skip_name(data, offset)
+        rtype, _, _, length = struct.unpack('!HHIH', data[offset:offset + 10])
+        offset += 10
+        if rtype == DNS_TYPE_A and length == 4:
+            addresses.append(socket.inet_ntoa(data[offset:offset + 4]))
+        offset += length
+    return {'id': query_id, 'rcode': DNS_RCODES.get(flags & 0x000F, str(flags & 0x000F)), 'addresses': addresses}
+
+def _icmp_checksum(packet):
+    if len(packet) % 2:
+        packet += b'\x00'
+    total = sum(struct.unpack(f'!{len(packet) // 2}H', packet))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+def _icmp_echo(identifier, sequence, payload):
+    header = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, 0, identifier, sequence)
+    checksum = _icmp_checksum(header + payload)
+    return struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, checksum, identifier, sequence) + payload
+
+def _is_echo_reply(packet, identifiers, sequence, payload):
+    """Whether packet is the reply to our echo request, with or without its IPv4 header"""
+    # Raw sockets, and datagram ones on macOS, deliver the IPv4 header too
+    if packet and packet[0] >> 4 == 4:
+        packet = packet[(packet[0] & 0x0F) * 4:]
+    if len(packet) < 8:
+        return False
+    reply_type, _, _, reply_id, reply_sequence = struct.unpack('!BBHHH', packet[:8])
+    return reply_type == ICMP_ECHO_REPLY and reply_sequence == sequence and \
+        reply_id in identifiers and packet[8:] == payload
+
+_icmp_socket_type = None
+_icmp_checked = False
+
+def icmp_socket_type():
+    """The ICMP socket this process may open: SOCK_DGRAM (unprivileged ping), SOCK_RAW, or None"""
+    global _icmp_socket_type, _icmp_checked
+    if not _icmp_checked:
+        for sock_type in (socket.SOCK_DGRAM, socket.SOCK_RAW):
+            try:
+                socket.socket(socket.AF_INET, sock_type, socket.IPPROTO_ICMP).close()
+                _icmp_socket_type = sock_type
+                break
+            except (PermissionError, OSError):
+                continue
+        _icmp_checked = True
+    return _icmp_socket_type
+
+def read_system_resolvers():
+    """Nameservers from /etc/resolv.conf (empty where there is none, e.g. Windows)"""
+    try:
+        with open('/etc/resolv.conf') as resolv_conf:
+            lines = resolv_conf.read().splitlines()
+    except OSError:
+        return []
+    resolvers = []
+    for line in lines:
+        parts = line.split()
+        if len(parts) >= 2 and parts[0] == 'nameserver' and '.' in parts[1]:
+            resolvers.append(parts[1])
+    return resolvers
+
+def format_probe_result(result):
+    """One ping-style summary line for a probe result"""
+    if result.get('error') and not result.get('received'):
+        return result['error']
+    line = f"{result['sent']} {result['method']} probes sent, {result['received']} received, {result['loss_pct']}% loss"
+    rtt = result.get('rtt_ms')
+    if rtt:
+        line += f", rtt min/avg/max/jitter = {rtt['min']}/{rtt['avg']}/{rtt['max']}/{rtt['jitter']} ms"
+    if 'rcode' in result:
+        line += f", {result['rcode']}"
+    if result.get('addresses'):
+        line += f": {', '.join(result['addresses'])}"
+    return line
+
+class _DnsClientProtocol(asyncio.DatagramProtocol):
+    def __init__(self, query_id, answer):
+        self.query_id = query_id
+        self.answer = answer
+    
+    def datagram_received(self, data, addr):
+        try:
+            response = parse_dns_response(data)
+        except (struct.error, IndexError):
+            return
+        if response['id'] == self.query_id and not self.answer.done():
+            self.answer.set_result(response)
+    
+    def error_received(self, exc):
+        if not self.answer.done():
+            self.answer.set_exception(exc)
+
+async def dns_query(resolver, name, port=53):
+    """Send one UDP query for name's A records to resolver; returns its rcode and addresses
+    
+    There is no timeout here: callers wrap it in ``asyncio.wait_for``.
+    """
+    loop = asyncio.get_running_loop()
+    query_id = random.getrandbits(16)
+    answer = loop.create_future()
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: _DnsClientProtocol(query_id, answer), remote_addr=(resolver, port)
+    )
+    try:
+        transport.sendto(build_dns_query(name, query_id))
+        response = await answer
+    finally:
+        transport.close()
+    return {'rcode': response['rcode'], 'addresses': response['addresses']}
+
+class ProbeEngine:
+    """Measures latency and loss in-process instead of spawning ping and nslookup
+    
+    Every probe of every target is in flight at once on the shared asyncio
+    loop (``count`` probes per target, ``interval`` apart), so a full run
+    takes one ``timeout`` window however many targets are unreachable.
+    """
+    
+    def __init__(self, timeout=None, count=None, interval=None, tcp_port=None, icmp_enabled=None):
+        self.timeout = timeout or Config.PROBE_TIMEOUT
+        self.count = count or Config.PROBE_COUNT
+        self.interval = Config.PROBE_INTERVAL if interval is None else interval
+        self.tcp_port = tcp_port or Config.PROBE_TCP_PORT
+        self.icmp_enabled = Config.PROBE_ICMP_ENABLED if icmp_enabled is None else icmp_enabled
+        self._lock = threading.Lock()
+        self.runs = 0
+        self.probes = {}
+        self.icmp_fallbacks = 0
+    
+    def probe(self, targets: List[ProbeTarget]) -> Dict[str, Dict]:
+        """Probe targets concurrently from synchronous code; returns results by target name"""
+        return get_async_runner().run(self.aprobe(targets), timeout=self.timeout + self.count * self.interval + 5)
+    
+    async def aprobe(self, targets: List[ProbeTarget]) -> Dict[str, Dict]:
+        """Probe targets concurrently; returns results by target name"""
+        started = time.monotonic()
+        results = await asyncio.gather(*(self._probe_target(target) for target in targets))
+        with self._lock:
+            self.runs += 1
+        logger.info(f"Probed {len(targets)} targets in {time.monotonic() - started:.2f}s")
+        return {target.name: result for target, result in zip(targets, results)}
+    
+    def get_stats(self):
+        """Get probe counts by method and how often ICMP fell back to TCP"""
+        with self._lock:
+            return {
+                'runs': self.runs,
+                'probes': dict(self.probes),
+                'icmp_fallbacks': self.icmp_fallbacks,
+                'icmp_socket': {socket.SOCK_DGRAM: 'dgram', socket.SOCK_RAW: 'raw'}.get(icmp_socket_type())
+            }
+    
+    async def _probe_target(self, target):
+        method = target.kind
+        if method == 'icmp' and not (self.icmp_enabled and icmp_socket_type()):
+            method = 'tcp'
+            with self._lock:
+                self.icmp_fallbacks += 1
+        
+        result = {'host': target.host, 'method': method}
+        # Name resolution and the probes share one timeout window
+        expires = time.monotonic() + self.timeout
+        try:
+            if method == 'resolve':
+                address = None
+            else:
+                address = await self._resolve(target.host)
+                result['ip'] = address
+        except (OSError, asyncio.TimeoutError) as e:
+            result.update(summarize_rtts([None] * self.count))
+            result.update({'success': False, 'error': f'Could not resolve {target.host}: {str(e) or "timed out"}'})
+            return result
+        
+        attempts = [self._attempt(method, target, address, sequence, expires) for sequence in range(self.count)]
+        outcomes = await asyncio.gather(*attempts)
+        with self._lock:
+            self.probes[method] = self.probes.get(method, 0) + len(outcomes)
+        
+        result.update(summarize_rtts([rtt for rtt, _ in outcomes]))
+        details = [detail for _, detail in outcomes if detail]
+        answers = [detail for detail in details if 'error' not in detail]
+        if details:
+            # The last answer (DNS rcode and addresses), or the last error if nothing answered
+            result.update((answers or details)[-1])
+        result['success'] = result['received'] > 0
+        return result
+    
+    async def _attempt(self, method, target, address, sequence, expires):
+        """One probe started ``sequence * interval`` from now; returns (rtt ms or None, detail dict)"""
+        await asyncio.sleep(sequence * self.interval)
+        timeout = max(expires + sequence * self.interval - time.monotonic(), 0.01)
+        started = time.perf_counter()
+        try:
+            if method == 'icmp':
+                detail = await asyncio.wait_for(self._icmp_echo(address, sequence), timeout)
+            elif method == 'tcp':
+                detail = await asyncio.wait_for(self._tcp_connect(address, target.port or self.tcp_port), timeout)
+            elif method == 'dns':
+                detail = await asyncio.wait_for(self._dns_query(address, target.port or 53, target.query), timeout)
+            elif method == 'resolve':
+                detail = await asyncio.wait_for(self._system_resolve(target.host), timeout)
+            else:
+                raise ValueError(f'Unknown probe kind {method}')
+        except asyncio.TimeoutError:
+            return None, None
+        except ConnectionRefusedError:
+            # A refusal is still a round trip: the host answered
+            return (time.perf_counter() - started) * 1000, {'refused': True}
+        except OSError as e:
+            return None, {'error': str(e)}
+        return (time.perf_counter() - started) * 1000, detail
+    
+    async def _resolve(self, host):
+        try:
+            socket.inet_aton(host)
+            return host
+        except OSError:
+            pass
+        loop = asyncio.get_running_loop()
+        infos = await asyncio.wait_for(loop.getaddrinfo(host, None, family=socket.AF_INET, type=socket.SOCK_STREAM), self.timeout)
+        return infos[0][4][0]
+    
+    async def _tcp_connect(self, address, port):
+        _, writer = await asyncio.open_connection(address, port)
+        writer.close()
+        return None
+    
+    async def _system_resolve(self, host):
+        loop = asyncio.get_running_loop()
+        infos = await loop.getaddrinfo(host, None, family=socket.AF_INET, type=socket.SOCK_STREAM)
+        return {'addresses': list(dict.fromkeys(info[4][0] for info in infos))}
+    
+    async def _dns_query(self, resolver, port, name):
+        return await dns_query(resolver, name, port)
+    
+    async def _icmp_echo(self, address, sequence):
+        loop = asyncio.get_running_loop()
+        sock_type = icmp_socket_type()
+        sock = socket.socket(socket.AF_INET, sock_type, socket.IPPROTO_ICMP)
+        sock.setblocking(False)
+        try:
+            identifier = (os.getpid() + random.getrandbits(16)) & 0xFFFF
+            payload = os.urandom(16)
+            await loop.sock_sendto(sock, _icmp_echo(identifier, sequence, payload), (address, 0))
+            # Linux datagram ICMP sockets replace the identifier with the socket's port
+            identifiers = {identifier}
+            if sock_type == socket.SOCK_DGRAM:
+                identifiers.add(sock.getsockname()[1])
+            while True:
+                packet = await loop.sock_recv(sock, 1024)
+                if _is_echo_reply(packet, identifiers, sequence, payload):
+                    return None
+        finally:
+            sock.close()
+
+class LocalResponder:
+    """A stand-in TCP listener and DNS server on 127.0.0.1 for tests and benchmarks
+    
+    The TCP port accepts connections (the kernel completes the handshake). The
+    UDP port answers A queries for names in ``records`` with their addresses,
+    and anything else with ``default`` addresses or, when that is None,
+    NXDOMAIN, after ``delay`` seconds. Queries for names in ``drop`` get no
+    answer at all.
+    """
+    
+    def __init__(self, records=None, delay=0.0, drop=(), default=None):
+        self.records = records if records is not None else {'example.com': ['127.0.0.1']}
+        self.delay = delay
+        self.drop = set(drop)
+        self.default = default
+        self.queries = 0
+        self._stopped = threading.Event()
+    
+    def __enter__(self):
+        self.tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp.bind(('127.0.0.1', 0))
+        self.tcp.listen(64)
+        self.tcp_port = self.tcp.getsockname()[1]
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.bind(('127.0.0.1', 0))
+        self.udp.settimeout(0.1)
+        self.dns_port = self.udp.getsockname()[1]
+        self._thread = threading.Thread(target=self._serve_dns, name='local-responder', daemon=True)
+        self._thread.start()
+        return self
+    
+    def __exit__(self, *exc_info):
+        self._stopped.set()
+        self._thread.join(timeout=1)
+        self.tcp.close()
+        self.udp.close()
+    
+    def _serve_dns(self):
+        while not self._stopped.is_set():
+            try:
+                query, client = self.udp.recvfrom(512)
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            self.queries += 1
+            reply = self.answer(query)
+            if reply is None:
+                continue
+            if self.delay:
+                threading.Timer(self.delay, self._send, (reply, client)).start()
+            else:
+                self._send(reply, client)
+    
+    def _send(self, reply, client):
+        try:
+            self.udp.sendto(reply, client)
+        except OSError:
+            pass
+    
+    def answer(self, query):
+        """Build the response to a query, or None to drop it"""
+        query_id = struct.unpack('!H', query[:2])[0]
+        end = _skip_name(query, 12)
+        labels, offset = [], 12
+        while query[offset]:
+            labels.append(query[offset + 1:offset + 1 + query[offset]].decode('ascii', 'replace'))
+            offset += query[offset] + 1
+        name = '.'.join(labels).lower()
+        if name in self.drop:
+            return None
+        addresses = self.records.get(name, self.default)
+        flags = 0x8180 if addresses is not None else 0x8183
+        header = struct.pack('!HHHHHH', query_id, flags, 1, len(addresses or []), 0, 0)
+        answers = b''.join(
+            struct.pack('!HHHIH', 0xC00C, DNS_TYPE_A, 1, 60, 4) + socket.inet_aton(address)
+            for address in addresses or []
+        )
+        return header + query[12:end + 4] + answers
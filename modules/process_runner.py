@@ -0,0 +1,456 @@
+import logging
+import os
+import queue
+import select
+import signal
+import subprocess
+import sys
+import threading
+import time
+import psutil
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# Marks the end of one of the process's output streams
+_EOF = object()
+
+# Seconds a pipe reader blocks before checking whether the run has stopped
+READ_POLL_INTERVAL = 0.1
+
+# Start every command in its own process group (a new session on POSIX) so the
+# shell, pipelines and anything they spawn can be killed together
+if os.name == 'nt':
+    PROCESS_GROUP_KWARGS = {'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP}
+else:
+    PROCESS_GROUP_KWARGS = {'start_new_session': True}
+
+_reaper_lock = threading.Lock()
+_reaper_stats = {'trees_killed': 0, 'processes_reaped': 0, 'leftover_groups': 0}
+
+def kill_process_tree(process):
+    """Kill a command's shell and every process it started; returns how many were reaped"""
+    members = _tree_members(process.pid)
+    if os.name != 'nt':
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+    for member in members:
+        try:
+            member.kill()
+        except psutil.Error:
+            pass
+    process.kill()
+    # The shell is our child and is reaped by Popen.wait; the rest are waited on here
+    alive = _wait_dead(members, timeout=1)
+    try:
+        process.wait(timeout=1)
+        root_reaped = 1
+    except subprocess.TimeoutExpired:
+        root_reaped = 0
+    reaped = len(members) - len(alive) + root_reaped
+    with _reaper_lock:
+        _reaper_stats['trees_killed'] += 1
+        _reaper_stats['processes_reaped'] += reaped
+    if alive:
+        logger.warning(f"{len(alive)} processes of command {process.pid} survived the kill")
+    return reaped
+
+def reap_leftover_group(process):
+    """Kill processes a finished command left running in its group (e.g. ``cmd &``)"""
+    if os.name == 'nt':
+        return 0
+    # Signal 0 only checks the group exists; usually it is gone, so skip scanning every process
+    try:
+        os.killpg(process.pid, 0)
+    except (ProcessLookupError, PermissionError):
+        return 0
+    members = [member for member in _group_members(process.pid) if member.pid != process.pid]
+    if not members:
+        return 0
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        return 0
+    reaped = len(members) - len(_wait_dead(members, timeout=1))
+    with _reaper_lock:
+        _reaper_stats['leftover_groups'] += 1
+        _reaper_stats['processes_reaped'] += reaped
+    return reaped
+
+def _wait_dead(processes, timeout):
+    """Wait until killed processes are gone or zombies; returns the ones still running"""
+    finished = time.monotonic() + timeout
+    running = _still_running(processes)
+    while running and time.monotonic() < finished:
+        time.sleep(0.01)
+        running = _still_running(running)
+    return running
+
+def _still_running(processes):
+    """Drop killed processes that are only waiting for init to collect them"""
+    running = []
+    for process in processes:
+        try:
+            if process.status() != psutil.STATUS_ZOMBIE:
+                running.append(process)
+        except psutil.NoSuchProcess:
+            continue
+    return running
+
+def _tree_members(pid):
+    """Descendants of the shell plus anything else still in its process group"""
+    members = {}
+    try:
+        for child in psutil.Process(pid).children(recursive=True):
+            members[child.pid] = child
+    except psutil.Error:
+        pass
+    for member in _group_members(pid):
+        members.setdefault(member.pid, member)
+    members.pop(pid, None)
+    return list(members.values())
+
+def _group_members(pgid):
+    if os.name == 'nt':
+        return []
+    members = []
+    for candidate in psutil.process_iter():
+        try:
+            if os.getpgid(candidate.pid) == pgid:
+                members.append(candidate)
+        except (ProcessLookupError, PermissionError):
+            continue
+    return members
+
+def _wait_with_usage(process, timeout):
+    """Wait for the shell; returns (return code, rusage of the shell and every child it reaped)
+    
+    The rusage comes from wait4, so it covers the whole pipeline. It is None
+    where wait4 is unavailable or the shell was already reaped by a kill.
+    """
+    if process.returncode is not None or not hasattr(os, 'wait4'):
+        return process.wait(timeout=timeout), None
+    finished = time.monotonic() + timeout
+    delay = 0.001
+    while True:
+        try:
+            pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+        except ChildProcessError:
+            return process.wait(timeout=timeout), None
+        if pid:
+            process.returncode = os.waitstatus_to_exitcode(status)
+            return process.returncode, usage
+        if time.monotonic() >= finished:
+            raise subprocess.TimeoutExpired(process.args, timeout)
+        time.sleep(delay)
+        delay = min(delay * 2, 0.05)
+
+def _resources(wall_time, usage):
+    """Per-command resource accounting from wall time and wait4 rusage"""
+    resources = {'wall_time': round(wall_time, 3), 'cpu_user': None, 'cpu_system': None, 'max_rss_kb': None}
+    if usage is not None:
+        resources['cpu_user'] = round(usage.ru_utime, 3)
+        resources['cpu_system'] = round(usage.ru_stime, 3)
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        resources['max_rss_kb'] = usage.ru_maxrss // 1024 if sys.platform == 'darwin' else usage.ru_maxrss
+    return resources
+
+def get_reaper_stats():
+    """Get counts of killed command trees and reaped processes"""
+    with _reaper_lock:
+        return dict(_reaper_stats)
+
+def run_in_group(command, timeout, text=True):
+    """``subprocess.run(command, shell=True, capture_output=True)`` that kills the whole process tree on timeout"""
+    with subprocess.Popen(command, shell=True, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, text=text, **PROCESS_GROUP_KWARGS) as process:
+        try:
+            stdout, stderr = process.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            kill_process_tree(process)
+            process.communicate()
+            raise
+        reap_leftover_group(process)
+    return subprocess.CompletedProcess(command, process.returncode, stdout, stderr)
+
+class BoundedCapture:
+    """Keeps the first ``head_bytes`` and last ``tail_bytes`` of a stream
+    
+    Everything in between is counted but not stored, so memory stays fixed
+    however much the command writes.
+    """
+    
+    def __init__(self, head_bytes, tail_bytes):
+        self.head_bytes = head_bytes
+        self.tail_bytes = tail_bytes
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.total = 0
+    
+    def write(self, data):
+        """Add a chunk read from the stream"""
+        self.total += len(data)
+        room = self.head_bytes - len(self.head)
+        if room > 0:
+            self.head += data[:room]
+            data = data[room:]
+        if data and self.tail_bytes:
+            self.tail += data[-self.tail_bytes:]
+            overflow = len(self.tail) - self.tail_bytes
+            if overflow > 0:
+                del self.tail[:overflow]
+    
+    @property
+    def dropped(self):
+        """Bytes that were read but are in neither the head nor the tail"""
+        return self.total - len(self.head) - len(self.tail)
+    
+    def text(self):
+        """The captured output, with a marker where bytes were dropped"""
+        text = self.head.decode('utf-8', errors='replace')
+        if self.dropped:
+            text += f"\n... ({self.dropped} bytes dropped) ...\n"
+        return text + self.tail.decode('utf-8', errors='replace')
+
+class ProcessRunner:
+    """Runs a shell command with bounded-memory capture, optionally streaming its output
+    
+    stdout and stderr are read in fixed-size chunks on two reader threads and
+    kept in a BoundedCapture each. The process is killed once it has written
+    more than ``max_bytes`` or runs past its timeout. With ``on_output``, lines
+    are handed over in batches of up to ``batch_lines``, or whatever has
+    arrived after ``batch_interval`` seconds, so a slow ``ping`` shows each
+    reply while a chatty command does not flood the socket; only the first
+    ``head_bytes`` of each stream are streamed.
+    """
+    
+    def __init__(self, batch_lines=None, batch_interval=None, head_bytes=None, tail_bytes=None,
+                 max_bytes=None, chunk_size=None):
+        self.batch_lines = batch_lines or Config.COMMAND_STREAM_BATCH_LINES
+        self.batch_interval = batch_interval or Config.COMMAND_STREAM_BATCH_INTERVAL
+        self.head_bytes = head_bytes or Config.COMMAND_OUTPUT_HEAD_BYTES
+        self.tail_bytes = tail_bytes if tail_bytes is not None else Config.COMMAND_OUTPUT_TAIL_BYTES
+        self.max_bytes = max_bytes or Config.COMMAND_OUTPUT_MAX_BYTES
+        self.chunk_size = chunk_size or Config.COMMAND_READ_CHUNK_SIZE
+    
+    def run(self, command, timeout, on_output=None, cancel=None):
+        """Run a validated command, streaming line batches to on_output, and return the result dictionary
+        
+        Setting the ``cancel`` event stops the command and everything it started.
+        """
+        process = subprocess.Popen(
+            command,
+            shell=True,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            **PROCESS_GROUP_KWARGS
+        )
+        started = time.monotonic()
+        # Bounded so readers stop pulling from the pipes when delivery falls behind
+        chunks = queue.Queue(maxsize=Config.COMMAND_READ_QUEUE_CHUNKS)
+        stop = threading.Event()
+        readers = [
+            threading.Thread(target=self._pump, args=(process.stdout, 'stdout', chunks, stop), daemon=True),
+            threading.Thread(target=self._pump, args=(process.stderr, 'stderr', chunks, stop), daemon=True)
+        ]
+        for reader in readers:
+            reader.start()
+        
+        captures = {stream: BoundedCapture(self.head_bytes, self.tail_bytes) for stream in ('stdout', 'stderr')}
+        lines = _LineBatcher(self, on_output)
+        open_streams = len(readers)
+        deadline = time.monotonic() + timeout
+        timed_out = capped = cancelled = False
+        while open_streams:
+            now = time.monotonic()
+            if now >= deadline:
+                timed_out = True
+                break
+            if cancel is not None and cancel.is_set():
+                cancelled = True
+                break
+            wait = lines.wait(deadline - now)
+            if cancel is not None:
+                wait = min(wait, 0.1)
+            try:
+                item = chunks.get(timeout=wait)
+            except queue.Empty:
+                item = None
+            if item is _EOF:
+                open_streams -= 1
+            elif item is not None:
+                stream, data = item
+                captures[stream].write(data)
+                lines.feed(stream, data, captures[stream].total)
+                if captures['stdout'].total + captures['stderr'].total > self.max_bytes:
+                    capped = True
+                    break
+            lines.flush_due()
+        
+        if timed_out or capped or cancelled:
+            kill_process_tree(process)
+        if capped or cancelled:
+            stop.set()
+        usage = None
+        try:
+            return_code, usage = _wait_with_usage(process, max(deadline - time.monotonic(), 1))
+        except subprocess.TimeoutExpired:
+            kill_process_tree(process)
+            timed_out = True
+            return_code = process.wait()
+        if not (timed_out or capped or cancelled):
+            reap_leftover_group(process)
+        self._drain(readers, chunks, captures, lines, stop)
+        lines.finish()
+        
+        output = captures['stdout'].text()
+        stderr = captures['stderr'].text()
+        if timed_out:
+            result = {
+                'success': False,
+                'output': output,
+                'error': f'Command timed out after {timeout} seconds'
+            }
+        elif cancelled:
+            result = {
+                'success': False,
+                'output': output,
+                'error': 'Command cancelled'
+            }
+        elif capped:
+            logger.warning(f"Stopped `{command}` after more than {self.max_bytes} bytes of output")
+            result = {
+                'success': False,
+                'output': output,
+                'error': f'Command stopped after producing more than {self.max_bytes} bytes of output'
+            }
+        else:
+            result = {
+                'success': return_code == 0,
+                'output': output,
+                'error': stderr if stderr else None,
+                'return_code': return_code,
+                'execution_time': time.time()
+            }
+        # How much the command wrote and how much of it was not kept
+        result['output_bytes'] = captures['stdout'].total + captures['stderr'].total
+        result['dropped_bytes'] = captures['stdout'].dropped + captures['stderr'].dropped
+        result['resources'] = _resources(time.monotonic() - started, usage)
+        return result
+    
+    def _drain(self, readers, chunks, captures, lines, stop):
+        """Collect what the readers picked up after the main loop ended, then stop them
+        
+        Bounded to about a second, so a process that keeps writing cannot hold
+        the caller; once stopped, the readers close their end of the pipes
+        within READ_POLL_INTERVAL (on Windows, only once the pipe has data or closes).
+        """
+        finished = time.monotonic() + 1
+        while not stop.is_set() and time.monotonic() < finished:
+            if not chunks.empty():
+                item = chunks.get_nowait()
+            elif any(reader.is_alive() for reader in readers):
+                try:
+                    item = chunks.get(timeout=0.05)
+                except queue.Empty:
+                    continue
+            else:
+                break
+            if item is not _EOF:
+                captures[item[0]].write(item[1])
+                lines.feed(item[0], item[1], captures[item[0]].total)
+        stop.set()
+    
+    def _pump(self, pipe, stream, chunks, stop):
+        try:
+            fd = pipe.fileno()
+            while not stop.is_set():
+                # Poll so a pipe held open by a silent survivor cannot block the reader for ever
+                if os.name != 'nt' and not select.select([fd], [], [], READ_POLL_INTERVAL)[0]:
+                    continue
+                data = os.read(fd, self.chunk_size)
+                if not data:
+                    break
+                self._put(chunks, (stream, data), stop)
+        except (OSError, ValueError):
+            pass  # the pipe was closed under us after a kill
+        finally:
+            pipe.close()
+            self._put(chunks, _EOF, stop)
+    
+    @staticmethod
+    def _put(chunks, item, stop):
+        """Queue an item, giving up once the run has stopped listening"""
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+class _LineBatcher:
+    """Splits streamed chunks into lines and delivers them in timed batches"""
+    
+    def __init__(self, runner, on_output):
+        self.runner = runner
+        self.on_output = on_output
+        self.pending = {'stdout': b'', 'stderr': b''}
+        self.batch = []
+        self.last_flush = time.monotonic()
+    
+    def feed(self, stream, data, stream_total):
+        """Add a chunk; complete lines within the streamed head join the batch"""
+        if self.on_output is None or stream_total - len(data) >= self.runner.head_bytes:
+            return
+        buffered = self.pending[stream] + data
+        *complete, rest = buffered.split(b'\n')
+        # A line longer than a read chunk is delivered in pieces rather than buffered
+        if len(rest) > self.runner.chunk_size:
+            complete.append(rest)
+            rest = b''
+        self.pending[stream] = rest
+        for line in complete:
+            self.batch.append({'stream': stream, 'line': line.decode('utf-8', errors='replace').rstrip('\r')})
+        if len(self.batch) >= self.runner.batch_lines:
+            self.flush()
+    
+    def wait(self, remaining):
+        """How long the reader loop may block before a pending batch is due"""
+        if not self.batch:
+            return remaining
+        return min(remaining, max(self.last_flush + self.runner.batch_interval - time.monotonic(), 0))
+    
+    def flush_due(self):
+        if self.batch and time.monotonic() - self.last_flush >= self.runner.batch_interval:
+            self.flush()
+    
+    def flush(self):
+        batch, self.batch = self.batch, []
+        self.last_flush = time.monotonic()
+        _deliver(batch, self.on_output)
+    
+    def finish(self):
+        """Deliver the unterminated last lines and anything still batched"""
+        for stream, rest in self.pending.items():
+            if rest:
+                self.batch.append({'stream': stream, 'line': rest.decode('utf-8', errors='replace').rstrip('\r')})
+        self.pending = {'stdout': b'', 'stderr': b''}
+        self.flush()
+
+def _deliver(batch, on_output):
+    if not batch or on_output is None:
+        return
+    try:
+        on_output(batch)
+    except Exception as e:
+        logger.warning(f"Error delivering command output: {str(e)}")
+
+def emit_in_batches(output, on_output, batch_lines=None):
+    """Deliver an already complete output through the same line-batch callback"""
+    batch_lines = batch_lines or Config.COMMAND_STREAM_BATCH_LINES
+    batch = [{'stream': 'stdout', 'line': line} for line in (output or '').splitlines()]
+    for start in range(0, len(batch), batch_lines):
+        _deliver(batch[start:start + batch_lines], on_output)
@@ -0,0 +1,277 @@
+import copy
+import hashlib
+import logging
+import re
+import struct
+import threading
+import time
+from collections import OrderedDict
+from config import Config
+from modules.prompts import normalize_os
+
+logger = logging.getLogger(__name__)
+
+# Words that carry no meaning for matching helpdesk questions
+STOPWORDS = frozenset("""
+a an the and or but so to of in on at for with from by is are was were be been am
+i im i'm me my mine we our you your it its it's this that these those there here
+can could would should will just please pls help hi hello hey thanks thank any some
+do does did doing have has had get got getting keep keeps still
+very really again now today anymore all what why how when
+""".split())
+
+# Spellings folded to one token before shingling
+SYNONYMS = {
+    'wi-fi': 'wifi',
+    'wireless': 'wifi',
+    'wlan': 'wifi',
+    'internet': 'network',
+    'connection': 'network',
+    'connectivity': 'network',
+    'offline': 'down',
+    'broken': 'down',
+    'working': 'work',
+    'works': 'work',
+    # Negations are kept: "working" and "not working" are opposite questions
+    'dont': 'not',
+    "don't": 'not',
+    'doesnt': 'not',
+    "doesn't": 'not',
+    'isnt': 'not',
+    "isn't": 'not',
+    'cant': 'not',
+    "can't": 'not',
+    'cannot': 'not',
+    'wont': 'not',
+    "won't": 'not',
+    'no': 'not',
+    'laptop': 'computer',
+    'pc': 'computer',
+    'mac': 'computer',
+    'machine': 'computer',
+}
+
+# Mersenne prime used for the MinHash permutations
+_MERSENNE_PRIME = (1 << 61) - 1
+
+def normalize_message(message):
+    """Reduce a message to its meaningful, canonically spelled tokens"""
+    text = (message or '').lower()
+    text = re.sub(r'\bwi[\s-]?fi\b', 'wifi', text)
+    text = re.sub(r"[^a-z0-9'\s-]+", ' ', text)
+    tokens = []
+    for token in text.split():
+        token = token.strip("'-")
+        token = SYNONYMS.get(token, token)
+        if not token or token in STOPWORDS:
+            continue
+        # Cheap plural folding: "printers" and "printer" are the same question
+        if len(token) > 3 and token.endswith('s') and not token.endswith('ss'):
+            token = token[:-1]
+        tokens.append(token)
+    return tokens
+
+def shingles(tokens):
+    """Word unigrams and bigrams used for near-duplicate matching"""
+    result = set(tokens)
+    result.update(f"{first} {second}" for first, second in zip(tokens, tokens[1:]))
+    return result
+
+def _stable_hash(value):
+    return struct.unpack('<Q', hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest())[0]
+
+class MinHasher:
+    """Computes fixed-size MinHash signatures whose agreement estimates Jaccard similarity"""
+    
+    def __init__(self, num_perm):
+        self.num_perm = num_perm
+        # Deterministic permutations so signatures are comparable across restarts
+        self._permutations = [
+            (_stable_hash(f"a{i}") % (_MERSENNE_PRIME - 1) + 1, _stable_hash(f"b{i}") % _MERSENNE_PRIME)
+            for i in range(num_perm)
+        ]
+    
+    def signature(self, shingle_set):
+        """Return the MinHash signature of a set of shingles"""
+        hashes = [_stable_hash(shingle) for shingle in shingle_set]
+        if not hashes:
+            return (0,) * self.num_perm
+        return tuple(
+            min((a * value + b) % _MERSENNE_PRIME for value in hashes)
+            for a, b in self._permutations
+        )
+
+class _CachedAnswer:
+    __slots__ = ('os_key', 'fingerprint', 'shingles', 'signature', 'response', 'expires_at', 'hits')
+    
+    def __init__(self, os_key, fingerprint, shingle_set, signature, response, expires_at):
+        self.os_key = os_key
+        self.fingerprint = fingerprint
+        self.shingles = shingle_set
+        self.signature = signature
+        self.response = response
+        self.expires_at = expires_at
+        self.hits = 0
+
+class ResponseCache:
+    """Answers repeated first-turn helpdesk questions without calling GPT-4o
+    
+    Questions are keyed by OS plus a fingerprint of their normalized tokens, so
+    "WiFi not working!" and "wifi is not working" hit the same entry. Near
+    duplicates ("my wifi keeps dropping" vs "wifi keeps dropping out") are found
+    through MinHash signatures bucketed with locality-sensitive hashing and
+    accepted when their shingle Jaccard similarity reaches ``similarity_threshold``.
+    Entries expire after ``ttl`` seconds and are evicted least-recently-used.
+    """
+    
+    def __init__(self, max_entries=None, ttl=None, similarity_threshold=None, num_perm=None, bands=None):
+        self.max_entries = max_entries or Config.RESPONSE_CACHE_MAX_ENTRIES
+        self.ttl = ttl or Config.RESPONSE_CACHE_TTL
+        self.similarity_threshold = similarity_threshold or Config.RESPONSE_CACHE_SIMILARITY
+        self.num_perm = num_perm or Config.RESPONSE_CACHE_NUM_PERM
+        self.bands = bands or Config.RESPONSE_CACHE_BANDS
+        if self.num_perm % self.bands:
+            raise ValueError("RESPONSE_CACHE_NUM_PERM must be a multiple of RESPONSE_CACHE_BANDS")
+        self.rows = self.num_perm // self.bands
+        
+        self._hasher = MinHasher(self.num_perm)
+        self._entries = OrderedDict()
+        self._buckets = {}
+        self._lock = threading.Lock()
+        
+        self.exact_hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.expirations = 0
+    
+    def get(self, os_type, message):
+        """Return a copy of the cached answer for a question, or None"""
+        os_key, tokens = self._key(os_type, message)
+        if not tokens:
+            return None
+        fingerprint = self._fingerprint(os_key, tokens)
+        now = time.time()
+        
+        with self._lock:
+            entry = self._live_entry_locked(fingerprint, now)
+            if entry:
+                self.exact_hits += 1
+                return self._hit_locked(entry)
+        
+        shingle_set = shingles(tokens)
+        signature = self._hasher.signature(shingle_set)
+        with self._lock:
+            best, best_score = None, 0.0
+            for candidate in self._candidates_locked(os_key, signature):
+                entry = self._live_entry_locked(candidate, now)
+                if not entry:
+                    continue
+                score = _jaccard(shingle_set, entry.shingles)
+                if score > best_score:
+                    best, best_score = entry, score
+            if best and best_score >= self.similarity_threshold:
+                self.near_hits += 1
+                logger.debug(f"Response cache near hit (similarity {best_score:.2f})")
+                return self._hit_locked(best)
+            self.misses += 1
+            return None
+    
+    def set(self, os_type, message, response):
+        """Cache the answer given to a first-turn question"""
+        os_key, tokens = self._key(os_type, message)
+        if not tokens:
+            return
+        fingerprint = self._fingerprint(os_key, tokens)
+        shingle_set = shingles(tokens)
+        entry = _CachedAnswer(
+            os_key, fingerprint, shingle_set, self._hasher.signature(shingle_set),
+            copy.deepcopy(response), time.time() + self.ttl
+        )
+        
+        with self._lock:
+            if fingerprint in self._entries:
+                self._remove_locked(fingerprint)
+            self._entries[fingerprint] = entry
+            for band_key in self._band_keys(os_key, entry.signature):
+                self._buckets.setdefault(band_key, set()).add(fingerprint)
+            self.stores += 1
+            while len(self._entries) > self.max_entries:
+                oldest = next(iter(self._entries))
+                self._remove_locked(oldest)
+                self.evictions += 1
+    
+    def clear(self):
+        """Drop every cached answer"""
+        with self._lock:
+            self._entries.clear()
+            self._buckets.clear()
+    
+    def get_stats(self):
+        """Get cache statistics"""
+        with self._lock:
+            hits = self.exact_hits + self.near_hits
+            lookups = hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'similarity_threshold': self.similarity_threshold,
+                'exact_hits': self.exact_hits,
+                'near_hits': self.near_hits,
+                'misses': self.misses,
+                'hit_rate': round(hits / lookups, 3) if lookups else 0.0,
+                'stores': self.stores,
+                'evictions': self.evictions,
+                'expirations': self.expirations
+            }
+    
+    def _key(self, os_type, message):
+        return normalize_os(os_type) or (os_type or '').lower(), normalize_message(message)
+    
+    @staticmethod
+    def _fingerprint(os_key, tokens):
+        # Word order matters ("wifi works but ethernet does not"); reorderings are left to the shingle match
+        canonical = f"{os_key}|{' '.join(tokens)}"
+        return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+    
+    def _band_keys(self, os_key, signature):
+        for band in range(self.bands):
+            start = band * self.rows
+            yield (os_key, band, signature[start:start + self.rows])
+    
+    def _candidates_locked(self, os_key, signature):
+        candidates = set()
+        for band_key in self._band_keys(os_key, signature):
+            candidates.update(self._buckets.get(band_key, ()))
+        return candidates
+    
+    def _live_entry_locked(self, fingerprint, now):
+        entry = self._entries.get(fingerprint)
+        if entry and entry.expires_at <= now:
+            self._remove_locked(fingerprint)
+            self.expirations += 1
+            return None
+        return entry
+    
+    def _hit_locked(self, entry):
+        entry.hits += 1
+        self._entries.move_to_end(entry.fingerprint)
+        return copy.deepcopy(entry.response)
+    
+    def _remove_locked(self, fingerprint):
+        entry = self._entries.pop(fingerprint, None)
+        if not entry:
+            return
+        for band_key in self._band_keys(entry.os_key, entry.signature):
+            bucket = self._buckets.get(band_key)
+            if bucket:
+                bucket.discard(fingerprint)
+                if not bucket:
+                    del self._buckets[band_key]
+
+def _jaccard(first, second):
+    if not first or not second:
+        return 0.0
+    return len(first & second) / len(first | second)
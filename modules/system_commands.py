@@ -1,23 +1,241 @@
-import subprocess
 import platform
 import logging
 import psutil
 import time
 import getpass
 import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from config import Config
+from modules.native_commands import NativeCommands
+from modules.process_runner import ProcessRunner, emit_in_batches, get_reaper_stats, run_in_group
 
 logger = logging.getLogger(__name__)
 
+class _CacheEntry:
+    """A cached value with its expiry time and approximate size"""
+    
+    __slots__ = ('value', 'expires_at', 'size')
+    
+    def __init__(self, value, expires_at, size):
+        self.value = value
+        self.expires_at = expires_at
+        self.size = size
+
+class _Flight:
+    """An in-progress load that concurrent callers for the same key wait on"""
+    
+    __slots__ = ('event', 'value', 'error')
+    
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+class CommandCache:
+    """Thread-safe LRU cache with per-entry TTLs, size bounds and single-flight loading
+    
+    Entries are evicted least-recently-used first once either ``max_entries`` or
+    ``max_bytes`` is exceeded, and a background sweeper drops expired entries so
+    they do not sit in memory until the next lookup. ``get_or_load`` makes sure
+    only one caller runs the loader for a key while the others wait for its result.
+    """
+    
+    def __init__(self, max_entries=None, max_bytes=None, default_ttl=None, sweep_interval=None):
+        self.max_entries = max_entries or Config.COMMAND_CACHE_MAX_ENTRIES
+        self.max_bytes = max_bytes or Config.COMMAND_CACHE_MAX_BYTES
+        self.default_ttl = default_ttl or Config.CACHE_TIMEOUT
+        self.sweep_interval = sweep_interval or Config.CACHE_SWEEP_INTERVAL
+        
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self._sweeper = None
+        self._stop = threading.Event()
+        
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.loads = 0
+        self.coalesced = 0
+    
+    def get(self, key):
+        """Return the cached value for key, or None if missing or expired"""
+        with self._lock:
+            return self._get_locked(key, time.time())
+    
+    def set(self, key, value, ttl=None):
+        """Store a value under key for ttl seconds"""
+        ttl = ttl if ttl is not None else self.default_ttl
+        size = self._estimate_size(value)
+        if size > self.max_bytes:
+            return
+        
+        with self._lock:
+            existing = self._entries.pop(key, None)
+            if existing:
+                self._bytes -= existing.size
+            self._entries[key] = _CacheEntry(value, time.time() + ttl, size)
+            self._bytes += size
+            self._evict_locked()
+        self._ensure_sweeper()
+    
+    def get_or_load(self, key, loader, ttl=None, should_cache=None):
+        """Return the cached value for key, running loader at most once across threads on a miss"""
+        with self._lock:
+            value = self._get_locked(key, time.time())
+            if value is not None:
+                return value
+            
+            flight = self._inflight.get(key)
+            if flight is None:
+                flight = _Flight()
+                self._inflight[key] = flight
+                leader = True
+                self.loads += 1
+            else:
+                leader = False
+                self.coalesced += 1
+        
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+        
+        try:
+            flight.value = loader()
+            if should_cache is None or should_cache(flight.value):
+                self.set(key, flight.value, ttl)
+            return flight.value
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.event.set()
+    
+    def invalidate(self, key):
+        """Remove a single entry"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry:
+                self._bytes -= entry.size
+    
+    def clear(self):
+        """Remove all entries"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+    
+    def sweep(self):
+        """Drop every expired entry and return how many were removed"""
+        now = time.time()
+        removed = 0
+        with self._lock:
+            for key in [k for k, entry in self._entries.items() if entry.expires_at <= now]:
+                self._bytes -= self._entries.pop(key).size
+                removed += 1
+            self.expirations += removed
+        return removed
+    
+    def get_stats(self):
+        """Get cache statistics"""
+        now = time.time()
+        with self._lock:
+            valid_entries = sum(1 for entry in self._entries.values() if entry.expires_at > now)
+            total_entries = len(self._entries)
+            lookups = self.hits + self.misses
+            return {
+                'total_entries': total_entries,
+                'valid_entries': valid_entries,
+                'expired_entries': total_entries - valid_entries,
+                'total_bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'loads': self.loads,
+                'coalesced_loads': self.coalesced,
+                'in_flight': len(self._inflight)
+            }
+    
+    def stop(self):
+        """Stop the background sweeper"""
+        self._stop.set()
+    
+    def _get_locked(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry.expires_at <= now:
+            del self._entries[key]
+            self._bytes -= entry.size
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry.value
+    
+    def _evict_locked(self):
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            _, entry = self._entries.popitem(last=False)
+            self._bytes -= entry.size
+            self.evictions += 1
+    
+    def _ensure_sweeper(self):
+        if self._sweeper is not None:
+            return
+        with self._lock:
+            if self._sweeper is None:
+                self._sweeper = threading.Thread(target=self._sweep_loop, name='command-cache-sweeper', daemon=True)
+                self._sweeper.start()
+    
+    def _sweep_loop(self):
+        while not self._stop.wait(self.sweep_interval):
+            try:
+                removed = self.sweep()
+                if removed:
+                    logger.debug(f"Swept {removed} expired command cache entries")
+            except Exception as e:
+                logger.error(f"Error sweeping command cache: {str(e)}")
+    
+    @staticmethod
+    def _estimate_size(value):
+        """Approximate the memory held by a cached command result"""
+        if isinstance(value, dict):
+            return sum(len(str(k)) + len(str(v)) for k, v in value.items())
+        return len(str(value))
+
 class SystemCommands:
     """Handles safe execution of system commands"""
     
     def __init__(self):
         """Initialize system commands handler"""
         self.os_type = platform.system().lower()
-        self.command_cache = {}  # Simple cache for quick commands
-        self.cache_timeout = 30  # Cache for 30 seconds
+        self.cache_timeout = Config.CACHE_TIMEOUT  # Default TTL for cached commands
+        self.command_cache = CommandCache(default_ttl=self.cache_timeout)
         self.sudo_password = None  # Store sudo password for macOS
+        # In-process psutil/procfs answers for common read-only commands
+        self.native_commands = NativeCommands(self.os_type)
+        self.process_runner = ProcessRunner()
+        # Speculatively prefetched results waiting for the user to click "Run", by expiry time
+        self._prefetched = {}
+        self._prefetch_lock = threading.Lock()
+        self._prefetch_executor = None
+        self.prefetch_started = 0
+        self.prefetch_skipped = 0
+        self.prefetch_hits = 0
+        self.prefetch_expired = 0
     
     def set_sudo_password(self, password):
         """Set sudo password for macOS commands"""
@@ -27,13 +245,7 @@ class SystemCommands:
     def execute_command(self, command, require_sudo=False):
         """Execute a system command safely with optimized timeouts"""
         try:
-            # Check cache first for quick commands
             cache_key = f"{command}_{self.os_type}_{require_sudo}"
-            if cache_key in self.command_cache:
-                cache_entry = self.command_cache[cache_key]
-                if time.time() - cache_entry['timestamp'] < self.cache_timeout:
-                    logger.info(f"Using cached result for command: {command}")
-                    return cache_entry['result']
             
             # Validate command before execution
             if not self._is_command_safe(command):
@@ -43,66 +255,109 @@ class SystemCommands:
                     'error': 'Security validation failed'
                 }
             
+            # A speculatively prefetched result is served once, whatever the command
+            if not require_sudo:
+                prefetched = self._take_prefetched(cache_key, command)
+                if prefetched is not None:
+                    return prefetched
+            
+            cacheable = self._is_quick_command(command)
+            ttl = self._get_cache_ttl(command)
+            
             # Handle macOS sudo commands
             if self.os_type == 'darwin' and require_sudo:
                 if not self.sudo_password:
-                    return {
-                        'success': False,
-                        'output': '',
-                        'error': 'Sudo password required for this command. Please provide your password.',
-                        'requires_password': True
-                    }
-                # Prepend sudo to command
-                command = f"echo '{self.sudo_password}' | sudo -S {command}"
+                    return self._password_required()
+                command = self._with_sudo(command)
             
             # Determine timeout based on command type
             timeout = self._get_command_timeout(command)
             
-            # Execute command with optimized timeout
-            result = subprocess.run(
-                command,
-                shell=True,
-                capture_output=True,
-                text=True,
-                timeout=timeout
-            )
-            
-            # Truncate output if too long
-            output = result.stdout
-            if len(output) > Config.MAX_COMMAND_OUTPUT:
-                output = output[:Config.MAX_COMMAND_OUTPUT] + "\n... (output truncated)"
-            
-            result_data = {
-                'success': result.returncode == 0,
-                'output': output,
-                'error': result.stderr if result.stderr else None,
-                'return_code': result.returncode,
-                'execution_time': time.time()
-            }
-            
-            # Cache quick commands
-            if self._is_quick_command(command):
-                self.command_cache[cache_key] = {
-                    'result': result_data,
-                    'timestamp': time.time()
-                }
+            if not cacheable:
+                return self._run_command(command, timeout)
             
-            return result_data
+            # Only one thread spawns the process for a given command; the rest share its result
+            return self.command_cache.get_or_load(
+                cache_key,
+                lambda: self._run_command(command, timeout),
+                ttl=ttl,
+                should_cache=lambda result: 'return_code' in result
+            )
             
-        except subprocess.TimeoutExpired:
+        except Exception as e:
+            logger.error(f"Error executing command '{command}': {str(e)}")
             return {
                 'success': False,
                 'output': '',
-                'error': f'Command timed out after {timeout} seconds'
+                'error': f'Command execution failed: {str(e)}'
             }
+    
+    def execute_command_stream(self, command, on_output, require_sudo=False, cancel=None):
+        """Execute a command like execute_command, passing output line batches to on_output as they arrive
+        
+        Uses the same allowlist and per-command timeouts. Results are not read
+        from or stored in the command cache: the caller wants live output.
+        Setting the ``cancel`` event kills the command's whole process tree.
+        """
+        try:
+            if not self._is_command_safe(command):
+                return {
+                    'success': False,
+                    'output': 'Command not allowed for security reasons',
+                    'error': 'Security validation failed'
+                }
+            
+            if self.os_type == 'darwin' and require_sudo:
+                if not self.sudo_password:
+                    return self._password_required()
+                command = self._with_sudo(command)
+            
+            native = self.native_commands.execute(command)
+            if native is not None:
+                emit_in_batches(native['output'], on_output)
+                return native
+            
+            return self.process_runner.run(command, self._get_command_timeout(command), on_output, cancel)
+            
         except Exception as e:
-            logger.error(f"Error executing command '{command}': {str(e)}")
+            logger.error(f"Error streaming command '{command}': {str(e)}")
             return {
                 'success': False,
                 'output': '',
                 'error': f'Command execution failed: {str(e)}'
             }
     
+    @staticmethod
+    def _password_required():
+        return {
+            'success': False,
+            'output': '',
+            'error': 'Sudo password required for this command. Please provide your password.',
+            'requires_password': True
+        }
+    
+    def _with_sudo(self, command):
+        """Prepend sudo to a command, feeding it the stored password"""
+        return f"echo '{self.sudo_password}' | sudo -S {command}"
+    
+    def _run_command(self, command, timeout):
+        """Run a validated command and build the result dictionary"""
+        # df, free, ps, netstat, ip addr, ... are answered without forking a shell
+        native = self.native_commands.execute(command)
+        if native is not None:
+            return native
+        
+        # Output is captured head + tail in fixed memory; runaway commands are stopped
+        return self.process_runner.run(command, timeout)
+    
+    def _get_cache_ttl(self, command):
+        """Get cache TTL for a command from the per-command table"""
+        command_lower = command.lower()
+        for prefix, ttl in Config.COMMAND_CACHE_TTLS.items():
+            if command_lower.startswith(prefix):
+                return ttl
+        return self.cache_timeout
+    
     def _get_command_timeout(self, command):
         """Get appropriate timeout for command type"""
         command_lower = command.lower()
@@ -131,24 +386,101 @@ class SystemCommands:
         self.command_cache.clear()
         logger.info("Command cache cleared")
     
-    def get_cache_stats(self):
-        """Get cache statistics"""
-        current_time = time.time()
-        valid_entries = 0
-        expired_entries = 0
+    def prefetch(self, commands):
+        """Run read-only commands in the background so a later execute_command is served from cache
         
-        for cache_entry in self.command_cache.values():
-            if current_time - cache_entry['timestamp'] < self.cache_timeout:
-                valid_entries += 1
-            else:
-                expired_entries += 1
+        Commands that fail validation, need sudo, or are already cached are skipped.
+        Returns the commands that were scheduled.
+        """
+        scheduled = []
+        for command in commands:
+            cache_key = f"{command}_{self.os_type}_False"
+            with self._prefetch_lock:
+                self._expire_prefetched()
+                skip = (cache_key in self._prefetched or self._requires_sudo(command)
+                        or not self._is_command_safe(command))
+                if not skip:
+                    # The result is kept for PREFETCH_TTL after the command can have finished
+                    self._prefetched[cache_key] = (
+                        time.monotonic() + self._get_command_timeout(command) + Config.PREFETCH_TTL
+                    )
+            if skip:
+                self.prefetch_skipped += 1
+                continue
+            self.prefetch_started += 1
+            self._get_prefetch_executor().submit(self._prefetch_command, command, cache_key)
+            scheduled.append(command)
+        return scheduled
+    
+    def _prefetch_command(self, command, cache_key):
+        try:
+            ttl = max(self._get_cache_ttl(command), Config.PREFETCH_TTL)
+            timeout = self._get_command_timeout(command)
+            self.command_cache.get_or_load(
+                cache_key,
+                lambda: self._run_command(command, timeout),
+                ttl=ttl,
+                should_cache=lambda result: 'return_code' in result
+            )
+            logger.debug(f"Prefetched command: {command}")
+        except Exception as e:
+            logger.warning(f"Error prefetching command '{command}': {str(e)}")
+            with self._prefetch_lock:
+                self._prefetched.pop(cache_key, None)
+    
+    def _expire_prefetched(self):
+        """Forget prefetches the user never ran; call with _prefetch_lock held"""
+        now = time.monotonic()
+        expired = [cache_key for cache_key, expires in self._prefetched.items() if expires <= now]
+        for cache_key in expired:
+            del self._prefetched[cache_key]
+        self.prefetch_expired += len(expired)
+    
+    def _take_prefetched(self, cache_key, command):
+        """Return a prefetched result once, waiting for it if it is still running"""
+        with self._prefetch_lock:
+            self._expire_prefetched()
+            if self._prefetched.pop(cache_key, None) is None:
+                return None
         
-        return {
-            'total_entries': len(self.command_cache),
-            'valid_entries': valid_entries,
-            'expired_entries': expired_entries,
-            'cache_timeout': self.cache_timeout
-        }
+        # get_or_load joins a prefetch that is still in flight instead of starting a second process
+        timeout = self._get_command_timeout(command)
+        result = self.command_cache.get_or_load(
+            cache_key,
+            lambda: self._run_command(command, timeout),
+            ttl=self._get_cache_ttl(command),
+            should_cache=lambda result: 'return_code' in result
+        )
+        self.prefetch_hits += 1
+        if not self._is_quick_command(command):
+            # Output of commands that are not normally cached is only reused for this one click
+            self.command_cache.invalidate(cache_key)
+        return result
+    
+    def _get_prefetch_executor(self):
+        with self._prefetch_lock:
+            if self._prefetch_executor is None:
+                self._prefetch_executor = ThreadPoolExecutor(
+                    max_workers=Config.PREFETCH_WORKERS, thread_name_prefix='diagnostic-prefetch'
+                )
+            return self._prefetch_executor
+    
+    def get_cache_stats(self):
+        """Get cache statistics"""
+        stats = self.command_cache.get_stats()
+        stats['cache_timeout'] = self.cache_timeout
+        with self._prefetch_lock:
+            self._expire_prefetched()
+            stats['prefetch'] = {
+                'started': self.prefetch_started,
+                'skipped': self.prefetch_skipped,
+                'hits': self.prefetch_hits,
+                'expired': self.prefetch_expired,
+                'waiting': len(self._prefetched)
+            }
+        stats['native'] = self.native_commands.get_stats()
+        stats['processes'] = get_reaper_stats()
+        return stats
     
     def _is_quick_command(self, command):
         """Check if command is suitable for caching"""
@@ -246,18 +578,18 @@ class SystemCommands:
             
             # Get network interfaces
             if self.os_type == 'windows':
-                result = subprocess.run('ipconfig', shell=True, capture_output=True, text=True, timeout=10)
+                result = run_in_group('ipconfig', timeout=10)
                 network_info['interfaces'] = result.stdout
             else:
-                result = subprocess.run('ifconfig', shell=True, capture_output=True, text=True, timeout=10)
+                result = run_in_group('ifconfig', timeout=10)
                 network_info['interfaces'] = result.stdout
             
             # Get routing table
             try:
                 if self.os_type == 'windows':
-                    route_result = subprocess.run('route print', shell=True, capture_output=True, text=True, timeout=10)
+                    route_result = run_in_group('route print', timeout=10)
                 else:
-                    route_result = subprocess.run('netstat -rn', shell=True, capture_output=True, text=True, timeout=10)
+                    route_result = run_in_group('netstat -rn', timeout=10)
                 network_info['routing'] = route_result.stdout
             except:
                 network_info['routing'] = "Unable to get routing information"
@@ -271,9 +603,12 @@ class SystemCommands:
         """Get list of running processes"""
         try:
             if self.os_type == 'windows':
-                result = subprocess.run('tasklist /v', shell=True, capture_output=True, text=True, timeout=15)
+                result = run_in_group('tasklist /v', timeout=15)
             else:
-                result = subprocess.run('ps aux --sort=-%cpu | head -20', shell=True, capture_output=True, text=True, timeout=15)
+                native = self.native_commands.execute('ps aux --sort=-%cpu | head -20')
+                if native is not None:
+                    return {'success': True, 'output': native['output'], 'error': None}
+                result = run_in_group('ps aux --sort=-%cpu | head -20', timeout=15)
             
             return {
                 'success': result.returncode == 0,
@@ -0,0 +1,260 @@
+import ipaddress
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional, Tuple
+from config import Config
+from modules.output_reducers import parse_output
+
+logger = logging.getLogger(__name__)
+
+# OS-specific commands quoted in the templated next steps
+FLUSH_DNS = {
+    'windows': 'ipconfig /flushdns',
+    'darwin': 'sudo dscacheutil -flushcache; sudo killall -HUP mDNSResponder',
+    'linux': 'resolvectl flush-caches'
+}
+RENEW_DHCP = {
+    'windows': 'ipconfig /release && ipconfig /renew',
+    'darwin': 'sudo ipconfig set en0 DHCP',
+    'linux': 'sudo dhclient -r && sudo dhclient'
+}
+DISK_CLEANUP = {
+    'windows': 'Run **Disk Cleanup** (`cleanmgr`), empty the Recycle Bin and clear `%TEMP%`',
+    'darwin': 'Open **About This Mac → Storage → Manage**, empty the Trash and clear `~/Library/Caches`',
+    'linux': 'Find large directories with `du -sh /* 2>/dev/null | sort -h`, then clear old logs (`journalctl --vacuum-size=200M`) and package caches'
+}
+
+@dataclass
+class VerdictRule:
+    """A rule that recognizes a clear-cut command result and answers it from a template"""
+    name: str
+    reducer: str  # output reducer whose facts the rule reads
+    confidence: float
+    check: Callable[[Dict, str], Optional[str]]  # (facts, os_type) -> markdown response or None
+
+def _is_ip_literal(host):
+    try:
+        ipaddress.ip_address(host or '')
+        return True
+    except ValueError:
+        return False
+
+def _ping_unresolved(facts, os_type):
+    if not any(error.startswith('name resolution failed') for error in facts.get('errors', [])):
+        return None
+    return (
+        "**Verdict: the host name could not be resolved.**\n\n"
+        "Ping never sent a packet because DNS did not return an address, so this is a name "
+        "resolution problem rather than a connectivity one.\n\n"
+        "**Next steps:**\n"
+        "1. Check the spelling of the host name\n"
+        f"2. Flush the DNS cache: `{FLUSH_DNS[os_type]}`\n"
+        "3. Test DNS directly with `nslookup google.com`; if that also fails, switch to a public DNS server (8.8.8.8 or 1.1.1.1)"
+    )
+
+def _ping_total_loss(facts, os_type):
+    if not facts.get('sent') or facts.get('received') != 0:
+        return None
+    host = facts.get('host') or facts.get('ip') or 'the host'
+    return (
+        f"**Verdict: {host} is unreachable (100% packet loss).**\n\n"
+        f"All {facts['sent']} packets were lost. Either this computer has no working network path, "
+        "or the target drops ping.\n\n"
+        "**Next steps:**\n"
+        "1. Ping your router/gateway; if that also fails, the problem is local (cable, Wi-Fi, adapter)\n"
+        "2. Ping `8.8.8.8`; if the gateway answers but this fails, the internet connection is down\n"
+        "3. Restart the router and reconnect to the network, then run the ping again"
+    )
+
+def _ping_healthy(facts, os_type):
+    rtt = facts.get('rtt_ms') or {}
+    if facts.get('loss_pct') != 0 or not facts.get('received') or facts.get('errors') or (rtt.get('avg') or 0) >= 100:
+        return None
+    host = facts.get('host') or facts.get('ip') or 'the host'
+    # Pinging an address proves nothing about DNS
+    resolved = facts.get('host') and not _is_ip_literal(facts['host'])
+    working = 'Basic connectivity and DNS are' if resolved else 'Basic connectivity is'
+    return (
+        f"**Verdict: the connection to {host} is healthy.**\n\n"
+        f"{facts['received']}/{facts['sent']} replies with no packet loss"
+        + (f" and an average round trip of {rtt['avg']} ms" if rtt.get('avg') is not None else "")
+        + f".\n\n{working} working. If an app or website still fails, the problem is "
+        "likely that service, a proxy/VPN, or the browser: try another site or browser, or disconnect the VPN."
+    )
+
+def _disk_full(facts, os_type):
+    full = [fs for fs in facts.get('filesystems', []) if (fs.get('use_pct') or 0) >= 95]
+    if not full:
+        return None
+    mounts = '\n'.join(f"- `{fs['mount']}`: {fs['use_pct']}% used, {fs['avail']} free" for fs in full)
+    return (
+        "**Verdict: disk space is critically low.**\n\n"
+        f"{mounts}\n\n"
+        "A nearly full disk causes slowness, failed updates and apps that cannot save.\n\n"
+        "**Next steps:**\n"
+        f"1. {DISK_CLEANUP[os_type]}\n"
+        "2. Move large files (videos, downloads, old backups) to external or cloud storage\n"
+        "3. Aim for at least 10-15% free space, then restart the affected apps"
+    )
+
+def _dns_nxdomain(facts, os_type):
+    error = (facts.get('error') or '').lower()
+    # "can't find" alone also covers SERVFAIL, REFUSED and "Server failed", which are not missing names
+    if 'nxdomain' not in error and 'non-existent domain' not in error:
+        return None
+    return (
+        "**Verdict: the domain does not exist (NXDOMAIN).**\n\n"
+        f"The DNS server {facts.get('server', '')} answered, so DNS itself is working, but it has no "
+        "record for this name.\n\n"
+        "**Next steps:**\n"
+        "1. Check the domain for typos\n"
+        "2. If it is an internal/company name, connect to the VPN or office network first\n"
+        f"3. If the name was recently created, wait a few minutes and flush the DNS cache: `{FLUSH_DNS[os_type]}`"
+    )
+
+def _dns_unreachable(facts, os_type):
+    error = (facts.get('error') or '').lower()
+    if 'timed out' not in error and 'no servers could be reached' not in error:
+        return None
+    return (
+        "**Verdict: the DNS server is not responding.**\n\n"
+        "The lookup timed out, so names cannot be translated into addresses; websites will fail to "
+        "load even if the network is up.\n\n"
+        "**Next steps:**\n"
+        "1. Check basic connectivity with `ping 8.8.8.8`\n"
+        "2. If that works, set a public DNS server (8.8.8.8 / 1.1.1.1) in your network settings\n"
+        f"3. Flush the DNS cache: `{FLUSH_DNS[os_type]}`"
+    )
+
+def _dns_resolved(facts, os_type):
+    if facts.get('error') or not facts.get('addresses'):
+        return None
+    name = facts.get('name') or 'the domain'
+    return (
+        f"**Verdict: DNS is working.** {name} resolved to {', '.join(facts['addresses'][:3])}"
+        f" via {facts.get('server', 'your DNS server')}.\n\n"
+        "Name resolution is not the problem. If the site still does not load, test connectivity to it "
+        f"with `ping {name}` and try another browser or disabling any proxy/VPN."
+    )
+
+def _no_ip_address(facts, os_type):
+    interfaces = facts.get('interfaces', [])
+    if not interfaces or any(iface['ipv4'] and not iface.get('loopback') for iface in interfaces):
+        return None
+    return (
+        "**Verdict: no network interface has an IP address.**\n\n"
+        "This computer is not connected to any network, so nothing beyond it can be reached.\n\n"
+        "**Next steps:**\n"
+        "1. Check the cable or reconnect to Wi-Fi\n"
+        f"2. Request a new address: `{RENEW_DHCP[os_type]}`\n"
+        "3. Restart the router if other devices are also offline"
+    )
+
+def _ipconfig_no_lease(facts, os_type):
+    adapters = facts.get('adapters', [])
+    if not adapters and facts.get('disconnected'):
+        return (
+            "**Verdict: every network adapter is disconnected.**\n\n"
+            "**Next steps:**\n"
+            "1. Plug in the network cable or connect to Wi-Fi\n"
+            "2. Make sure Wi-Fi is not turned off and airplane mode is disabled"
+        )
+    if adapters and all((adapter.get('ipv4') or '').startswith('169.254.') for adapter in adapters if adapter.get('ipv4')) \
+            and any(adapter.get('ipv4') for adapter in adapters):
+        return (
+            "**Verdict: the computer did not get an address from DHCP.**\n\n"
+            "The adapter has a self-assigned 169.254.x.x address, which means the router did not answer "
+            "its request for an IP address.\n\n"
+            "**Next steps:**\n"
+            f"1. Renew the lease: `{RENEW_DHCP[os_type]}`\n"
+            "2. Disconnect and reconnect the network, or restart the router\n"
+            "3. If it persists, escalate to IT: the DHCP server may be down"
+        )
+    return None
+
+def _memory_exhausted(facts, os_type):
+    memory = facts.get('mem_mib') or {}
+    total, available = memory.get('total'), memory.get('available')
+    if not total or available is None or available / total > 0.05:
+        return None
+    return (
+        f"**Verdict: memory is almost exhausted** ({available:.0f} MiB of {total:.0f} MiB available).\n\n"
+        "When memory runs out the system swaps heavily, which makes everything slow or unresponsive.\n\n"
+        "**Next steps:**\n"
+        "1. Close unused applications and browser tabs\n"
+        "2. Find the heaviest processes with `ps aux --sort=-%mem | head -10` and close or restart them\n"
+        "3. Restart the computer if memory does not recover"
+    )
+
+# Ordered by specificity: the first confident rule for a reducer wins
+DEFAULT_RULES = [
+    VerdictRule('ping_unresolved', 'ping', 0.95, _ping_unresolved),
+    VerdictRule('ping_total_loss', 'ping', 0.95, _ping_total_loss),
+    VerdictRule('ping_healthy', 'ping', 0.9, _ping_healthy),
+    VerdictRule('disk_full', 'df', 0.95, _disk_full),
+    VerdictRule('dns_nxdomain', 'nslookup', 0.95, _dns_nxdomain),
+    VerdictRule('dns_unreachable', 'nslookup', 0.9, _dns_unreachable),
+    VerdictRule('dns_resolved', 'nslookup', 0.9, _dns_resolved),
+    VerdictRule('no_ip_address', 'ifconfig', 0.9, _no_ip_address),
+    VerdictRule('no_ip_address', 'ip addr', 0.9, _no_ip_address),
+    VerdictRule('ipconfig_no_lease', 'ipconfig', 0.9, _ipconfig_no_lease),
+    VerdictRule('memory_exhausted', 'free', 0.9, _memory_exhausted),
+]
+
+class VerdictEngine:
+    """Answers clear-cut command results locally instead of asking GPT-4o
+    
+    The command's output (and error stream, where tools like ping report
+    failures) is parsed with the output reducers and the rules for that reducer
+    are tried in order. The first rule at or above ``min_confidence`` that
+    recognizes the facts returns a templated next-step response; otherwise the
+    caller falls back to the LLM.
+    """
+    
+    def __init__(self, rules=None, min_confidence=None):
+        self.rules = rules if rules is not None else DEFAULT_RULES
+        self.min_confidence = min_confidence or Config.VERDICT_MIN_CONFIDENCE
+        self._lock = threading.Lock()
+        self.evaluations = 0
+        self.answered = 0
+        self.rule_hits = {}
+    
+    def evaluate(self, command, output, error, os_type) -> Optional[Tuple[str, str]]:
+        """Return (rule name, markdown response) for a clear-cut result, or None"""
+        text = '\n'.join(part for part in (output, error) if part)
+        reducer, facts = parse_output(command, text)
+        verdict = None
+        if facts:
+            os_key = os_type if os_type in FLUSH_DNS else 'linux'
+            for rule in self.rules:
+                if rule.reducer != reducer or rule.confidence < self.min_confidence:
+                    continue
+                try:
+                    response = rule.check(facts, os_key)
+                except Exception as e:
+                    logger.warning(f"Verdict rule {rule.name} failed: {str(e)}")
+                    continue
+                if response:
+                    verdict = (rule.name, response)
+                    break
+        
+        with self._lock:
+            self.evaluations += 1
+            if verdict:
+                self.answered += 1
+                self.rule_hits[verdict[0]] = self.rule_hits.get(verdict[0], 0) + 1
+        if verdict:
+            logger.info(f"Verdict rule {verdict[0]} answered `{command}` without an LLM call")
+        return verdict
+    
+    def get_stats(self):
+        """Get per-rule hit counts and the share of analyses answered locally"""
+        with self._lock:
+            return {
+                'evaluations': self.evaluations,
+                'answered': self.answered,
+                'offload_pct': round(100 * self.answered / self.evaluations, 1) if self.evaluations else 0.0,
+                'min_confidence': self.min_confidence,
+                'rule_hits': {rule.name: self.rule_hits.get(rule.name, 0) for rule in self.rules}
+            }
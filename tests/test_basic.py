@@ -9,8 +9,18 @@ sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from modules.os_detector import OSDetector
 from modules.security import SecurityValidator
-from modules.system_commands import SystemCommands
-from modules.network_tools import NetworkTools
+from modules.system_commands import SystemCommands, CommandCache
+from unittest import mock
+from modules.network_tools import NetworkTools, ConnectivityMonitor
+from modules.chat_handler import ResponseFieldStreamer
+from modules.chat_database import ChatDatabase
+
+def build_chat_handler(chat_database=None):
+    """Build a real ChatHandler with the OpenAI client and database patched"""
+    from modules.chat_handler import ChatHandler
+    with mock.patch('modules.chat_handler.get_llm_client', return_value=mock.MagicMock()), \
+         mock.patch('modules.chat_handler.ChatDatabase', return_value=chat_database or mock.MagicMock()):
+        return ChatHandler()
 
 class TestOSDetector(unittest.TestCase):
     """Test OS detection functionality"""
@@ -115,6 +125,446 @@ class TestSystemCommands(unittest.TestCase):
         result = self.system_commands.execute_command('rm -rf /')
         self.assertFalse(result['success'])
         self.assertIn('not allowed', result['output'])
+    
+    def test_prefetched_result_is_reused(self):
+        """Test a speculatively prefetched command is served without running again"""
+        runs = []
+        original = self.system_commands._run_command
+        
+        def counting_run(command, timeout):
+            runs.append(command)
+            return original(command, timeout)
+        
+        self.system_commands._run_command = counting_run
+        self.assertEqual(self.system_commands.prefetch(['echo prefetched', 'rm -rf /']), ['echo prefetched'])
+        result = self.system_commands.execute_command('echo prefetched')
+        self.assertIn('prefetched', result['output'])
+        self.assertEqual(runs, ['echo prefetched'])
+        self.assertEqual(self.system_commands.get_cache_stats()['prefetch']['hits'], 1)
+    
+    def test_unclaimed_prefetches_expire(self):
+        """Test prefetched results the user never runs stop counting as waiting"""
+        import time
+        self.assertEqual(self.system_commands.prefetch(['echo ignored']), ['echo ignored'])
+        self.assertEqual(self.system_commands.get_cache_stats()['prefetch']['waiting'], 1)
+        later = time.monotonic() + 3600
+        with mock.patch('modules.system_commands.time.monotonic', return_value=later):
+            stats = self.system_commands.get_cache_stats()['prefetch']
+        self.assertEqual((stats['waiting'], stats['expired']), (0, 1))
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), 'native commands mimic the Linux tools')
+    def test_native_commands_skip_the_shell(self):
+        """Test allowlisted read-only commands are answered in-process in the real tool's format"""
+        from modules.output_reducers import parse_output
+        with mock.patch('subprocess.Popen') as spawn:
+            for command in ('free -h', 'df -h', 'ps aux --sort=-%cpu | head -20', 'netstat -an'):
+                result = self.system_commands.execute_command(command)
+                self.assertTrue(result.get('native'), command)
+                self.assertIsNotNone(parse_output(command, result['output'])[1], command)
+            spawn.assert_not_called()
+        self.assertIsNone(self.system_commands.native_commands.execute('ls -la'))
+
+    def test_native_commands_import_without_pwd(self):
+        """Test the native commands still import where the pwd module does not exist (Windows)"""
+        import importlib
+        saved = sys.modules.pop('modules.native_commands')
+        try:
+            with mock.patch.dict(sys.modules, {'pwd': None}):
+                native = importlib.import_module('modules.native_commands')
+                self.assertIsNone(native.pwd)
+                if sys.platform.startswith('linux'):
+                    self.assertIn('PID', native.native_ps(limit=3))
+        finally:
+            sys.modules['modules.native_commands'] = saved
+
+class TestProcessRunner(unittest.TestCase):
+    """Test streaming command execution"""
+    
+    def test_lines_arrive_before_exit(self):
+        """Test output batches are delivered while the process is still running"""
+        import time
+        from modules.process_runner import ProcessRunner
+        batches = []
+        started = time.monotonic()
+        script = 'import time; print("first", flush=True); time.sleep(0.5); print("second")'
+        result = ProcessRunner(batch_lines=10, batch_interval=0.05).run(
+            f'{sys.executable} -c \'{script}\'', 5,
+            lambda lines: batches.append((time.monotonic() - started, lines))
+        )
+        self.assertTrue(result['success'])
+        self.assertEqual(result['output'], 'first\nsecond\n')
+        self.assertEqual([line['line'] for _, lines in batches for line in lines], ['first', 'second'])
+        self.assertLess(batches[0][0], 0.4)
+    
+    def test_timeout_kills_process(self):
+        """Test a command running past its timeout is killed and reported"""
+        from modules.process_runner import ProcessRunner
+        result = ProcessRunner().run(f'{sys.executable} -c "import time; time.sleep(5)"', 0.3)
+        self.assertFalse(result['success'])
+        self.assertIn('timed out', result['error'])
+
+    def test_runaway_output_is_capped(self):
+        """Test a command writing without end is stopped at the byte cap with head and tail kept"""
+        from modules.process_runner import ProcessRunner
+        runner = ProcessRunner(head_bytes=100, tail_bytes=50, max_bytes=1024 * 1024)
+        result = runner.run(f'{sys.executable} -c "while True: print(\'x\' * 79)"', 10)
+        self.assertFalse(result['success'])
+        self.assertIn('more than 1048576 bytes', result['error'])
+        self.assertGreater(result['dropped_bytes'], 1000000)
+        self.assertIn('bytes dropped', result['output'])
+        self.assertLess(len(result['output']), 250)
+
+    @unittest.skipIf(os.name == 'nt', 'uses POSIX sleep')
+    def test_timeout_reaps_whole_pipeline(self):
+        """Test every process of a timed-out pipeline is killed, not just the shell"""
+        import psutil
+        from modules.process_runner import ProcessRunner, get_reaper_stats
+        before = get_reaper_stats()['processes_reaped']
+        result = ProcessRunner().run('sleep 31.7 | sleep 31.7', 0.3)
+        self.assertIn('timed out', result['error'])
+        self.assertGreaterEqual(get_reaper_stats()['processes_reaped'] - before, 3)
+        leftovers = [p for p in psutil.process_iter(['cmdline']) if p.info['cmdline'] == ['sleep', '31.7']]
+        self.assertEqual(leftovers, [])
+    
+    @unittest.skipIf(os.name == 'nt', 'uses POSIX process groups')
+    def test_leftover_group_is_scanned_only_while_alive(self):
+        """Test background children are reaped and an empty group skips the process scan"""
+        import psutil
+        from modules import process_runner
+        result = process_runner.ProcessRunner().run('sleep 31.9 >/dev/null 2>&1 & echo started', 5)
+        self.assertIn('started', result['output'])
+        leftovers = [p for p in psutil.process_iter(['cmdline']) if p.info['cmdline'] == ['sleep', '31.9']]
+        self.assertEqual(leftovers, [])
+        with mock.patch.object(process_runner, '_group_members') as scan:
+            process_runner.ProcessRunner().run('echo done', 5)
+            scan.assert_not_called()
+
+    @unittest.skipIf(os.name == 'nt', 'uses POSIX sessions')
+    def test_readers_stop_when_a_survivor_holds_the_pipe(self):
+        """Test reader threads exit and release the pipe when an escaped grandchild keeps it open"""
+        import threading
+        import time
+        import psutil
+        from modules.process_runner import ProcessRunner
+        script = 'import os, time; os.setsid(); time.sleep(30.7)'
+        self.addCleanup(lambda: [p.kill() for p in psutil.process_iter(['cmdline'])
+                                 if p.info['cmdline'] and 'time.sleep(30.7)' in ' '.join(p.info['cmdline'])])
+        before = threading.active_count()
+        result = ProcessRunner().run(f'{sys.executable} -c "{script}" & sleep 0.3; echo started', 1)
+        self.assertIn('started', result['output'])
+        time.sleep(0.3)
+        self.assertEqual(threading.active_count(), before)
+
+class TestJobManager(unittest.TestCase):
+    """Test background command jobs"""
+    
+    def setUp(self):
+        from modules.process_runner import ProcessRunner
+        from modules.job_manager import JobManager
+        runner = ProcessRunner(batch_interval=0.05)
+        self.manager = JobManager(
+            lambda job, on_output, cancel: runner.run(job.command, 10, on_output, cancel),
+            workers=1, max_pending=1
+        )
+        self.addCleanup(self.manager.shutdown)
+    
+    def wait_for(self, job):
+        job.future.exception(timeout=10)
+        return job.to_dict()
+    
+    def test_submit_returns_before_command_finishes(self):
+        """Test a job id comes back at once and the result is available by polling"""
+        import time
+        started = time.monotonic()
+        job = self.manager.submit(f'{sys.executable} -c "import time; time.sleep(0.3); print(sum(range(10**6)))"')
+        self.assertLess(time.monotonic() - started, 0.2)
+        self.assertIn(self.manager.get(job.id).status, ('queued', 'running'))
+        
+        status = self.wait_for(job)
+        self.assertEqual(status['status'], 'succeeded')
+        self.assertEqual(status['output'].strip(), str(sum(range(10 ** 6))))
+        self.assertEqual(status['recent_output'], [str(sum(range(10 ** 6)))])
+        self.assertGreaterEqual(status['resources']['wall_time'], 0.3)
+        if hasattr(os, 'wait4'):
+            self.assertGreater(status['resources']['cpu_user'] + status['resources']['cpu_system'], 0)
+            self.assertGreater(status['resources']['max_rss_kb'], 0)
+    
+    def test_cancel_running_and_queued_jobs(self):
+        """Test cancelling kills a running job and drops a queued one, and the queue is bounded"""
+        import time
+        from modules.job_manager import JobQueueFull
+        running = self.manager.submit(f'{sys.executable} -c "import time; time.sleep(5)"')
+        started = time.monotonic()
+        while self.manager.get(running.id).status == 'queued':
+            self.assertLess(time.monotonic() - started, 5, 'the job never started')
+            time.sleep(0.01)
+        queued = self.manager.submit('echo never')
+        with self.assertRaises(JobQueueFull):
+            self.manager.submit('echo refused')
+        
+        self.assertEqual(self.manager.cancel(queued.id).status, 'cancelled')
+        self.manager.cancel(running.id)
+        status = self.wait_for(running)
+        self.assertEqual(status['status'], 'cancelled')
+        self.assertLess(status['resources']['wall_time'], 2)
+        self.assertEqual(self.manager.get_stats()['totals']['cancelled'], 2)
+    
+    def test_diagnostic_mode_keeps_the_allowlist(self):
+        """Test a command outside the allowlist is refused even when sent as a diagnostic"""
+        import app
+        with mock.patch.object(app.automated_diagnostics, 'execute_command_stream') as run:
+            result = app.run_user_command('rm -rf /tmp/x', 'Custom', None, True, lambda lines: None, None)
+        run.assert_not_called()
+        self.assertFalse(result['success'])
+        self.assertEqual(result['error'], 'Security validation failed')
+
+class TestDiagnosticBundle(unittest.TestCase):
+    """Test concurrent diagnostic bundles and playbooks"""
+    
+    def setUp(self):
+        from modules.automated_diagnostics import AutomatedDiagnostics, DiagnosticCommand
+        self.diagnostics = AutomatedDiagnostics()
+        self.make = lambda name, seconds: DiagnosticCommand(
+            name=name, description=name, category='custom', risk_level='low',
+            command=f'{sys.executable} -c "import time; time.sleep({seconds}); print({name!r})"'
+        )
+    
+    def test_bundle_takes_as_long_as_slowest_command(self):
+        """Test commands run concurrently and results arrive in completion order"""
+        import time
+        started = time.monotonic()
+        arrivals = []
+        for result in self.diagnostics.iter_bundle([self.make('slow', 0.6), self.make('fast', 0.1), self.make('medium', 0.3)]):
+            arrivals.append((result['name'], time.monotonic() - started))
+        self.assertEqual([name for name, _ in arrivals], ['fast', 'medium', 'slow'])
+        self.assertLess(arrivals[0][1], 0.5)
+        self.assertLess(arrivals[-1][1], 1.2)
+    
+    def test_aggregate_deadline_stops_stragglers(self):
+        """Test a command outliving the bundle deadline is killed and reported"""
+        from modules.deadline import Deadline
+        results = {result['name']: result for result in
+                   self.diagnostics.execute_bundle([self.make('quick', 0), self.make('stuck', 5)], Deadline(0.5))}
+        self.assertTrue(results['quick']['success'])
+        self.assertFalse(results['stuck']['success'])
+        self.assertIn('timed out', results['stuck']['error'])
+        self.assertLess(results['stuck']['duration'], 2)
+    
+    def test_playbook_skips_ruled_out_subtrees(self):
+        """Test upstream facts skip pointless checks while independent branches still run"""
+        from modules.automated_diagnostics import AutomatedDiagnostics
+        with mock.patch('platform.system', return_value='Linux'):
+            diagnostics = AutomatedDiagnostics()
+        loopback_only = '1: lo: <LOOPBACK,UP,LOWER_UP> mtu 65536\n    inet 127.0.0.1/8 scope host lo\n'
+        connected = loopback_only + '2: eth0: <BROADCAST,MULTICAST,UP,LOWER_UP> mtu 1500\n    inet 192.168.1.20/24 brd 192.168.1.255 scope global eth0\n'
+        outputs = {
+            'nslookup google.com': ('', "** server can't find google.com: SERVFAIL"),
+            'ping -c 2 8.8.8.8': ('2 packets transmitted, 2 received, 0% packet loss, time 1001ms', None)
+        }
+        calls = []
+        
+        def run(command, timeout, on_output=None, cancel=None):
+            calls.append(command)
+            output, error = (interfaces, None) if command == 'ip addr show' else outputs[command]
+            return {'success': error is None, 'output': output, 'error': error}
+        
+        playbook = diagnostics.get_playbook('network')
+        with mock.patch.object(diagnostics.process_runner, 'run', side_effect=run):
+            interfaces = loopback_only
+            results = {result['step']: result for result in diagnostics.iter_playbook(playbook)}
+            self.assertEqual(calls, ['ip addr show'])
+            self.assertEqual([results[step]['status'] for step in ('reachability', 'dns', 'connectivity')], ['skipped'] * 3)
+            
+            calls.clear()
+            interfaces = connected
+            results = {result['step']: result for result in diagnostics.iter_playbook(playbook)}
+            self.assertEqual(sorted(calls), ['ip addr show', 'nslookup google.com', 'ping -c 2 8.8.8.8'])
+            self.assertEqual(results['connectivity']['skipped_reason'], 'DNS resolution failed')
+    
+    def test_playbook_rejects_cycles(self):
+        """Test a playbook whose steps depend on each other in a loop is refused"""
+        from modules.diagnostic_playbooks import Playbook, PlaybookEdge, PlaybookStep
+        with self.assertRaises(ValueError):
+            Playbook('loop', [
+                PlaybookStep('a', self.make('a', 0), [PlaybookEdge('b')]),
+                PlaybookStep('b', self.make('b', 0), [PlaybookEdge('a')])
+            ])
+
+class TestCommandCache(unittest.TestCase):
+    """Test the bounded command cache"""
+    
+    def test_lru_eviction(self):
+        """Test least recently used entries are evicted past max_entries"""
+        cache = CommandCache(max_entries=2, max_bytes=1024, default_ttl=60)
+        cache.set('a', '1')
+        cache.set('b', '2')
+        cache.get('a')
+        cache.set('c', '3')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), '1')
+        self.assertEqual(cache.get_stats()['evictions'], 1)
+    
+    def test_expired_entries_are_swept(self):
+        """Test expired entries are removed by a sweep"""
+        cache = CommandCache(default_ttl=60)
+        cache.set('a', '1', ttl=0)
+        self.assertEqual(cache.sweep(), 1)
+        self.assertEqual(cache.get_stats()['total_entries'], 0)
+    
+    def test_single_flight_loading(self):
+        """Test concurrent misses for one key run the loader once"""
+        import threading
+        cache = CommandCache(default_ttl=60)
+        calls = []
+        release = threading.Event()
+        
+        def loader():
+            calls.append(1)
+            release.wait(1)
+            return {'output': 'pong'}
+        
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get_or_load('ping', loader)))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join()
+        
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{'output': 'pong'}] * 5)
+
+class TestResponseCache(unittest.TestCase):
+    """Test the first-turn answer cache"""
+    
+    def setUp(self):
+        from modules.response_cache import ResponseCache
+        self.cache = ResponseCache(max_entries=2, ttl=60, similarity_threshold=0.6, num_perm=32, bands=16)
+        self.answer = {'response': 'Restart the router.', 'system_commands': [], 'escalation': False}
+    
+    def test_exact_and_near_duplicate_hits(self):
+        """Test normalized and near-duplicate questions hit, other OSes and topics miss"""
+        self.cache.set('Windows', 'My WiFi is not working!', self.answer)
+        self.assertEqual(self.cache.get('win', 'wi-fi not working'), self.answer)
+        self.assertEqual(self.cache.get('windows', 'wifi not working on my laptop'), self.answer)
+        self.assertIsNone(self.cache.get('linux', 'wifi not working'))
+        self.assertIsNone(self.cache.get('windows', 'printer is offline'))
+        stats = self.cache.get_stats()
+        self.assertEqual((stats['exact_hits'], stats['near_hits'], stats['misses']), (1, 1, 2))
+    
+    def test_negation_is_not_a_duplicate(self):
+        """Test a question and its negation never share an answer"""
+        self.cache.set('windows', 'my wifi is not working', self.answer)
+        self.assertIsNone(self.cache.get('windows', 'my wifi is working'))
+        self.assertEqual(self.cache.get('windows', "my wifi doesn't work"), self.answer)
+    
+    def test_swapped_subjects_miss(self):
+        """Test questions with the same words about different subjects do not share an answer"""
+        self.cache.set('windows', 'wifi works but ethernet does not', self.answer)
+        self.assertIsNone(self.cache.get('windows', 'ethernet works but wifi does not'))
+        self.assertEqual(self.cache.get_stats()['exact_hits'], 0)
+    
+    def test_lru_eviction(self):
+        """Test the least recently used answer is evicted first"""
+        self.cache.set('linux', 'printer offline', self.answer)
+        self.cache.set('linux', 'disk full', self.answer)
+        self.cache.get('linux', 'printer offline')
+        self.cache.set('linux', 'vpn disconnects', self.answer)
+        self.assertIsNone(self.cache.get('linux', 'disk full'))
+        self.assertIsNotNone(self.cache.get('linux', 'printer offline'))
+
+class TestOutputReducers(unittest.TestCase):
+    """Test parsing diagnostic output into compact facts"""
+    
+    def test_ping_and_df_facts(self):
+        """Test ping statistics and full disks are extracted"""
+        from modules.output_reducers import OutputReducer
+        reducer = OutputReducer()
+        ping = reducer.reduce('ping -c 4 google.com', (
+            "PING google.com (142.250.80.46) 56(84) bytes of data.\n"
+            + "64 bytes from 142.250.80.46: icmp_seq=1 ttl=117 time=1.23 ms\n" * 4
+            + "4 packets transmitted, 3 received, 25% packet loss, time 3004ms\n"
+            "rtt min/avg/max/mdev = 1.123/1.245/1.412/0.105 ms\n"
+        ))
+        self.assertEqual(ping['reducer'], 'ping')
+        self.assertEqual(ping['facts']['loss_pct'], 25)
+        self.assertEqual(ping['facts']['rtt_ms']['avg'], 1.245)
+        self.assertLess(ping['tokens_after'], ping['tokens_before'])
+        
+        from modules.output_reducers import reduce_df
+        facts = reduce_df((
+            "Filesystem      Size  Used Avail Use% Mounted on\n"
+            "tmpfs            64M     0   64M   0% /dev\n"
+            "/dev/sda1        59G   56G  3.0G  95% /\n"
+            "/dev/sdb1       100G   10G   90G  10% /mnt/data\n"
+        ))
+        self.assertEqual(facts['nearly_full'], ['/'])
+        self.assertEqual(facts['count'], 2)
+    
+    def test_global_ipv6_counts_as_an_address(self):
+        """Test an IPv6-only host has an address while link-local IPv6 alone does not"""
+        from modules.diagnostic_playbooks import has_ip_address
+        from modules.output_reducers import reduce_interfaces, reduce_ipconfig
+        link_local = ('2: eth0: <BROADCAST,MULTICAST,UP,LOWER_UP> mtu 1500\n'
+                      '    inet6 fe80::1c2b:3ff:fe4d:5e6f/64 scope link\n')
+        self.assertFalse(has_ip_address(reduce_interfaces(link_local)))
+        facts = reduce_interfaces(link_local + '    inet6 2001:db8::20/64 scope global dynamic\n')
+        self.assertEqual(facts['interfaces'][0]['ipv6_global'], ['2001:db8::20'])
+        self.assertTrue(has_ip_address(facts))
+        
+        adapter = ('Ethernet adapter Ethernet:\n\n'
+                   '   Link-local IPv6 Address . . . . . : fe80::8d4f:1a2b:3c4d:5e6f%12(Preferred)\n')
+        self.assertFalse(has_ip_address(reduce_ipconfig(adapter)))
+        self.assertTrue(has_ip_address(reduce_ipconfig(
+            adapter + '   IPv6 Address. . . . . . . . . . . : 2001:db8::5(Preferred)\n')))
+    
+    def test_unknown_command_passes_through(self):
+        """Test output of commands without a parser is sent unchanged"""
+        from modules.output_reducers import OutputReducer
+        result = OutputReducer().reduce('uptime', ' 10:00:00 up 1 day,  load average: 0.1, 0.2, 0.3')
+        self.assertIsNone(result['reducer'])
+        self.assertIn('load average', result['text'])
+
+class TestVerdictEngine(unittest.TestCase):
+    """Test local verdicts for clear-cut command results"""
+    
+    def test_clear_cut_results_are_answered(self):
+        """Test total packet loss and NXDOMAIN are answered locally and counted per rule"""
+        from modules.verdict_engine import VerdictEngine
+        engine = VerdictEngine()
+        rule, response = engine.evaluate('ping -c 2 10.9.9.9', (
+            "PING 10.9.9.9 (10.9.9.9) 56(84) bytes of data.\n"
+            "2 packets transmitted, 0 received, 100% packet loss, time 1001ms\n"
+        ), '', 'linux')
+        self.assertEqual(rule, 'ping_total_loss')
+        self.assertIn('100% packet loss', response)
+        
+        rule, _ = engine.evaluate('nslookup nope.invalid', "** server can't find nope.invalid: NXDOMAIN\n", '', 'windows')
+        self.assertEqual(rule, 'dns_nxdomain')
+        
+        # Ambiguous results are left to GPT-4o
+        self.assertIsNone(engine.evaluate('ping -c 4 host', "4 packets transmitted, 3 received, 25% packet loss\n", '', 'linux'))
+        stats = engine.get_stats()
+        self.assertEqual((stats['evaluations'], stats['answered']), (3, 2))
+        self.assertEqual(stats['rule_hits']['dns_nxdomain'], 1)
+    
+    def test_server_failures_and_ip_pings_are_not_overclaimed(self):
+        """Test SERVFAIL is not reported as a missing domain and pinging an IP says nothing about DNS"""
+        from modules.verdict_engine import VerdictEngine
+        engine = VerdictEngine()
+        for output in ("** server can't find example.com: SERVFAIL\n",
+                       "** server can't find example.com: REFUSED\n",
+                       "Server:  UnKnown\nAddress:  10.0.0.1\n\n*** UnKnown can't find example.com: Server failed\n"):
+            self.assertIsNone(engine.evaluate('nslookup example.com', output, '', 'linux'), output)
+        
+        ping = ("PING {0} (8.8.8.8) 56(84) bytes of data.\n"
+                "2 packets transmitted, 2 received, 0% packet loss, time 1001ms\n"
+                "rtt min/avg/max/mdev = 10.1/12.0/13.9/1.9 ms\n")
+        _, response = engine.evaluate('ping -c 2 8.8.8.8', ping.format('8.8.8.8'), '', 'linux')
+        self.assertNotIn('DNS', response)
+        _, response = engine.evaluate('ping -c 2 dns.google', ping.format('dns.google'), '', 'linux')
+        self.assertIn('DNS are working', response)
 
 class TestNetworkTools(unittest.TestCase):
     """Test network diagnostics functionality"""
@@ -143,6 +593,317 @@ class TestNetworkTools(unittest.TestCase):
         self.assertIn('success', result)
         self.assertIn('output', result)
 
+class TestProbeEngine(unittest.TestCase):
+    """Test in-process network probes against a local responder"""
+    
+    def test_probes_report_latency_and_answers(self):
+        """Test TCP and DNS probes measure round trips and decode answers"""
+        from modules.probe_engine import ProbeEngine, ProbeTarget, LocalResponder
+        engine = ProbeEngine(timeout=1, count=3, interval=0.01)
+        with LocalResponder(records={'example.com': ['192.0.2.7']}) as responder:
+            results = engine.probe([
+                ProbeTarget('tcp', 'tcp', '127.0.0.1', responder.tcp_port),
+                ProbeTarget('dns', 'dns', '127.0.0.1', responder.dns_port, 'example.com'),
+                ProbeTarget('nxdomain', 'dns', '127.0.0.1', responder.dns_port, 'missing.example')
+            ])
+        self.assertEqual(results['tcp']['received'], 3)
+        self.assertLessEqual(results['tcp']['rtt_ms']['min'], results['tcp']['rtt_ms']['max'])
+        self.assertEqual(results['dns']['addresses'], ['192.0.2.7'])
+        self.assertEqual(results['dns']['rcode'], 'NOERROR')
+        self.assertEqual(results['nxdomain']['rcode'], 'NXDOMAIN')
+        self.assertEqual(engine.get_stats()['probes'], {'tcp': 3, 'dns': 6})
+    
+    def test_unanswered_targets_share_one_timeout_window(self):
+        """Test several silent targets cost one timeout in total and report full loss"""
+        import time
+        from modules.probe_engine import ProbeEngine, ProbeTarget, LocalResponder
+        engine = ProbeEngine(timeout=0.5, count=3, interval=0.01)
+        with LocalResponder(drop={'slow.example'}) as responder:
+            started = time.monotonic()
+            results = engine.probe([
+                ProbeTarget(f'dns{index}', 'dns', '127.0.0.1', responder.dns_port, 'slow.example') for index in range(4)
+            ])
+            elapsed = time.monotonic() - started
+        self.assertLess(elapsed, 1.0)
+        self.assertTrue(all(result['loss_pct'] == 100.0 and not result['success'] for result in results.values()))
+        self.assertEqual(responder.queries, 12)
+    
+    def test_rtt_statistics(self):
+        """Test loss, min/avg/max and jitter are derived from per-probe round trips"""
+        from modules.probe_engine import summarize_rtts
+        stats = summarize_rtts([10.0, None, 14.0, 12.0])
+        self.assertEqual(stats['loss_pct'], 25.0)
+        self.assertEqual(stats['rtt_ms'], {'min': 10.0, 'avg': 12.0, 'max': 14.0, 'jitter': 3.0})
+
+    def test_echo_replies_match_with_or_without_ip_header(self):
+        """Test replies are recognized behind an IPv4 header and foreign replies are ignored"""
+        import struct
+        from modules.probe_engine import _is_echo_reply
+        payload = b'0123456789abcdef'
+        reply = struct.pack('!BBHHH', 0, 0, 0, 0x1234, 7) + payload
+        ip_header = bytes([0x45]) + bytes(19)
+        self.assertTrue(_is_echo_reply(reply, {0x1234}, 7, payload))
+        self.assertTrue(_is_echo_reply(ip_header + reply, {0x1234}, 7, payload))
+        self.assertFalse(_is_echo_reply(ip_header + reply, {0x4321}, 7, payload))
+        self.assertFalse(_is_echo_reply(reply, {0x1234}, 8, payload))
+        self.assertFalse(_is_echo_reply(ip_header[:6], {0x1234}, 7, payload))
+
+class TestDnsProbe(unittest.TestCase):
+    """Test the multi-resolver DNS benchmark against local stand-in servers"""
+    
+    def test_fastest_healthy_resolver_is_recommended(self):
+        """Test slow, hijacking and silent resolvers are ranked below the fastest correct one"""
+        import time
+        from contextlib import ExitStack
+        from modules.dns_probe import DnsProbe, Resolver
+        from modules.probe_engine import LocalResponder
+        records = {'example.com': ['93.184.216.34'], 'example.org': ['93.184.216.35']}
+        with ExitStack() as stack:
+            current = stack.enter_context(LocalResponder(records, delay=0.05))
+            fast = stack.enter_context(LocalResponder(records))
+            hijacker = stack.enter_context(LocalResponder(records, default=['93.184.216.99']))
+            silent = stack.enter_context(LocalResponder(records, drop=set(records)))
+            probe = DnsProbe([
+                Resolver('127.0.0.1', 'Current', current.dns_port, system=True),
+                Resolver('127.0.0.1', 'Fast', fast.dns_port),
+                Resolver('127.0.0.1', 'Hijacker', hijacker.dns_port),
+                Resolver('127.0.0.1', 'Silent', silent.dns_port)
+            ], names=['example.com', 'example.org'], timeout=0.5, attempts=2)
+            started = time.monotonic()
+            report = probe.benchmark()
+            elapsed = time.monotonic() - started
+        
+        self.assertLess(elapsed, 1.0)
+        by_name = {resolver['name']: resolver for resolver in report['resolvers']}
+        self.assertEqual(report['recommended']['name'], 'Fast')
+        self.assertTrue(by_name['Current']['healthy'])
+        self.assertIn('answers for names that do not exist (NOERROR)', by_name['Hijacker']['issues'])
+        self.assertEqual(by_name['Silent']['loss_pct'], 100.0)
+        self.assertFalse(by_name['Silent']['healthy'])
+        self.assertIn('Fast (127.0.0.1)', report['recommendation'])
+        self.assertEqual(by_name['Fast']['sent'], 4)
+    
+    def test_resolution_check_is_bounded(self):
+        """Test the quick check answers from the system resolver and gives up after its timeout"""
+        import time
+        from modules.dns_probe import DnsProbe, Resolver
+        from modules.probe_engine import LocalResponder
+        with LocalResponder({'google.com': ['142.250.0.1']}, drop={'hang.example'}) as responder:
+            probe = DnsProbe([Resolver('127.0.0.1', 'System resolver', responder.dns_port, system=True)])
+            self.assertTrue(probe.check_resolution('google.com', timeout=0.5))
+            started = time.monotonic()
+            self.assertFalse(probe.check_resolution('hang.example', timeout=0.3))
+            self.assertLess(time.monotonic() - started, 0.8)
+
+class TestSystemPromptLibrary(unittest.TestCase):
+    """Test precomputed per-OS system prompts"""
+    
+    def test_prompts_are_trimmed_per_os(self):
+        """Test each OS prompt only carries its own OS sections"""
+        from modules.prompts import SystemPromptLibrary
+        library = SystemPromptLibrary()
+        linux_prompt = library.get('Linux')
+        self.assertIn('**Linux Commands:**', linux_prompt)
+        self.assertNotIn('**Windows Commands:**', linux_prompt)
+        self.assertNotIn('**macOS SECURITY NOTES:**', linux_prompt)
+        self.assertIs(library.get('linux'), linux_prompt)
+        self.assertIn('macOS SECURITY NOTES', library.get('darwin'))
+        
+        stats = library.get_stats()
+        for variant in stats['variants'].values():
+            self.assertLess(variant['tokens'], stats['full_prompt_tokens'])
+
+class TestConnectivityMonitor(unittest.TestCase):
+    """Test the cached background connectivity monitor"""
+    
+    def test_status_is_cached(self):
+        """Test only the first read probes the network"""
+        monitor = ConnectivityMonitor(ttl=60, poll_interval=60)
+        with mock.patch('modules.network_tools.probe_internet_connectivity', return_value=True) as probe, \
+                mock.patch('modules.network_tools.probe_dns_resolution', return_value=True):
+            for _ in range(5):
+                self.assertTrue(monitor.is_internet_available())
+            monitor.stop()
+        self.assertEqual(probe.call_count, 1)
+        self.assertFalse(monitor.get_status()['stale'])
+    
+    def test_monitor_does_not_repeat_a_request_probe(self):
+        """Test the monitor thread skips its first probe when a request probed while it waited"""
+        import time
+        monitor = ConnectivityMonitor(ttl=60, poll_interval=60)
+        
+        def slow_probe(*args):
+            time.sleep(0.2)
+            return True
+        
+        with mock.patch('modules.network_tools.probe_internet_connectivity', side_effect=slow_probe) as probe, \
+                mock.patch('modules.network_tools.probe_dns_resolution', return_value=True):
+            self.assertTrue(monitor.is_internet_available())
+            time.sleep(0.1)
+            monitor.stop()
+        self.assertEqual(probe.call_count, 1)
+
+class TestCircuitBreaker(unittest.TestCase):
+    """Test the OpenAI circuit breaker"""
+    
+    def test_opens_and_recovers(self):
+        """Test the breaker fails fast after repeated failures and allows one trial later"""
+        from modules.llm_client import CircuitBreaker
+        breaker = CircuitBreaker(failure_threshold=2, recovery_timeout=0.05)
+        for _ in range(2):
+            self.assertTrue(breaker.allow_request())
+            breaker.record_failure()
+        self.assertFalse(breaker.allow_request())
+        
+        import time
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow_request())
+        self.assertFalse(breaker.allow_request())
+        breaker.record_success()
+        self.assertEqual(breaker.get_stats()['state'], 'closed')
+
+class TestAsyncPipeline(unittest.TestCase):
+    """Test the asyncio pipeline runner and bounded LLM concurrency"""
+    
+    def test_concurrency_is_bounded(self):
+        """Test concurrent async calls never exceed LLM_MAX_CONCURRENCY upstream"""
+        import asyncio
+        from modules.async_runner import AsyncRunner
+        from modules.llm_client import LLMClient
+        client = LLMClient(api_key='test-key')
+        client.max_concurrency = 2
+        
+        async def fake_create(**kwargs):
+            await asyncio.sleep(0.02)
+            return 'ok'
+        
+        async def fan_out():
+            async_client, _ = client._get_async_resources()
+            async_client.chat.completions.create = fake_create
+            return await asyncio.gather(*(client.achat_completion(model='x', messages=[]) for _ in range(6)))
+        
+        runner = AsyncRunner(max_blocking_workers=2)
+        try:
+            self.assertEqual(runner.run(fan_out(), timeout=5), ['ok'] * 6)
+        finally:
+            runner.stop()
+        self.assertEqual(client.get_stats()['async_peak_in_flight'], 2)
+
+class TestRequestCoalescing(unittest.TestCase):
+    """Test identical in-flight chat requests share one GPT-4o call"""
+    
+    def setUp(self):
+        self.handler = build_chat_handler()
+    
+    def test_duplicate_waits_for_leader(self):
+        """Test a concurrent duplicate gets the leader's result without processing again"""
+        import threading
+        handler = self.handler
+        
+        started, release, calls = threading.Event(), threading.Event(), []
+        
+        def slow_process(user_message, os_type, session_id=None):
+            calls.append(user_message)
+            started.set()
+            release.wait(5)
+            return {'response': 'done', 'system_commands': [], 'escalation': False}
+        
+        handler._process_message = slow_process
+        results = []
+        leader = threading.Thread(target=lambda: results.append(handler.process_message('hi', 'linux', 's1')))
+        leader.start()
+        started.wait(5)
+        follower = threading.Thread(target=lambda: results.append(handler.process_message('hi', 'linux', 's1')))
+        follower.start()
+        import time
+        while handler.coalesced_requests == 0:
+            time.sleep(0.01)
+        release.set()
+        leader.join(5)
+        follower.join(5)
+        
+        self.assertEqual(len(calls), 1)
+        self.assertEqual([r['response'] for r in results], ['done', 'done'])
+        self.assertEqual(handler.get_inflight_stats()['in_flight'], 0)
+
+    def test_async_duplicate_waits_on_the_loop(self):
+        """Test an async duplicate gets the result, and a timed-out one leaves the leader's future intact"""
+        import asyncio
+        from concurrent.futures import Future
+        handler = self.handler
+        
+        async def wait_for(future, delay):
+            asyncio.get_running_loop().call_later(delay, future.set_result, {'response': 'done'})
+            return await handler._aawait_inflight(future)
+        
+        self.assertEqual(asyncio.run(wait_for(Future(), 0.01)), {'response': 'done'})
+        future = Future()
+        with mock.patch('modules.chat_handler.Config.INFLIGHT_WAIT_TIMEOUT', 0.01):
+            self.assertIsNone(asyncio.run(handler._aawait_inflight(future)))
+        self.assertFalse(future.cancelled())
+        self.assertEqual(handler.coalesce_fallbacks, 1)
+
+class TestModelRouter(unittest.TestCase):
+    """Test model tier routing and escalation on invalid JSON"""
+    
+    def setUp(self):
+        self.handler = build_chat_handler()
+    
+    def test_routing_decisions(self):
+        """Test acknowledgements and short follow-ups go small, new and technical issues go large"""
+        from modules.model_router import ModelRouter
+        router = ModelRouter(tiers={'small': 'mini', 'large': 'big'}, enabled=True)
+        self.assertEqual(router.route('thanks, it works!', 'general', 3).tier, 'small')
+        self.assertEqual(router.route('no', 'general', 3).tier, 'large')
+        self.assertEqual(router.route('Nope!', 'general', 3).tier, 'large')
+        self.assertEqual(router.route('which menu is that in?', 'general', 2).tier, 'small')
+        self.assertEqual(router.route('my wifi keeps dropping', 'network', 2).tier, 'large')
+        self.assertEqual(router.route('which menu is that in?', 'general', 0).tier, 'large')
+        self.assertEqual(router.route('x' * 500, 'general', 1).tier, 'large')
+        self.assertEqual(ModelRouter(enabled=False).route('thanks', 'general', 3).tier, 'large')
+    
+    def test_invalid_small_reply_escalates(self):
+        """Test a small-tier reply that is not valid JSON is retried on the large tier"""
+        from unittest.mock import MagicMock
+        from modules.deadline import Deadline
+        from modules.model_router import ModelRouter
+        handler = self.handler
+        handler.model_router = ModelRouter(tiers={'small': 'mini', 'large': 'big'}, enabled=True)
+        replies = {'mini': 'not json', 'big': '{"response": "Glad it works!"}'}
+        
+        def fake_completion(timeout=None, model=None, **kwargs):
+            response = MagicMock()
+            response.choices[0].message.content = replies[model]
+            response.usage.prompt_tokens, response.usage.completion_tokens = 100, 20
+            return response
+        
+        handler.llm_client.chat_completion.side_effect = fake_completion
+        decision = handler.model_router.route('thanks!', 'general', 2)
+        text = handler._complete_turn(decision, [], Deadline(5))
+        
+        self.assertEqual(text, replies['big'])
+        stats = handler.model_router.get_stats()['tiers']
+        self.assertEqual(stats['small']['escalations'], 1)
+        self.assertEqual((stats['small']['calls'], stats['large']['calls']), (1, 1))
+        self.assertEqual(stats['large']['prompt_tokens'], 100)
+
+class TestResponseFieldStreamer(unittest.TestCase):
+    """Test incremental extraction of streamed GPT-4o replies"""
+    
+    def test_extracts_response_across_chunks(self):
+        """Test response text is decoded as chunks arrive, including split escapes"""
+        streamer = ResponseFieldStreamer()
+        chunks = ['{"resp', 'onse": "Line one\\', 'nLine \\"two\\" \\ud83d', '\\ude00", "escalation": false}']
+        text = ''.join(streamer.feed(chunk) for chunk in chunks)
+        self.assertEqual(text, 'Line one\nLine "two" \U0001F600')
+        self.assertTrue(streamer.finished)
+    
+    def test_ignores_other_fields(self):
+        """Test nothing is emitted until the response field starts"""
+        streamer = ResponseFieldStreamer()
+        self.assertEqual(streamer.feed('{"escalation": false, "system_commands": []'), '')
+        self.assertEqual(streamer.feed(', "response": "ok"}'), 'ok')
+
 class TestDatabase(unittest.TestCase):
     """Test database functionality"""
     
@@ -204,6 +965,140 @@ class TestDatabase(unittest.TestCase):
         count = self.cursor.fetchone()[0]
         self.assertEqual(count, 1)
 
+class TestChatDatabase(unittest.TestCase):
+    """Test the pooled chat database"""
+    
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.database = ChatDatabase(os.path.join(self.temp_dir, 'chat.db'))
+    
+    def tearDown(self):
+        self.database.close()
+        import shutil
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+    
+    def test_connections_are_reused(self):
+        """Test a chat turn reuses one pooled WAL connection"""
+        self.database.create_session('test_session', 'Linux')
+        self.database.get_conversation_history('test_session')
+        self.database.store_message('test_session', 'Hello', 'Hi there!', 'Linux')
+        
+        history = self.database.get_conversation_history('test_session')
+        self.assertEqual(history[-1]['bot_response'], 'Hi there!')
+        self.assertEqual(self.database.get_pool_stats()['connections_opened'], 1)
+        with self.database.pool.connection() as conn:
+            self.assertEqual(conn.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+    
+    def test_failed_history_read_is_not_a_first_turn(self):
+        """Test a session whose history cannot be read is never treated as new"""
+        with mock.patch('modules.chat_handler.Config.RESPONSE_CACHE_ENABLED', True):
+            handler = build_chat_handler(self.database)
+        self.database.create_session('test_session', 'Linux')
+        self.assertTrue(handler._is_first_turn('test_session'))
+        self.database.store_message('test_session', 'Hello', 'Hi there!', 'Linux')
+        self.assertFalse(handler._is_first_turn('test_session'))
+        with mock.patch.object(self.database, '_read_history', side_effect=sqlite3.OperationalError('locked')):
+            self.assertIsNone(self.database.has_conversation_history('other_session'))
+            self.assertFalse(handler._is_first_turn('other_session'))
+    
+    def test_command_executions_share_one_transaction(self):
+        """Test a batch of command results is committed together"""
+        self.database.store_command_executions('test_session', [
+            {'command': 'df -h', 'description': 'Disk', 'output': 'ok', 'error': None, 'success': True},
+            {'command': 'ping -c 4 example.com', 'description': 'Ping', 'output': '', 'error': 'timed out', 'success': False}
+        ])
+        self.database.flush()
+        self.assertEqual(len(self.database.get_command_executions('test_session')), 2)
+        if self.database.writer:
+            self.assertEqual(self.database.get_writer_stats()['committed_writes'], 1)
+    
+    def test_deadline_interrupts_queries(self):
+        """Test a request deadline stops a long query and blocks new work once passed"""
+        from modules.deadline import Deadline, DeadlineExceeded
+        with self.database.pool.connection(Deadline(0.05)) as conn:
+            with self.assertRaises(sqlite3.OperationalError):
+                conn.execute(
+                    'WITH RECURSIVE n(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM n) SELECT COUNT(*) FROM n'
+                ).fetchone()
+        with self.assertRaises(DeadlineExceeded):
+            with self.database.pool.connection(Deadline(0)):
+                pass
+        # The connection goes back to the pool without the deadline attached
+        with self.database.pool.connection() as conn:
+            self.assertEqual(conn.execute('SELECT 1').fetchone()[0], 1)
+    
+    def test_exhausted_pool_is_not_a_deadline(self):
+        """Test a busy pool reports exhaustion, and only a passed deadline reports a timeout"""
+        from modules.db_connection import SQLiteConnectionPool, PoolExhausted
+        from modules.deadline import Deadline, DeadlineExceeded
+        pool = SQLiteConnectionPool(os.path.join(self.temp_dir, 'pool.db'), max_connections=1, busy_timeout=50)
+        self.addCleanup(pool.close_all)
+        with pool.connection():
+            with self.assertRaises(PoolExhausted):
+                with pool.connection():
+                    pass
+            with self.assertRaises(PoolExhausted):
+                with pool.connection(Deadline(5)):
+                    pass
+            with self.assertRaises(DeadlineExceeded):
+                with pool.connection(Deadline(0.02)):
+                    pass
+    
+    def test_context_builder_respects_budget(self):
+        """Test long sessions are summarized into a bounded prompt"""
+        from modules.context_builder import ContextBuilder, count_message_tokens
+        for i in range(40):
+            self.database.store_message('long_session', f'Question {i} about my wifi?', 'Try this. ' * 60, 'Linux')
+        
+        builder = ContextBuilder(self.database, token_budget=800, summary_token_budget=200, max_turn_tokens=300)
+        messages = builder.build('long_session')
+        self.assertLessEqual(count_message_tokens(messages), 800)
+        self.assertEqual(messages[0]['role'], 'system')
+        self.assertEqual(messages[-2]['content'], 'Question 39 about my wifi?')
+        
+        summary = self.database.get_session_summary('long_session')
+        self.assertIsNotNone(summary)
+        # A second build only reads turns newer than the summary watermark
+        self.assertEqual(builder.build('long_session'), messages)
+    
+    def test_write_behind_read_your_writes(self):
+        """Test queued writes are visible to reads and committed on flush"""
+        database = ChatDatabase(os.path.join(self.temp_dir, 'queued.db'), write_behind=True)
+        try:
+            database.create_session('queued_session', 'Linux')
+            for i in range(20):
+                database.store_message('queued_session', f'Question {i}', f'Answer {i}', 'Linux')
+            
+            history = database.get_conversation_history('queued_session', limit=5)
+            self.assertEqual([row['user_message'] for row in history],
+                             [f'Question {i}' for i in range(15, 20)])
+            
+            database.flush()
+            self.assertFalse(database.writer.has_pending('queued_session'))
+            self.assertEqual(database.get_session_stats()['total_messages'], 20)
+            self.assertLess(database.get_writer_stats()['batches'], 21)
+        finally:
+            database.close()
+    
+    def test_write_behind_keeps_order_when_full(self):
+        """Test a full queue makes callers wait, and writes after shutdown still land in order"""
+        import time
+        from modules.chat_database import WriteBehindWriter
+        applied = []
+        
+        def write(cursor, params):
+            if params == 0:
+                time.sleep(0.3)
+            applied.append(params)
+        
+        writer = WriteBehindWriter(self.database.pool, max_queue_size=1, batch_size=1, flush_interval=0.01)
+        for i in range(5):
+            writer.submit(write, i)
+        writer.shutdown()
+        writer.submit(write, 5)
+        self.assertEqual(applied, list(range(6)))
+        self.assertEqual(writer.get_stats()['sync_fallbacks'], 1)
+
 def run_tests():
     """Run all tests"""
     # Create test suite
@@ -214,8 +1109,25 @@ def run_tests():
     suite.addTests(loader.loadTestsFromTestCase(TestOSDetector))
     suite.addTests(loader.loadTestsFromTestCase(TestSecurityValidator))
     suite.addTests(loader.loadTestsFromTestCase(TestSystemCommands))
+    suite.addTests(loader.loadTestsFromTestCase(TestProcessRunner))
+    suite.addTests(loader.loadTestsFromTestCase(TestJobManager))
+    suite.addTests(loader.loadTestsFromTestCase(TestDiagnosticBundle))
+    suite.addTests(loader.loadTestsFromTestCase(TestCommandCache))
+    suite.addTests(loader.loadTestsFromTestCase(TestResponseCache))
+    suite.addTests(loader.loadTestsFromTestCase(TestOutputReducers))
+    suite.addTests(loader.loadTestsFromTestCase(TestVerdictEngine))
     suite.addTests(loader.loadTestsFromTestCase(TestNetworkTools))
+    suite.addTests(loader.loadTestsFromTestCase(TestProbeEngine))
+    suite.addTests(loader.loadTestsFromTestCase(TestDnsProbe))
+    suite.addTests(loader.loadTestsFromTestCase(TestConnectivityMonitor))
+    suite.addTests(loader.loadTestsFromTestCase(TestSystemPromptLibrary))
+    suite.addTests(loader.loadTestsFromTestCase(TestCircuitBreaker))
+    suite.addTests(loader.loadTestsFromTestCase(TestAsyncPipeline))
+    suite.addTests(loader.loadTestsFromTestCase(TestRequestCoalescing))
+    suite.addTests(loader.loadTestsFromTestCase(TestModelRouter))
+    suite.addTests(loader.loadTestsFromTestCase(TestResponseFieldStreamer))
     suite.addTests(loader.loadTestsFromTestCase(TestDatabase))
+    suite.addTests(loader.loadTestsFromTestCase(TestChatDatabase))
     
     # Run tests
     runner = unittest.TextTestRunner(verbosity=2)